@@ -0,0 +1,128 @@
+"""
+Adaptive sampling of scenarios around the boundary of unacceptable outcomes.
+
+Scenario discovery only needs to know where in the uncertainty space the
+outcomes become unacceptable, but a uniform sample spends most model runs
+far away from that boundary. The BoundarySampler starts from the model
+results on a small Latin hypercube, fits a random forest classifier of
+the unacceptable outcomes, and picks the next scenarios to run where the
+classifier is least certain. The scenarios are picked from a uniform pool
+and the ones that are not run are labelled by the classifier, so PRIM
+still gets a uniform sample, with model results where the label is in
+doubt.
+"""
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+
+
+class BoundarySampler:
+    """Active learning of unacceptable outcomes on a pool of scenarios
+
+    After each batch of model runs, a random forest is fitted on the
+    scenarios that were run and predicts the probability of an unacceptable
+    outcome for the whole pool. The next batch are the scenarios that were
+    not run yet and whose probability is closest to a half. Sampling is done
+    when no scenario that was not run is uncertain anymore.
+
+    Parameters
+    ----------
+    scenarios : DataFrame
+                the uncertainties of the pool of scenarios, a row per
+                scenario
+    thresholds : dict
+                 outcome name to the threshold from which the outcome is
+                 unacceptable, a scenario is unacceptable if one of the
+                 outcomes is
+    batch_size : int, optional
+    confidence : float, optional
+                 a scenario is uncertain if its probability of an
+                 unacceptable outcome is between 1 - confidence and
+                 confidence
+    seed : int, optional
+           seed of the random forest
+
+    Attributes
+    ----------
+    evaluated : ndarray
+                scenarios that were run
+    unacceptable : ndarray
+                   model results of the scenarios that were run, the label
+                   of the classifier otherwise
+    probability : ndarray
+                  probability of an unacceptable outcome, 0 or 1 for the
+                  scenarios that were run
+    log : list of dict
+          number of runs, unacceptable runs and uncertain scenarios, and the
+          out-of-bag accuracy of the classifier, after each batch
+
+    """
+
+    def __init__(self, scenarios, thresholds, batch_size=250, confidence=0.9, seed=None):
+        self.features = scenarios.to_numpy(dtype=float)
+        self.thresholds = dict(thresholds)
+        self.batch_size = batch_size
+        self.confidence = confidence
+        self.seed = seed
+
+        n_scenarios = len(self.features)
+        self.evaluated = np.zeros(n_scenarios, dtype=bool)
+        self.unacceptable = np.zeros(n_scenarios, dtype=bool)
+        # nothing is known before the first runs
+        self.probability = np.full(n_scenarios, 0.5)
+        self.classifier = None
+        self.log = []
+
+    def update(self, index, outcomes):
+        """Add the model results of scenarios of the pool and refit the classifier
+
+        Parameters
+        ----------
+        index : array-like
+                positions in the pool of the scenarios that were run
+        outcomes : dict
+                   outcome name to an array with a value per scenario, in
+                   the order of the index
+
+        """
+        index = np.asarray(index)
+        unacceptable = np.zeros(len(index), dtype=bool)
+        for name, threshold in self.thresholds.items():
+            unacceptable |= np.asarray(outcomes[name]) >= threshold
+        self.evaluated[index] = True
+        self.unacceptable[index] = unacceptable
+
+        labels = self.unacceptable[self.evaluated]
+        accuracy = np.nan
+        if labels.min() != labels.max():
+            self.classifier = RandomForestClassifier(n_estimators=100, min_samples_leaf=2, oob_score=True,
+                                                     random_state=self.seed)
+            self.classifier.fit(self.features[self.evaluated], labels)
+            self.probability = self.classifier.predict_proba(self.features)[:, 1]
+            accuracy = self.classifier.oob_score_
+        # without both kinds of outcomes there is no boundary to learn yet, so all other scenarios stay uncertain
+        self.probability[self.evaluated] = labels
+        self.unacceptable[~self.evaluated] = self.probability[~self.evaluated] >= 0.5
+
+        self.log.append({"runs": int(self.evaluated.sum()), "unacceptable runs": int(labels.sum()),
+                         "uncertain": int(self._uncertain().sum()), "oob accuracy": accuracy})
+
+    def _uncertain(self):
+        return ~self.evaluated & (np.minimum(self.probability, 1 - self.probability) > 1 - self.confidence)
+
+    def next_batch(self):
+        """Positions in the pool of the most uncertain scenarios that were not run, empty when sampling is done"""
+        candidates = np.flatnonzero(self._uncertain())
+        distance = np.abs(self.probability[candidates] - 0.5)
+        return candidates[np.argsort(distance, kind="stable")[:self.batch_size]]
+
+    def labels(self):
+        """Unacceptable outcome, its probability and whether the model was run, per scenario of the pool
+
+        Returns
+        -------
+        DataFrame
+
+        """
+        return pd.DataFrame({"unacceptable": self.unacceptable, "probability": self.probability,
+                             "evaluated": self.evaluated})
@@ -0,0 +1,177 @@
+"""
+Evaluators running all policies of a scenario as one batched DikeNetwork call.
+
+During optimization every generation evaluates its population against the
+same reference scenario. Instead of running the model once per experiment,
+the experiments are grouped per scenario and handed to
+DikeNetwork.run_policies, which simulates the whole group at once.
+
+The same holds for re-evaluating many policies on many scenarios: the
+work is ordered scenario-major, so the inputs that only depend on the
+scenario are prepared once per batch instead of once per experiment.
+"""
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from ema_workbench.em_framework.evaluators import BaseEvaluator
+from ema_workbench.em_framework.points import experiment_generator
+from ema_workbench.util import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+# models of a worker process of the SharedPoolEvaluator, by name
+_worker_models = {}
+
+
+def to_model_variables(point, parameters):
+    """Translate a scenario or policy to the variable names of the model"""
+    return {var: point[par.name] for par in parameters for var in par.variable_name}
+
+
+def evaluate_batch(model, experiments, num_events=None):
+    """Run experiments sharing a scenario in one batch, returns their outcomes
+
+    num_events: number of flood events to simulate, None for all
+    """
+    scenario = to_model_variables(experiments[0].scenario, model.uncertainties)
+    lever_matrix = pd.DataFrame(
+        [to_model_variables(experiment.policy, model.levers) for experiment in experiments]
+    )
+
+    outcomes = []
+    for output in model.function.run_policies(scenario, lever_matrix, num_events=num_events):
+        # process the output into outcomes like a model run does
+        model.outcomes_output = output
+        outcomes.append(dict(model.outcomes_output))
+    return outcomes
+
+
+def initialize_worker(models):
+    """Initializer of the worker processes of a shared pool"""
+    for model in models:
+        _worker_models[model.name] = model
+
+
+def evaluate_in_worker(model_name, experiments, num_events=None):
+    """Run a batch in a worker process, returns the outcomes and the time it took"""
+    start = time.perf_counter()
+    outcomes = evaluate_batch(_worker_models[model_name], experiments, num_events)
+    return outcomes, time.perf_counter() - start
+
+
+class PolicyBatchEvaluator(BaseEvaluator):
+    """Evaluator for experiments on a DikeNetwork, batched per scenario
+
+    Has the same perform_experiments and optimize interface as the
+    MultiprocessingEvaluator. The models should have a DikeNetwork as
+    function. The number of flood events they simulate can be lowered
+    with num_events for cheap, coarse evaluations, e.g. by a
+    FidelitySchedule. None simulates all events.
+
+    Parameters
+    ----------
+    msis : collection of models
+
+    """
+
+    def __init__(self, msis):
+        super().__init__(msis)
+        self.num_events = None
+
+    def initialize(self):
+        pass
+
+    def finalize(self):
+        pass
+
+    def _group_experiments(self, scenarios, policies, combine):
+        """Group the experiments per model and scenario"""
+        batches = defaultdict(list)
+        for experiment in experiment_generator(scenarios, self._msis, policies, combine=combine):
+            batches[(experiment.model_name, experiment.scenario.name)].append(experiment)
+
+        _logger.info(f"performing experiments in {len(batches)} batches")
+        return batches
+
+    def evaluate_experiments(self, scenarios, policies, callback, combine="factorial"):
+        models = {model.name: model for model in self._msis}
+
+        batches = self._group_experiments(scenarios, policies, combine)
+        for (model_name, _), experiments in batches.items():
+            outcomes = evaluate_batch(models[model_name], experiments, self.num_events)
+            for experiment, outcome in zip(experiments, outcomes):
+                callback(experiment, outcome)
+
+
+class SharedPoolEvaluator(PolicyBatchEvaluator):
+    """Batched evaluator submitting its work to a process pool shared with others
+
+    Several optimizations can run at the same time, each with its own
+    SharedPoolEvaluator, while their batches queue up in the same pool.
+    The pool should be created with initialize_worker and the models as
+    initializer. The pool is not shut down by the evaluator. The time the
+    workers spent on the batches of this evaluator is kept in busy_time.
+
+    Parameters
+    ----------
+    msis : collection of models
+    pool : concurrent.futures.ProcessPoolExecutor
+    chunksize : int, optional
+                maximum number of policies per submitted batch
+
+    """
+
+    def __init__(self, msis, pool, chunksize=25):
+        super().__init__(msis)
+        self.pool = pool
+        self.chunksize = chunksize
+        self.busy_time = 0.0
+
+    def evaluate_experiments(self, scenarios, policies, callback, combine="factorial"):
+        batches = self._group_experiments(scenarios, policies, combine)
+
+        # split the batches in chunks, so the work is spread over the workers
+        futures = []
+        for (model_name, _), experiments in batches.items():
+            for i in range(0, len(experiments), self.chunksize):
+                chunk = experiments[i : i + self.chunksize]
+                future = self.pool.submit(evaluate_in_worker, model_name, chunk, self.num_events)
+                futures.append((chunk, future))
+
+        for chunk, future in futures:
+            outcomes, busy_time = future.result()
+            self.busy_time += busy_time
+            for experiment, outcome in zip(chunk, outcomes):
+                callback(experiment, outcome)
+
+
+class MultiprocessingBatchEvaluator(SharedPoolEvaluator):
+    """Batched evaluator spreading the batches over a process pool of its own
+
+    Like the SharedPoolEvaluator, but the pool is created when the
+    evaluator is entered and shut down when it exits, like the
+    MultiprocessingEvaluator.
+
+    Parameters
+    ----------
+    msis : collection of models
+    n_processes : int, optional
+                  number of worker processes, defaults to the number of cpu's
+    chunksize : int, optional
+                maximum number of policies per submitted batch
+
+    """
+
+    def __init__(self, msis, n_processes=None, chunksize=25):
+        super().__init__(msis, None, chunksize=chunksize)
+        self.n_processes = n_processes
+
+    def initialize(self):
+        self.pool = ProcessPoolExecutor(self.n_processes, initializer=initialize_worker,
+                                        initargs=(self._msis,))
+
+    def finalize(self):
+        self.pool.shutdown()
+        self.pool = None
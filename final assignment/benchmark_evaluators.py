@@ -0,0 +1,53 @@
+import time
+import pandas as pd
+from ema_workbench import MultiprocessingEvaluator, Scenario, SequentialEvaluator, ema_logging
+from ema_workbench.em_framework.samplers import sample_uncertainties
+from our_problem_formulation import get_model_for_problem_formulation
+from thread_evaluator import ThreadPoolEvaluator
+
+
+# Function to time the experiments and a short optimization with a given evaluator
+def time_evaluator(evaluator_class, model, number_of_scenarios, number_of_policies, nfe, reference):
+    timings = {}
+    with evaluator_class(model) as evaluator:
+        start = time.time()
+        evaluator.perform_experiments(number_of_scenarios, policies=number_of_policies)
+        timings["perform_experiments [s]"] = time.time() - start
+
+        start = time.time()
+        evaluator.optimize(nfe=nfe, searchover="levers", epsilons=[1] * len(model.outcomes),
+                           reference=reference)
+        timings["optimize [s]"] = time.time() - start
+
+    return timings
+
+
+### Run script ###
+if __name__ == "__main__":
+
+    print("\nEvaluator benchmark is running...\n")
+
+    ema_logging.log_to_stderr(ema_logging.INFO)
+
+    # get model
+    model, steps = get_model_for_problem_formulation()
+
+    # benchmark size
+    number_of_scenarios = 20
+    number_of_policies = 2
+    nfe = 200
+    # optimize over a single sampled reference scenario
+    reference = Scenario("reference", **next(iter(sample_uncertainties(model, 1))))
+
+    evaluators = {"sequential": SequentialEvaluator,
+                  "multiprocessing": MultiprocessingEvaluator,
+                  "threads": ThreadPoolEvaluator}
+
+    benchmark = {}
+    for name, evaluator_class in evaluators.items():
+        benchmark[name] = time_evaluator(evaluator_class, model, number_of_scenarios,
+                                         number_of_policies, nfe, reference)
+        print(f"{name}: {benchmark[name]}")
+
+    print(f"\nTimings for {number_of_scenarios * number_of_policies} experiments and {nfe} NFEs:")
+    print(pd.DataFrame(benchmark).T)
@@ -0,0 +1,55 @@
+import time
+import numpy as np
+import pandas as pd
+from ema_workbench import MultiprocessingEvaluator, SequentialEvaluator, ema_logging
+from ema_workbench.em_framework.samplers import sample_levers, sample_uncertainties
+from our_problem_formulation import get_model_for_problem_formulation
+from batch_evaluator import MultiprocessingBatchEvaluator, PolicyBatchEvaluator
+
+
+# Function to time the re-evaluation of policies on scenarios with a given evaluator
+def time_reevaluation(evaluator_class, model, scenarios, policies):
+    with evaluator_class(model) as evaluator:
+        start = time.time()
+        experiments, outcomes = evaluator.perform_experiments(scenarios, policies=policies)
+        duration = time.time() - start
+
+    timings = {"time [s]": duration, "experiments/s": len(experiments) / duration}
+    return timings, pd.DataFrame(outcomes)
+
+
+### Run script ###
+if __name__ == "__main__":
+
+    print("\nRe-evaluation benchmark is running...\n")
+
+    ema_logging.log_to_stderr(ema_logging.INFO)
+
+    # get model
+    model, steps = get_model_for_problem_formulation()
+
+    # benchmark size, the default ordering runs the model once per experiment (policy x scenario)
+    number_of_scenarios = 10
+    number_of_policies = 20
+    scenarios = list(sample_uncertainties(model, number_of_scenarios))
+    policies = list(sample_levers(model, number_of_policies))
+
+    # scenario-major evaluators prepare the scenario inputs once and simulate all policies together
+    evaluators = {"sequential": SequentialEvaluator,
+                  "multiprocessing": MultiprocessingEvaluator,
+                  "batch (scenario-major)": PolicyBatchEvaluator,
+                  "batch multiprocessing (scenario-major)": MultiprocessingBatchEvaluator}
+
+    benchmark = {}
+    reference = None
+    for name, evaluator_class in evaluators.items():
+        benchmark[name], outcomes = time_reevaluation(evaluator_class, model, scenarios, policies)
+        # all evaluators should give the same outcomes
+        if reference is None:
+            reference = outcomes
+        benchmark[name]["same outcomes"] = np.allclose(outcomes.values, reference.values, equal_nan=True)
+        benchmark[name]["speedup"] = benchmark["sequential"]["time [s]"] / benchmark[name]["time [s]"]
+        print(f"{name}: {benchmark[name]}")
+
+    print(f"\nTimings for {number_of_scenarios} scenarios x {number_of_policies} policies:")
+    print(pd.DataFrame(benchmark).T.to_string())
@@ -0,0 +1,87 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from ema_workbench import Scenario, ema_logging
+from ema_workbench.em_framework.optimization import AbstractConvergenceMetric
+from ema_workbench.em_framework.samplers import sample_uncertainties
+from our_problem_formulation import get_model_for_problem_formulation
+from batch_evaluator import SharedPoolEvaluator, initialize_worker
+from convergence_metrics import MonteCarloHypervolume
+from optimization_runner import optimize, optimize_steady_state
+
+
+class ArchiveTrace(AbstractConvergenceMetric):
+    """Records the wall clock time, nfe and objectives of the archive"""
+
+    def __init__(self):
+        super().__init__("archive_trace")
+        self.start = time.time()
+
+    def __call__(self, optimizer):
+        self.results.append((time.time() - self.start, optimizer.nfe,
+                             [solution.objectives[:] for solution in optimizer.result]))
+
+    def get_results(self):
+        return None
+
+
+# Function to time an optimization run, returns its final results and its archive trace
+def time_run(optimize_function, model, pool, chunksize, nfe, epsilons, reference, **kwargs):
+    evaluator = SharedPoolEvaluator(model, pool, chunksize=chunksize)
+    trace = ArchiveTrace()
+    start = time.time()
+    results, _ = optimize_function(model, evaluator, nfe, epsilons, reference=reference,
+                                   convergence=[trace], convergence_freq=100, **kwargs)
+    wall_time = time.time() - start
+
+    timings = {"wall time [s]": wall_time,
+               "worker utilization": evaluator.busy_time / (pool._max_workers * wall_time),
+               "solutions": len(results)}
+    return results, trace.results, timings
+
+
+### Run script ###
+if __name__ == "__main__":
+
+    print("\nSteady-state benchmark is running...\n")
+
+    ema_logging.log_to_stderr(ema_logging.INFO)
+
+    # get model
+    model, steps = get_model_for_problem_formulation()
+
+    # benchmark size
+    n_workers = os.cpu_count()
+    nfe = 2000
+    population_size = 100
+    batch_size = 10
+    epsilons = [5e7, 5e7, 1] * 5 + [5e8, 5e8]
+    # optimize over a single sampled reference scenario
+    reference = Scenario("reference", **next(iter(sample_uncertainties(model, 1))))
+
+    benchmark, results, traces = {}, {}, {}
+    with ProcessPoolExecutor(n_workers, initializer=initialize_worker, initargs=([model],)) as pool:
+        # a generation is split evenly over the workers
+        results["generational"], traces["generational"], benchmark["generational"] = time_run(
+            optimize, model, pool, math.ceil(population_size / n_workers), nfe, epsilons, reference,
+            population_size=population_size)
+        results["steady state"], traces["steady state"], benchmark["steady state"] = time_run(
+            optimize_steady_state, model, pool, batch_size, nfe, epsilons, reference,
+            population_size=population_size, n_workers=n_workers, batch_size=batch_size)
+
+    # time until each run reached 95% of the hypervolume both runs reached
+    outcome_names = [outcome.name for outcome in model.outcomes]
+    hv = MonteCarloHypervolume.from_reference_sets(list(results.values()), outcome_names)
+    hypervolumes = {name: [(t, n, hv.calculate(points)[0]) for t, n, points in trace]
+                    for name, trace in traces.items()}
+    target = 0.95 * min(hypervolumes[name][-1][2] for name in hypervolumes)
+    for name, hypervolume in hypervolumes.items():
+        reached = [(t, n) for t, n, value in hypervolume if value >= target]
+        benchmark[name]["hypervolume"] = hypervolume[-1][2]
+        benchmark[name]["time to target [s]"] = reached[0][0] if reached else float("nan")
+        benchmark[name]["nfe to target"] = reached[0][1] if reached else float("nan")
+
+    print(f"\nTimings for {nfe} NFEs on {n_workers} workers (target hypervolume {target:.3f}):")
+    print(pd.DataFrame(benchmark).T.to_string())
@@ -0,0 +1,162 @@
+"""
+Parallel coordinates plots for thousands of policies.
+
+The ParallelAxes of the workbench adds a matplotlib line per row and axis,
+so a plot of many policies is slow to draw and needs a legend entry per
+policy to tell them apart. BulkParallelAxes draws all rows that are
+plotted together as one LineCollection per axis, so a group of policies
+with the same colour is a single artist. For very large sets, the lines
+can be aggregated into a density image instead.
+"""
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LogNorm
+from ema_workbench.analysis.parcoords import ParallelAxes
+
+
+class BulkParallelAxes(ParallelAxes):
+    """ParallelAxes that draws many lines at once
+
+    plot draws all rows of the data as one LineCollection per axis. When no
+    alpha is given, it decreases with the number of rows, so overlapping
+    lines show where they are dense. Axes should be inverted before
+    plot_density is called, as the density images are not flipped
+    afterwards.
+
+    """
+
+    # number of overlapping lines that add up to an opaque line when no alpha is given
+    opaque_lines = 100
+
+    def _normalize(self, data):
+        """Recoded and normalized data in the order of the axes, as an array"""
+        data = data[self.axis_labels].copy()
+        for key, value in self.recoding.items():
+            data[key] = data[key].astype(value).cat.codes
+        normalized = self._normalizer.transform(data)
+        for column in self.flipped_axes:
+            index = self.axis_labels.index(column)
+            normalized[:, index] = 1 - normalized[:, index]
+        return normalized
+
+    def _plot(self, data, **kwargs):
+        """Plot all rows of the normalized data as a LineCollection per axis"""
+        values = data.values
+        kwargs.setdefault("alpha", min(1.0, self.opaque_lines / max(len(values), 1)))
+        kwargs.setdefault("lw", 1)
+
+        for j, ax in enumerate(self.axes):
+            segments = np.empty((len(values), 2, 2))
+            segments[:, :, 0] = [j + 1, j + 2]
+            segments[:, :, 1] = values[:, j:j + 2]
+            # the data is normalized but not flipped yet
+            for index, label in enumerate(self.axis_labels[j:j + 2]):
+                if label in self.flipped_axes:
+                    segments[:, index, 1] = 1 - segments[:, index, 1]
+            ax.add_collection(LineCollection(segments, **kwargs))
+
+    def _update_plot_data(self, ax, index, lines=None):
+        """Flip the lines and line collections of an axis on one of its sides"""
+        super()._update_plot_data(ax, index, lines=lines)
+        if lines is None:
+            for collection in ax.collections:
+                segments = collection.get_segments()
+                for segment in segments:
+                    segment[index, 1] = 1 - segment[index, 1]
+                collection.set_segments(segments)
+
+    def plot_groups(self, data, groups, colors=None, **kwargs):
+        """Plot the rows of the data in a colour per group, with a line collection per group and axis
+
+        Parameters
+        ----------
+        data : DataFrame
+        groups : array-like
+                 group of each row, the groups are labelled in the legend
+        colors : list, optional
+                 a colour per group, in order of appearance of the groups,
+                 a hsv colour map by default
+
+        Returns
+        -------
+        list of legend handles, one per group
+
+        """
+        codes, labels = pd.factorize(np.asarray(groups))
+        if colors is None:
+            colors = plt.get_cmap("hsv")(np.linspace(0, 1.0, len(labels) + 1))
+
+        handles = []
+        for code, (label, color) in enumerate(zip(labels, colors)):
+            self.plot(data[codes == code], color=color, label=str(label), **kwargs)
+            handles.append(plt.Line2D([0, 1], [0, 1], color=color, label=str(label)))
+        return handles
+
+    def plot_density(self, data, resolution=(50, 200), cmap="Greys", chunksize=10000):
+        """Plot the density of the lines of the rows as an image per axis
+
+        Parameters
+        ----------
+        data : DataFrame
+        resolution : tuple of int, optional
+                     number of pixels across and along the height of an axis
+        cmap : str, optional
+        chunksize : int, optional
+                    number of rows rasterized at a time
+
+        """
+        normalized = self._normalize(data)
+        nx, ny = resolution
+        edges = np.linspace(0, 1, nx + 1)
+        columns = np.arange(nx)
+
+        densities = []
+        for j in range(len(self.axes)):
+            # a line covers the pixel rows between its heights at the edges of a pixel column, which
+            # are counted as +1 at the first and -1 after the last row, and summed along the column
+            changes = np.zeros((ny + 1) * nx, dtype=np.int64)
+            for start in range(0, len(normalized), chunksize):
+                chunk = normalized[start:start + chunksize, j:j + 2]
+                y = chunk[:, :1] + (chunk[:, 1:] - chunk[:, :1]) * edges
+                rows = np.clip((y * ny).astype(np.int64), 0, ny - 1)
+                first = np.minimum(rows[:, :-1], rows[:, 1:])
+                last = np.maximum(rows[:, :-1], rows[:, 1:])
+                changes += np.bincount((first * nx + columns).ravel(), minlength=(ny + 1) * nx)
+                changes -= np.bincount(((last + 1) * nx + columns).ravel(), minlength=(ny + 1) * nx)
+            densities.append(np.cumsum(changes.reshape(ny + 1, nx), axis=0)[:ny])
+
+        # all axes share the colour scale
+        norm = LogNorm(vmin=1, vmax=max(1, max(density.max() for density in densities)))
+        for j, (ax, density) in enumerate(zip(self.axes, densities)):
+            # imshow sets the limits to the image, which would cut off the tick labels
+            xlim, ylim = ax.get_xlim(), ax.get_ylim()
+            ax.imshow(np.ma.masked_equal(density, 0), extent=(j + 1, j + 2, 0, 1), origin="lower",
+                      aspect="auto", interpolation="nearest", cmap=cmap, norm=norm)
+            ax.set_xlim(xlim)
+            ax.set_ylim(ylim)
+
+
+def export_figure(fig, file_paths, show=False, **kwargs):
+    """Save a figure to one or more files, in the formats of their extensions
+
+    Parameters
+    ----------
+    fig : Figure
+    file_paths : str or list of str
+                 for instance a png and an svg file
+    show : bool, optional
+           show the figure after saving it, otherwise it is closed, so
+           batch jobs do not block on plt.show
+    kwargs : passed to savefig
+
+    """
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    for file_path in file_paths:
+        fig.savefig(file_path, **kwargs)
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
@@ -0,0 +1,322 @@
+"""
+Convergence metrics for the optimizations of the multi-MORDM scripts.
+
+These follow the AbstractConvergenceMetric interface of the workbench and
+are passed to evaluator.optimize in the convergence list.
+"""
+import os
+import tarfile
+
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from ema_workbench.em_framework.optimization import AbstractConvergenceMetric, to_dataframe
+from scipy.stats import norm, qmc
+
+from results_store import append_npy, truncate_npy
+
+
+class ColumnarArchiveLogger(AbstractConvergenceMetric):
+    """Logs the archive at each iteration to a single npy file
+
+    The snapshots are appended to one structured array with an nfe column
+    and a typed column per lever and outcome, so no snapshot has to be
+    compressed or parsed again. The file can be memory-mapped with
+    load_array or numpy.load(filename, mmap_mode="r"). Snapshots of an
+    empty archive have no rows, so they are not stored.
+
+    A resumed run drops the snapshots its interrupted run logged after the
+    checkpoint as soon as the checkpoint is loaded (see resume_from), a new
+    run, or a run that finds no checkpoint to resume from, starts with an
+    empty file.
+
+    Parameters
+    ----------
+    directory : str
+    decision_varnames : list of str
+    outcome_varnames : list of str
+    base_filename : str, optional
+    resume : bool, optional
+    """
+
+    def __init__(self, directory, decision_varnames, outcome_varnames,
+                 base_filename="archives.npy", resume=False):
+        super().__init__("archive_logger")
+
+        self.decision_varnames = decision_varnames
+        self.outcome_varnames = outcome_varnames
+        self.filename = os.path.join(os.path.abspath(directory), base_filename)
+        self.resume = resume and os.path.exists(self.filename)
+
+        if not self.resume and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def __call__(self, optimizer):
+        archive = to_dataframe(optimizer.result, self.decision_varnames, self.outcome_varnames)
+
+        # the run did not resume from a checkpoint, so it starts over
+        if self.resume:
+            self._truncate(0)
+            self.resume = False
+
+        self.append(optimizer.nfe, archive)
+
+    def resume_from(self, nfe):
+        """Drop the snapshots logged after the checkpoint at nfe, called when the run resumes from it
+
+        The workbench evaluators call the convergence metrics before they
+        evaluate a generation, so the snapshot at the nfe of the checkpoint
+        itself is logged after the checkpoint is saved, and is dropped too.
+
+        Parameters
+        ----------
+        nfe : int
+
+        """
+        if self.resume:
+            self._truncate(nfe)
+            self.resume = False
+
+    def append(self, nfe, archive):
+        """Append a snapshot of the archive
+
+        Parameters
+        ----------
+        nfe : int
+        archive : DataFrame
+                  with a column per lever and outcome
+
+        """
+        if archive.empty:
+            return
+
+        if os.path.exists(self.filename):
+            dtype = self.load_array(self.filename).dtype
+        else:
+            # integer levers keep their type, the rest is stored as float
+            columns = [("nfe", np.int64)]
+            for name in self.decision_varnames:
+                is_integer = name in archive and pd.api.types.is_integer_dtype(archive[name])
+                columns.append((name, np.int64 if is_integer else np.float64))
+            columns += [(name, np.float64) for name in self.outcome_varnames]
+            dtype = np.dtype(columns)
+
+        snapshot = np.zeros(len(archive), dtype=dtype)
+        snapshot["nfe"] = nfe
+        for name in dtype.names[1:]:
+            snapshot[name] = archive[name].to_numpy()
+        append_npy(self.filename, snapshot)
+
+    def _truncate(self, nfe):
+        """Drop the snapshots from nfe onwards"""
+        array = self.load_array(self.filename)
+        rows = int(np.searchsorted(array["nfe"], nfe, side="left"))
+        del array
+        truncate_npy(self.filename, rows)
+
+    def get_results(self):
+        return None
+
+    @classmethod
+    def load_array(cls, filename):
+        """Memory-map the logged archives
+
+        Parameters
+        ----------
+        filename : str
+
+        Returns
+        -------
+        structured numpy memmap with an nfe column and a column per lever
+        and outcome, sorted on nfe
+        """
+        return np.load(os.path.abspath(filename), mmap_mode="r")
+
+    @classmethod
+    def load_archives(cls, filename, nfes=None):
+        """Load the logged archives like ArchiveLogger.load_archives
+
+        Parameters
+        ----------
+        filename : str
+        nfes : list of int, optional
+               only load the snapshots at these nfe
+
+        Returns
+        -------
+        dict with nfe as key and dataframe as value
+        """
+        array = cls.load_array(filename)
+        logged_nfes, starts = np.unique(array["nfe"], return_index=True)
+        ends = np.append(starts[1:], len(array))
+
+        columns = list(array.dtype.names[1:])
+        archives = {}
+        for nfe, start, end in zip(logged_nfes, starts, ends):
+            if nfes is not None and nfe not in nfes:
+                continue
+            archives[int(nfe)] = pd.DataFrame(
+                {name: np.asarray(array[name][start:end]) for name in columns}
+            )
+        return archives
+
+    @classmethod
+    def convert(cls, tar_filename, filename, decision_varnames, outcome_varnames):
+        """Convert the tar.gz archives of an ArchiveLogger to a npy file
+
+        Parameters
+        ----------
+        tar_filename : str
+        filename : str
+                   npy file to write to, overwritten if it exists
+        decision_varnames : list of str
+        outcome_varnames : list of str
+        """
+        archives = {}
+        with tarfile.open(os.path.abspath(tar_filename)) as fh:
+            for entry in fh.getmembers():
+                if entry.name.endswith("csv"):
+                    nfe = int(os.path.basename(entry.name)[:-4])
+                    archives[nfe] = pd.read_csv(fh.extractfile(entry))
+
+        directory, base_filename = os.path.split(os.path.abspath(filename))
+        logger = cls(directory, decision_varnames, outcome_varnames, base_filename=base_filename)
+        for nfe in sorted(archives):
+            logger.append(nfe, archives[nfe])
+
+
+class MonteCarloHypervolume:
+    """Monte Carlo estimate of the hypervolume of minimized objectives
+
+    The objectives are normalized with the given bounds, after which the
+    hypervolume is the fraction of a fixed set of quasi-random (scrambled
+    Sobol) samples in the unit cube that is dominated by at least one
+    point. Unlike the exact hypervolume, the costs grow linearly with the
+    number of objectives. Because the samples are fixed, estimates of
+    different archives are comparable and successive archives can be
+    updated incrementally: update only processes the points that entered
+    or left the archive since the previous call.
+
+    Parameters
+    ----------
+    minimum : list of float
+              ideal point, normalized to 0
+    maximum : list of float
+              reference point, normalized to 1
+    n_samples : int, optional
+                number of samples, rounded up to a power of 2
+    confidence : float, optional
+                 confidence level of the interval
+    seed : int, optional
+
+    """
+
+    def __init__(self, minimum, maximum, n_samples=2**16, confidence=0.95, seed=0):
+        self.minimum = np.asarray(minimum, dtype=float)
+        self.maximum = np.asarray(maximum, dtype=float)
+        extent = self.maximum - self.minimum
+        self.extent = np.where(extent > 0, extent, 1)
+        self.z = norm.ppf(0.5 + confidence / 2)
+
+        sampler = qmc.Sobol(len(self.minimum), scramble=True, seed=seed)
+        self.samples = sampler.random_base2(int(np.ceil(np.log2(n_samples))))
+        self.reset()
+
+    @classmethod
+    def from_reference_sets(cls, reference_sets, outcome_names, **kwargs):
+        """Create an estimator with the bounds of the outcomes over reference sets
+
+        Parameters
+        ----------
+        reference_sets : list of DataFrame
+        outcome_names : list of str
+        kwargs : any additional arguments are passed on to the estimator
+
+        """
+        outcomes = pd.concat([reference_set[outcome_names] for reference_set in reference_sets])
+        return cls(outcomes.min().values, outcomes.max().values, **kwargs)
+
+    def reset(self):
+        """Forget the points of the previous update"""
+        self._points = Counter()
+        self._counts = np.zeros(len(self.samples), dtype=np.int64)
+
+    def _dominated(self, points):
+        """Number of the points dominating each sample"""
+        counts = np.zeros(len(self.samples), dtype=np.int64)
+        points = np.asarray(points, dtype=float).reshape(-1, len(self.minimum))
+        for point in (points - self.minimum) / self.extent:
+            counts += np.all(point <= self.samples, axis=1)
+        return counts
+
+    def _estimate(self, counts):
+        fraction = np.count_nonzero(counts) / len(self.samples)
+        half_width = self.z * np.sqrt(fraction * (1 - fraction) / len(self.samples))
+        return fraction, half_width
+
+    def calculate(self, points):
+        """Estimate the hypervolume of points
+
+        Parameters
+        ----------
+        points : 2D array-like
+                 a row of objectives per point
+
+        Returns
+        -------
+        tuple with the estimate and the half width of its confidence interval
+
+        """
+        return self._estimate(self._dominated(points))
+
+    def update(self, points):
+        """Estimate the hypervolume of points, reusing the previous update
+
+        Parameters
+        ----------
+        points : 2D array-like
+                 a row of objectives per point
+
+        Returns
+        -------
+        tuple with the estimate and the half width of its confidence interval
+
+        """
+        points = Counter(map(tuple, np.asarray(points, dtype=float).reshape(-1, len(self.minimum))))
+        added = list((points - self._points).elements())
+        removed = list((self._points - points).elements())
+
+        if added:
+            self._counts += self._dominated(added)
+        if removed:
+            self._counts -= self._dominated(removed)
+        self._points = points
+
+        return self._estimate(self._counts)
+
+    def __call__(self, archive):
+        """Estimate the hypervolume of a platypus archive, e.g. for EarlyStopping"""
+        return self.update([solution.objectives[:] for solution in archive])[0]
+
+
+class RunProgress(AbstractConvergenceMetric):
+    """Reports the number of function evaluations of a run in a shared dict
+
+    Nothing is added to the convergence results.
+
+    Parameters
+    ----------
+    label : str
+            name of the run
+    progress : dict
+               run label to number of function evaluations
+    """
+
+    def __init__(self, label, progress):
+        super().__init__("run_progress")
+        self.label = label
+        self.progress = progress
+
+    def __call__(self, optimizer):
+        self.progress[self.label] = optimizer.nfe
@@ -11,10 +11,15 @@ from collections import defaultdict
 from ema_workbench import ema_logging
 
 import funs_generate_network
-from funs_dikes import Lookuplin, dikefailure, init_node
+from funs_dikes import Lookuplin, dikefailure, dikefailure_batch, init_node
 from funs_economy import cost_fun, discount, cost_evacuation
 from funs_hydrostat import werklijn_cdf, werklijn_inv
 
+# Risk outcomes of over-budget policies, which are not simulated. Finite,
+# so the epsilon boxes of platypus (floor(value / epsilon)) can still be
+# computed when two infeasible policies are compared on their objectives
+REJECTED_RISK = 1e20
+
 
 def Muskingum(C1, C2, C3, Qn0_t1, Qn0_t0, Qn1_t0):
     """Simulates hydrological routing"""
@@ -64,6 +69,20 @@ class DikeNetwork:
         # Time step correction: Q is a mean daily value expressed in m3/s
         self.timestepcorr = 24 * 60 * 60
 
+        # Maximum total investment costs (dikes and RfR) [euro], policies
+        # above it are not simulated. None means no budget
+        self.budget = None
+
+        # Dikes for which the flood wave is routed, a prefix of dikelist
+        # (see limit_to_outcomes)
+        self.simulated_dikes = dike_list
+
+        # Costs and water level reductions of every Room for the River
+        # portfolio, indexed by [planning step, bitmask of projects]:
+        self.rfr_costs, self.rfr_offsets = self._build_rfr_portfolios(
+            G, dike_list, planning_steps
+        )
+
     #        ema_logging.info('model initialized')
 
     # Initialize hydrology at each node:
@@ -76,22 +95,74 @@ class DikeNetwork:
         node["tbreach"] = np.nan
         return node
 
+    def _build_rfr_portfolios(self, G, dikenodes, steps):
+        """Precompute costs and water level reductions of all RfR portfolios
+
+        With five binary projects per planning step there are only 2**5
+        portfolios. Bit p of a portfolio index is set when project p is
+        implemented.
+        """
+        projects = [key for key in G.nodes[f"RfR_projects {steps[0]}"] if key != "type"]
+        n_portfolios = 2 ** len(projects)
+
+        costs = np.zeros((len(steps), n_portfolios))
+        offsets = np.zeros((len(steps), n_portfolios, len(dikenodes)))
+        for s in steps:
+            proj_node = G.nodes[f"RfR_projects {s}"]
+            for portfolio in range(n_portfolios):
+                for project in projects:
+                    if not portfolio & (1 << int(project)):
+                        continue
+                    # Cost of RfR project
+                    costs[s, portfolio] += proj_node[project]["costs_1e6"] * 1e6
+
+                    # Change in rating curve of the locations affected by the project
+                    for i, dike in enumerate(dikenodes):
+                        offsets[s, portfolio, i] += proj_node[project].get(dike, 0)
+        return costs, offsets
+
     def _initialize_rfr_ooi(self, G, dikenodes, steps):
         for s in steps:
             for n in dikenodes:
                 node = G.nodes[n]
-                # Create a copy of the rating curve that will be used in the sim:
-                node["rnew"] = copy.deepcopy(node["r"])
-
                 # Initialize outcomes of interest (ooi):
                 node[f"losses {s}"] = []
                 node[f"deaths {s}"] = []
                 node[f"evacuation_costs {s}"] = []
+        return G
+
+    def _apply_rfr_portfolios(self, G, dikenodes, steps, portfolios):
+        """Look up costs and rating curve reductions of the chosen portfolios"""
+        for s in steps:
+            G.nodes[f"RfR_projects {s}"]["cost"] = self.rfr_costs[s, portfolios[s]]
 
-            # Initialize room for the river
-            G.nodes[f"RfR_projects {s}"]["cost"] = 0
+        # Projects of every planning step lower the same rating curve:
+        offsets = np.sum([self.rfr_offsets[s, portfolios[s]] for s in steps], axis=0)
+        for dike, offset in zip(dikenodes, offsets):
+            G.nodes[dike]["rfr_offset"] = offset
         return G
 
+    def _dike_investment_costs(self, node, increases):
+        """Dike heightening costs per planning step, increases in meters"""
+        costs = []
+        dikeh_cum = 0
+        for increase in increases:
+            dikeh_cum += increase
+            if increase == 0:
+                costs.append(0)
+            else:
+                costs.append(
+                    cost_fun(
+                        node["traj_ratio"],
+                        node["c"],
+                        node["b"],
+                        node["lambda"],
+                        dikeh_cum,
+                        increase,
+                    )
+                )
+        return costs
+
     def progressive_height_and_costs(self, G, dikenodes, steps):
         for dike in dikenodes:
             node = G.nodes[dike]
@@ -109,24 +180,112 @@ class DikeNetwork:
                     node[f"fnew {s}"][:, 0] += node[f"DikeIncrease {ss}"]
                     node[f"dikeh_cum {s}"] += node[f"DikeIncrease {ss}"]
 
-                # Calculate dike heigheting costs:
-                if node[f"DikeIncrease {s}"] == 0:
-                    node[f"dikecosts {s}"] = 0
-                else:
-                    node[f"dikecosts {s}"] = cost_fun(
-                        node["traj_ratio"],
-                        node["c"],
-                        node["b"],
-                        node["lambda"],
-                        node[f"dikeh_cum {s}"],
-                        node[f"DikeIncrease {s}"],
-                    )
+            # Calculate dike heigheting costs:
+            costs = self._dike_investment_costs(
+                node, [node[f"DikeIncrease {s}"] for s in steps]
+            )
+            for s in steps:
+                node[f"dikecosts {s}"] = costs[s]
+
+    def _rfr_portfolios(self, kwargs):
+        """Bitmask of the RfR projects implemented in each planning step"""
+        portfolios = np.zeros(len(self.planning_steps), dtype=int)
+        for item in kwargs:
+            if "RfR" in item:
+                # item: {projectID}_RfR {step}
+                # Note: kwargs[item] in this case can be either 0
+                # (no project) or 1 (yes project)
+                project, rfr_step = item.split("_")
+                temporal_step = int(rfr_step.split(" ")[1])
+                portfolios[temporal_step] |= int(kwargs[item]) << int(project)
+        return portfolios
+
+    def evaluate_costs(self, **kwargs):
+        """Evaluate the investment costs of a policy without simulating floods
+
+        Dike investment costs and RfR costs only depend on the levers, so
+        they are computed without copying the network or running the event
+        loop. Uncertainties in kwargs are ignored. Returns the cost outcomes
+        in the same layout as a full model run.
+        """
+        portfolios = self._rfr_portfolios(kwargs)
+
+        dikecosts = {}
+        for dike in self.dikelist:
+            increases = [
+                kwargs[f"{dike}_DikeIncrease {s}"] * self.dh
+                for s in self.planning_steps
+            ]
+            dikecosts[dike] = self._dike_investment_costs(self.G.nodes[dike], increases)
+
+        data = defaultdict(list)
+        for s in self.planning_steps:
+            for dike in self.dikelist:
+                data[f"{dike}_Dike Investment Costs"].append(dikecosts[dike][s])
+            data["RfR Total Costs"].append(self.rfr_costs[s, portfolios[s]])
+        return data
+
+    def _over_budget(self, costs):
+        """Check whether the total investment costs exceed the budget"""
+        if self.budget is None:
+            return False
+        return sum(sum(values) for values in costs.values()) > self.budget
+
+    def _rejected_outcomes(self, costs):
+        """Outcomes of an over-budget policy: costs, and the rejected risks"""
+        data = defaultdict(list)
+        for s in self.planning_steps:
+            for dike in self.dikelist:
+                data[f"{dike}_Expected Annual Damage"].append(REJECTED_RISK)
+                data[f"{dike}_Expected Number of Deaths"].append(REJECTED_RISK)
+                data[f"{dike}_Dike Investment Costs"].append(
+                    costs[f"{dike}_Dike Investment Costs"][s]
+                )
+
+            data[f"RfR Total Costs"].append(costs["RfR Total Costs"][s])
+            data[f"Expected Evacuation Costs"].append(REJECTED_RISK)
+        return data
+
+    def limit_to_outcomes(self, variable_names):
+        """Only route the flood wave up to the last dike needed for the outcomes
+
+        Breaches only reduce the discharge further downstream, so dikes
+        downstream never affect the ones upstream. Risk outcomes of dikes
+        that are not simulated are nan, as are the evacuation costs when
+        not all dikes are simulated.
+
+        variable_names: model outputs that are needed, e.g. the variable
+        names of the model outcomes
+        """
+        last = 0
+        for name in variable_names:
+            # Evacuation costs are summed over all dikes:
+            if name == "Expected Evacuation Costs":
+                last = len(self.dikelist)
+
+            for i, dike in enumerate(self.dikelist):
+                if name in (
+                    f"{dike}_Expected Annual Damage",
+                    f"{dike}_Expected Number of Deaths",
+                ):
+                    last = max(last, i + 1)
+
+        self.simulated_dikes = self.dikelist[:last]
+        return self.simulated_dikes
 
     def __call__(self, timestep=1, **kwargs):
 
+        # Over-budget policies are rejected on their costs alone, before
+        # the network is copied and the event loop runs:
+        if self.budget is not None:
+            costs = self.evaluate_costs(**kwargs)
+            if self._over_budget(costs):
+                return self._rejected_outcomes(costs)
+
         G = copy.deepcopy(self.G)
         Qpeaks = self.Qpeaks
         dikelist = self.dikelist
+        simulated_dikes = self.simulated_dikes
 
         # Call RfR initialization:
         self._initialize_rfr_ooi(G, dikelist, self.planning_steps)
@@ -140,31 +299,14 @@ class DikeNetwork:
             else:
                 string1, string2 = item.split("_")
 
-                if "RfR" in string2:
-                    # string1: projectID
-                    # string2: rfr #step
-                    # Note: kwargs[item] in this case can be either 0
-                    # (no project) or 1 (yes project)
-                    temporal_step = string2.split(" ")[1]
-
-                    proj_node = G.nodes[f"RfR_projects {temporal_step}"]
-                    # Cost of RfR project
-                    proj_node["cost"] += (
-                        kwargs[item] * proj_node[string1]["costs_1e6"] * 1e6
-                    )
-
-                    # Iterate over the location affected by the project
-                    for key in proj_node[string1].keys():
-                        if key != "costs_1e6":
-                            # Change in rating curve due to the RfR project
-                            G.nodes[key]["rnew"][:, 1] -= (
-                                kwargs[item] * proj_node[string1][key]
-                            )
-                else:
+                # RfR projects are looked up per portfolio below
+                if "RfR" not in string2:
                     # string1: dikename or EWS
                     # string2: name of uncertainty or lever
                     G.nodes[string1][string2] = kwargs[item]
 
+        rfr_portfolios = self._rfr_portfolios(kwargs)
+        self._apply_rfr_portfolios(G, dikelist, self.planning_steps, rfr_portfolios)
         self.progressive_height_and_costs(G, dikelist, self.planning_steps)
 
         # Percentage of people who can be evacuated for a given warning
@@ -187,7 +329,7 @@ class DikeNetwork:
                 node["Qout"] = Qpeak * node["Qevents_shape"].loc[waveshape_id]
 
                 # Initialize hydrological event:
-                for key in dikelist:
+                for key in simulated_dikes:
                     node = G.nodes[key]
 
                     Q_0 = int(G.nodes["A.0"]["Qout"][0])
@@ -201,9 +343,9 @@ class DikeNetwork:
                 # Run over the discharge wave:
                 for t in range(1, len(time)):
                     # Run over each node of the branch:
-                    for n in range(0, len(dikelist)):
+                    for n in range(0, len(simulated_dikes)):
                         # Select current node:
-                        node = G.nodes[dikelist[n]]
+                        node = G.nodes[simulated_dikes[n]]
                         if node["type"] == "dike":
 
                             # Muskingum parameters:
@@ -223,8 +365,9 @@ class DikeNetwork:
                             )
 
                             # Transform Q in water levels:
-                            node["wl"][t] = Lookuplin(
-                                node["rnew"], 0, 1, node["Qin"][t]
+                            node["wl"][t] = (
+                                Lookuplin(node["r"], 0, 1, node["Qin"][t])
+                                - node["rfr_offset"]
                             )
 
                             # Evaluate failure and, in case, Q in the floodplain and
@@ -258,11 +401,11 @@ class DikeNetwork:
                             node["hbas"][t] = node["cumVol"][t] / float(Area)
 
                         elif node["type"] == "downstream":
-                            node["Qin"] = G.nodes[dikelist[n - 1]]["Qout"]
+                            node["Qin"] = G.nodes[simulated_dikes[n - 1]]["Qout"]
 
                 # Iterate over the network and store outcomes of interest for a
                 # given event
-                for dike in self.dikelist:
+                for dike in simulated_dikes:
                     node = G.nodes[dike]
 
                     # If breaches occured:
@@ -294,27 +437,288 @@ class DikeNetwork:
             for dike in dikelist:
                 node = G.nodes[dike]
 
-                # Expected Annual Damage:
-                EAD = np.trapz(node[f"losses {s}"], self.p_exc)
-                # Discounted annual risk per dike ring:
-                disc_EAD = np.sum(
-                    discount(
-                        EAD, rate=G.nodes[f"discount rate {s}"]["value"], n=self.y_step
+                # Dikes downstream of the simulated ones have no risk outcomes:
+                if dike not in simulated_dikes:
+                    disc_EAD, END = np.nan, np.nan
+                else:
+                    # Expected Annual Damage:
+                    EAD = np.trapz(node[f"losses {s}"], self.p_exc)
+                    # Discounted annual risk per dike ring:
+                    disc_EAD = np.sum(
+                        discount(
+                            EAD,
+                            rate=G.nodes[f"discount rate {s}"]["value"],
+                            n=self.y_step,
+                        )
                     )
-                )
 
-                # Expected Annual number of deaths:
-                END = np.trapz(node[f"deaths {s}"], self.p_exc)
+                    # Expected Annual number of deaths:
+                    END = np.trapz(node[f"deaths {s}"], self.p_exc)
 
-                # Expected Evacuation costs: depend on the event, the higher
-                # the event, the more people you have got to evacuate:
-                EECosts.append(np.trapz(node[f"evacuation_costs {s}"], self.p_exc))
+                    # Expected Evacuation costs: depend on the event, the higher
+                    # the event, the more people you have got to evacuate:
+                    EECosts.append(np.trapz(node[f"evacuation_costs {s}"], self.p_exc))
 
                 data[f"{dike}_Expected Annual Damage"].append(disc_EAD)
                 data[f"{dike}_Expected Number of Deaths"].append(END)
                 data[f"{dike}_Dike Investment Costs"].append(node[f"dikecosts {s}"])
 
             data[f"RfR Total Costs"].append(G.nodes[f"RfR_projects {s}"]["cost"])
-            data[f"Expected Evacuation Costs"].append(np.sum(EECosts))
+            if len(simulated_dikes) < len(dikelist):
+                data[f"Expected Evacuation Costs"].append(np.nan)
+            else:
+                data[f"Expected Evacuation Costs"].append(np.sum(EECosts))
 
         return data
+
+    def _event_selection(self, num_events=None):
+        """Indices of num_events flood events, evenly spread over all events
+
+        The largest and smallest events are always included, so the
+        integration over the exceedance probabilities keeps its range.
+        None selects all events.
+        """
+        if num_events is None or num_events >= len(self.Qpeaks):
+            return np.arange(len(self.Qpeaks))
+        return np.unique(
+            np.round(np.linspace(0, len(self.Qpeaks) - 1, max(num_events, 2))).astype(int)
+        )
+
+    def _scenario_inputs(self, scenario, timestep=1, num_events=None):
+        """Inputs of the simulation that only depend on the scenario
+
+        scenario: dict with the uncertainties, keyed by model variable name
+        """
+        G = self.G
+        shapes = G.nodes["A.0"]["Qevents_shape"]
+        wave = shapes.loc[scenario["A.0_ID flood wave shape"]].values
+        events = self._event_selection(num_events)
+
+        inputs = {
+            "time": np.arange(0, wave.shape[0], timestep),
+            # Discharge at the upstream node, [time, step, event, policy]:
+            "Qupstream": wave[:, None, None, None] * self.Qpeaks[None, None, events, None],
+            # Probability of exceedence of the simulated events:
+            "p_exc": self.p_exc[events],
+            # Discounting over the years of each planning step:
+            "disc_factor": np.array(
+                [
+                    np.sum(
+                        discount(1, rate=scenario[f"discount rate {s}"], n=self.y_step)
+                    )
+                    for s in self.planning_steps
+                ]
+            ),
+        }
+        for dike in self.dikelist:
+            node = G.nodes[dike]
+            inputs[dike] = {
+                "Bmax": scenario[f"{dike}_Bmax"],
+                "Brate": scenario[f"{dike}_Brate"],
+                # Critical water level before dike heightening:
+                "critWL": Lookuplin(node["f"], 1, 0, scenario[f"{dike}_pfail"]),
+            }
+        return inputs
+
+    def _policy_inputs(self, levers):
+        """Inputs of the simulation that only depend on the policies
+
+        levers: list with a dict of levers per policy, keyed by model
+        variable name
+        """
+        steps = self.planning_steps
+        portfolios = np.array([self._rfr_portfolios(policy) for policy in levers])
+
+        inputs = {
+            # RfR costs [policy, step] and rating curve reductions [policy, dike]
+            "rfr_costs": self.rfr_costs[steps, portfolios],
+            "rfr_offsets": np.sum(self.rfr_offsets[steps, portfolios], axis=1),
+            "DaysToThreat": np.array([policy["EWS_DaysToThreat"] for policy in levers]),
+        }
+        evacuees = self.G.nodes["EWS"]["evacuees"]
+        inputs["evacuation_percentage"] = np.array(
+            [evacuees[days] for days in inputs["DaysToThreat"]]
+        )
+
+        for dike in self.dikelist:
+            node = self.G.nodes[dike]
+            increases = np.array(
+                [
+                    [policy[f"{dike}_DikeIncrease {s}"] * self.dh for s in steps]
+                    for policy in levers
+                ]
+            )
+            inputs[dike] = {
+                # Cumulative dike heightening [policy, step]:
+                "dikeh_cum": np.cumsum(increases, axis=1),
+                "dikecosts": np.array(
+                    [self._dike_investment_costs(node, row) for row in increases]
+                ),
+            }
+        return inputs
+
+    def _select_policies(self, pol, selection):
+        """Policy inputs of a selection of the policies in the batch"""
+        if isinstance(pol, dict):
+            return {
+                key: self._select_policies(value, selection)
+                for key, value in pol.items()
+            }
+        return pol[selection]
+
+    def _simulate_batch(self, scen, pol):
+        """Route all events of all planning steps for a batch of policies
+
+        Arrays have the axes [step, event, policy], after the time axis for
+        the discharges. Returns per dike the losses, deaths and evacuation
+        costs per event.
+        """
+        G = self.G
+        time = scen["time"]
+        Qout = {"A.0": scen["Qupstream"]}
+        Q_0 = np.trunc(scen["Qupstream"][0])
+
+        results = {}
+        for dike in self.simulated_dikes:
+            node = G.nodes[dike]
+            prec_Qout = Qout[node["prec_node"]]
+
+            # Dike heightening shifts the fragility curve per step:
+            critWL = scen[dike]["critWL"] + pol[dike]["dikeh_cum"].T[:, None, :]
+            offset = pol["rfr_offsets"][:, list(self.dikelist).index(dike)]
+
+            shape = np.broadcast(Q_0, critWL).shape
+            Qin = np.zeros((len(time),) + shape)
+            Qin[0] = Q_0
+            node_Qout = np.zeros((len(time),) + shape)
+            node_Qout[0] = Q_0
+            maxwl = np.zeros(shape)
+            status = np.zeros(shape, dtype=bool)
+            tbreach = np.full(shape, np.nan)
+
+            # Run over the discharge wave:
+            for t in range(1, len(time)):
+                Qin[t] = Muskingum(
+                    node["C1"],
+                    node["C2"],
+                    node["C3"],
+                    prec_Qout[t],
+                    prec_Qout[t - 1],
+                    Qin[t - 1],
+                )
+                wl = Lookuplin(node["r"], 0, 1, Qin[t]) - offset
+                maxwl = np.maximum(maxwl, wl)
+
+                node_Qout[t], _, status, tbreach = dikefailure_batch(
+                    self.sb,
+                    Qin[t],
+                    wl,
+                    node["hground"],
+                    status,
+                    scen[dike]["Bmax"],
+                    scen[dike]["Brate"],
+                    time[t],
+                    tbreach,
+                    critWL,
+                )
+            Qout[dike] = node_Qout
+
+            # Outcomes of interest per event, if breaches occured:
+            evacuation_percentage = pol["evacuation_percentage"]
+            results[dike] = {
+                "losses": np.where(status, Lookuplin(node["table"], 6, 4, maxwl), 0),
+                "deaths": np.where(
+                    status,
+                    Lookuplin(node["table"], 6, 3, maxwl) * (1 - evacuation_percentage),
+                    0,
+                ),
+                "evacuation_costs": np.where(
+                    status,
+                    cost_evacuation(
+                        Lookuplin(node["table"], 6, 5, maxwl) * evacuation_percentage,
+                        pol["DaysToThreat"],
+                    ),
+                    0,
+                ),
+            }
+        return results
+
+    def run_policies(self, scenario, lever_matrix, timestep=1, num_events=None):
+        """Simulate a batch of policies against a single scenario
+
+        The scenario dependent inputs are prepared once, after which all
+        policies are routed together along a batch axis.
+
+        Parameters
+        ----------
+        scenario : dict
+                   uncertainties, keyed by model variable name
+        lever_matrix : DataFrame
+                       one row of levers per policy, columns are the model
+                       variable names of the levers
+        timestep : int, optional
+        num_events : int, optional
+                     number of flood events to simulate, evenly spread
+                     over all events; fewer events give a cheaper, coarser
+                     estimate of the risks. None simulates all events
+
+        Returns
+        -------
+        list with the outcomes of every policy, in the layout of __call__
+        """
+        levers = lever_matrix.to_dict("records")
+        pol = self._policy_inputs(levers)
+
+        # Over-budget policies are rejected before the simulation:
+        total_costs = pol["rfr_costs"].sum(axis=1)
+        for dike in self.dikelist:
+            total_costs += pol[dike]["dikecosts"].sum(axis=1)
+        feasible = np.ones(len(levers), dtype=bool)
+        if self.budget is not None:
+            feasible = total_costs <= self.budget
+
+        scen = self._scenario_inputs(scenario, timestep, num_events)
+        results = {}
+        if np.any(feasible):
+            results = self._simulate_batch(scen, self._select_policies(pol, feasible))
+
+        # Integrate over the events: [step, policy]
+        expected = {}
+        for dike in self.simulated_dikes:
+            expected[dike] = {
+                key: np.trapz(values, scen["p_exc"], axis=1)
+                for key, values in results.get(dike, {}).items()
+            }
+
+        data = [defaultdict(list) for _ in levers]
+        simulated = np.cumsum(feasible) - 1
+        for i in range(len(levers)):
+            j = simulated[i]
+            for s in self.planning_steps:
+                EECosts = 0
+                for d, dike in enumerate(self.dikelist):
+                    if not feasible[i]:
+                        disc_EAD, END = REJECTED_RISK, REJECTED_RISK
+                    elif dike not in self.simulated_dikes:
+                        disc_EAD, END = np.nan, np.nan
+                    else:
+                        disc_EAD = (
+                            expected[dike]["losses"][s, j] * scen["disc_factor"][s]
+                        )
+                        END = expected[dike]["deaths"][s, j]
+                        EECosts += expected[dike]["evacuation_costs"][s, j]
+
+                    data[i][f"{dike}_Expected Annual Damage"].append(disc_EAD)
+                    data[i][f"{dike}_Expected Number of Deaths"].append(END)
+                    data[i][f"{dike}_Dike Investment Costs"].append(
+                        pol[dike]["dikecosts"][i, s]
+                    )
+
+                data[i][f"RfR Total Costs"].append(pol["rfr_costs"][i, s])
+                if not feasible[i]:
+                    data[i][f"Expected Evacuation Costs"].append(REJECTED_RISK)
+                elif len(self.simulated_dikes) < len(self.dikelist):
+                    data[i][f"Expected Evacuation Costs"].append(np.nan)
+                else:
+                    data[i][f"Expected Evacuation Costs"].append(EECosts)
+        return data
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from collections import defaultdict
 from ema_workbench import Model, MultiprocessingEvaluator, Policy, Scenario
@@ -7,11 +8,57 @@ from ema_workbench.em_framework.samplers import sample_uncertainties
 from ema_workbench.util import ema_logging
 import time
 from our_problem_formulation import get_model_for_problem_formulation
+from adaptive_sampling import BoundarySampler
 
-# pick config from ['ref', 'subspace']
+# pick config from ['ref', 'subspace', 'adaptive']
+# 'adaptive' runs the subspace scenarios near the boundary of the unacceptable outcomes only,
+# the other scenarios are labelled by a classifier (see adaptive_sampling.py)
 CONFIG = 'subspace'
 # outcomes will be saved with _{CONFIG} appended to file name
 
+# thresholds from which outcomes are unacceptable, those of the local scope in notebooks/subspace.ipynb
+UNACCEPTABLE_THRESHOLDS = {"A1_Expected_Annual_Damage": 1e9, "A2_Expected_Annual_Damage": 1e9,
+                           "A1_Expected_Number_of_Deaths": 0.9, "A2_Expected_Number_of_Deaths": 0.9}
+
+
+# Function to run a policy on a uniform pool of scenarios, of which only the initial Latin hypercube and the
+# scenarios near the boundary of the unacceptable outcomes are run, batch by batch
+# the outcomes of the scenarios that are not run are nan, their labels are those of the classifier
+def perform_experiments_adaptive(evaluator, model, policy, number_of_scenarios, thresholds,
+                                 initial_scenarios=500, batch_size=250, max_runs=5000, confidence=0.9):
+    samples = list(sample_uncertainties(model, initial_scenarios)) + \
+        list(sample_uncertainties(model, number_of_scenarios - initial_scenarios))
+    scenarios = [Scenario(i, **sample) for i, sample in enumerate(samples)]
+    pool = pd.DataFrame(scenarios, columns=[uncertainty.name for uncertainty in model.uncertainties])
+    sampler = BoundarySampler(pool, thresholds, batch_size=batch_size, confidence=confidence)
+
+    runs = []
+    batch = range(initial_scenarios)
+    while len(batch):
+        experiments, outcomes = evaluator.perform_experiments([scenarios[i] for i in batch], policies=policy)
+        sampler.update(experiments["scenario"].astype(int), outcomes)
+        runs.append((experiments, outcomes))
+        print(f"Batch {len(runs)}: {sampler.log[-1]}")
+        batch = sampler.next_batch()[:max_runs - sampler.evaluated.sum()]
+
+    # experiments of the whole pool, in the layout of the workbench
+    experiments = pd.concat([run[0] for run in runs], ignore_index=True)
+    index = experiments["scenario"].astype(int).to_numpy()
+    pool_experiments = pool.copy()
+    for column in experiments.columns:
+        if column not in pool_experiments:
+            pool_experiments[column] = experiments[column].iloc[0]
+    pool_experiments["scenario"] = np.arange(number_of_scenarios)
+    pool_experiments = pool_experiments[experiments.columns].astype(
+        {column: "category" for column in experiments.select_dtypes("category").columns})
+
+    pool_outcomes = {}
+    for name in runs[0][1]:
+        pool_outcomes[name] = np.full(number_of_scenarios, np.nan)
+        pool_outcomes[name][index] = np.concatenate([run[1][name] for run in runs])
+    return pool_experiments, pool_outcomes, sampler
+
+
 if __name__ == "__main__":
     ema_logging.log_to_stderr(ema_logging.INFO)
 
@@ -76,7 +123,19 @@ if __name__ == "__main__":
     # series run
     config_options = {'ref': {'models': dike_model, 'scenarios': ref_scenario, 'policies': 5},
                       'subspace': {'models': dike_model, 'scenarios': 10000, 'policies': policy0}}
-    experiments, outcomes = perform_experiments(**config_options[CONFIG])
+    if CONFIG == 'adaptive':
+        with MultiprocessingEvaluator(dike_model) as evaluator:
+            experiments, outcomes, sampler = perform_experiments_adaptive(
+                evaluator, dike_model, policy0, 10000, UNACCEPTABLE_THRESHOLDS)
+        print(f"{sampler.evaluated.sum()} of {len(experiments)} scenarios were run")
+
+        # PRIM on the pool should use these labels instead of the outcomes, which are nan if not run,
+        # see labels_path in notebooks/subspace.ipynb
+        labels = sampler.labels()
+        labels.index.name = 'experiment'
+        labels.to_csv(f'data/experiments/unacceptable_{CONFIG}.csv')
+    else:
+        experiments, outcomes = perform_experiments(**config_options[CONFIG])
 
     # export
     experiments.to_csv(f'data/experiments/experiments_{CONFIG}.csv')
@@ -58,6 +58,34 @@ def dikefailure(
     return outflow, breachflow, status_t2, tbr
 
 
+def dikefailure_batch(
+    sb, inflow, hriver, hground, status_t1, Bmax, Brate, simtime, tbreach, critWL
+):
+    """Array version of dikefailure, for a batch of simulations at once
+
+    The water depth in the polder (hbas) is taken as zero, as it is in the
+    simulation loop of DikeNetwork, which passes hbas before updating it.
+    Returns outflow, breachflow, status and time of breach.
+    """
+    h1 = hriver - hground
+
+    # if the dike has already failed:
+    B = Bmax * (1 - np.exp(-Brate * (simtime - tbreach)))
+    breachflow = np.where(status_t1 & (h1 > 0), 1.7 * B * np.maximum(h1, 0) ** 1.5, 0)
+    outflow = np.where(status_t1, np.maximum(0, inflow - breachflow), inflow)
+
+    # if the dike has not failed yet, check whether it fails:
+    failure = ~status_t1 & (hriver > critWL)
+    status_t2 = status_t1 | failure
+    tbr = np.where(failure, simtime, tbreach)
+
+    # if effects of hydrodynamic system behaviour have to be ignored:
+    if sb == False:
+        outflow = inflow
+
+    return outflow, breachflow, status_t2, tbr
+
+
 def Lookuplin(MyFile, inputcol, searchcol, inputvalue):
     """Linear lookup function"""
     return np.interp(inputvalue, MyFile[:, inputcol], MyFile[:, searchcol])
@@ -26,5 +26,5 @@ def discount(amount, rate, n):
 
 def cost_evacuation(N_evacuated, days_to_threat):
     # if days to threat is zero, then no evacuation happens, costs are zero
-    cost = N_evacuated * 22 * (days_to_threat + 3) * (int(days_to_threat > 0))
+    cost = N_evacuated * 22 * (days_to_threat + 3) * (np.asarray(days_to_threat) > 0)
     return cost
@@ -0,0 +1,82 @@
+"""
+Epsilon-box nondominated filtering of optimization results with numpy.
+"""
+import numpy as np
+import pandas as pd
+from platypus import Direction
+
+
+def epsilon_boxes(outcomes, epsilons):
+    """Epsilon-box index of each row of minimized outcomes, and the squared
+    distance of each row to the optimal corner of its box"""
+
+    boxes = np.floor(outcomes / epsilons)
+    distances = np.sum((outcomes - boxes * epsilons) ** 2, axis=1)
+    return boxes.astype(np.int64), distances
+
+
+def nondominated_boxes(boxes, block=256):
+    """Mask of the boxes that are not dominated by any other box
+
+    The boxes should be unique. They are sorted on the sum of their
+    indices, because a box can only be dominated by a box with a smaller
+    sum. Every block of boxes is then checked against the nondominated
+    boxes found so far, and against the boxes earlier in the block.
+    """
+    order = np.argsort(boxes.sum(axis=1), kind="stable")
+    nondominated = np.zeros(len(boxes), dtype=bool)
+    front = boxes[:0]
+
+    for start in range(0, len(order), block):
+        indices = order[start:start + block]
+        candidates = boxes[indices]
+
+        # dominated by the front of the earlier blocks
+        less_equal = np.all(front[None, :, :] <= candidates[:, None, :], axis=2)
+        less = np.any(front[None, :, :] < candidates[:, None, :], axis=2)
+        dominated = np.any(less_equal & less, axis=1)
+
+        # dominated within the block, by a box with a smaller sum
+        less_equal = np.all(candidates[None, :, :] <= candidates[:, None, :], axis=2)
+        less = np.any(candidates[None, :, :] < candidates[:, None, :], axis=2)
+        dominated |= np.any(less_equal & less, axis=1)
+
+        nondominated[indices[~dominated]] = True
+        front = np.concatenate([front, candidates[~dominated]])
+
+    return nondominated
+
+
+def epsilon_nondominated(results, epsilons, problem):
+    """Merge a list of results into a single set of epsilon nondominated results
+
+    Gives the same set as epsilon_nondominated of the workbench, which adds
+    the rows one by one to a platypus EpsilonBoxArchive: of every box that
+    is not dominated by another box, the row closest to the optimal corner
+    of the box is kept, the first one on ties. The rows keep their order.
+    Columns other than the levers and outcomes, like a saved index, are
+    ignored.
+    """
+    if problem.nobjs != len(epsilons):
+        raise ValueError(
+            f"The number of epsilon values ({len(epsilons)}) must match the number of objectives {problem.nobjs}"
+        )
+
+    results = pd.concat(results, ignore_index=True)
+    outcomes = results[problem.outcome_names].to_numpy(dtype=float)
+    outcomes = np.where(np.asarray(problem.directions) == Direction.MAXIMIZE, -outcomes, outcomes)
+
+    boxes, distances = epsilon_boxes(outcomes, np.asarray(epsilons, dtype=float))
+    unique_boxes, box_of_row = np.unique(boxes, axis=0, return_inverse=True)
+    box_of_row = box_of_row.ravel()
+
+    # the first row with the smallest distance in each box
+    rows = np.lexsort((np.arange(len(results)), distances, box_of_row))
+    first_in_box = np.ones(len(rows), dtype=bool)
+    first_in_box[1:] = box_of_row[rows[1:]] != box_of_row[rows[:-1]]
+    best_rows = rows[first_in_box]
+
+    keep = best_rows[nondominated_boxes(unique_boxes)[box_of_row[best_rows]]]
+
+    columns = problem.parameter_names + problem.outcome_names
+    return results.loc[np.sort(keep), columns].reset_index(drop=True)
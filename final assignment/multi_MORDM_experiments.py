@@ -1,15 +1,43 @@
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from ema_workbench import Policy
 from our_problem_formulation import get_model_for_problem_formulation
-from ema_workbench.em_framework.optimization import (ArchiveLogger, EpsilonProgress,
-                                                        to_problem, epsilon_nondominated,
-                                                        rebuild_platypus_population)
+from ema_workbench.em_framework.optimization import EpsilonProgress, to_problem
+from ema_workbench.em_framework.samplers import sample_uncertainties
+from ema_workbench.util import EMAError
 from ema_workbench import (MultiprocessingEvaluator, Scenario, SequentialEvaluator)
-from platypus import Hypervolume
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import seaborn as sns
+from convergence_metrics import ColumnarArchiveLogger, MonteCarloHypervolume
+from funs_pareto import epsilon_nondominated
+from batch_evaluator import MultiprocessingBatchEvaluator, PolicyBatchEvaluator
+from bulk_parcoords import export_figure
+from results_store import ColumnTable
+from racing import PolicyRace
+from robustness_metrics import DOMAIN_THRESHOLDS, RobustnessAccumulator
+
+# pick evaluator from ['multiprocessing', 'batch', 'batch_multiprocessing']
+# 'batch' simulates all policies of a scenario in one DikeNetwork.run_policies call,
+# 'batch_multiprocessing' spreads these scenario batches over worker processes
+# (see benchmark_reevaluation.py for the speedup over one model run per experiment)
+EVALUATOR = 'batch_multiprocessing'
+EVALUATORS = {'multiprocessing': MultiprocessingEvaluator, 'batch': PolicyBatchEvaluator,
+              'batch_multiprocessing': MultiprocessingBatchEvaluator}
+
+# the experiments and outcomes are saved to a columnar store (see results_store.py),
+# set EXPORT_CSV to True to also export them to experiments.csv and outcomes.csv
+EXPORT_CSV = False
+
+# set RACING to True to stop testing policies that are out of contention on the domain criterion,
+# the racing log and the running scores with their confidence intervals are saved next to the store
+RACING = False
+
+# set SHOW_PLOTS to False to only save the convergence plot, for instance in batch jobs
+SHOW_PLOTS = True
 
 
 # Function to create a list of scenarios from the scenario discovery selection
@@ -105,6 +133,8 @@ def retrieve_results(folder_path):
 
 
 # Function to filter results using the non dominance sort
+# epsilon_nondominated of funs_pareto gives the same reference set as the one of the workbench,
+# but works on the outcome columns with numpy instead of adding platypus solutions one by one
 def sort_non_dominance(results, epsilons, problem):
 
     # retrieve reference set from the non dominance sort function
@@ -113,20 +143,253 @@ def sort_non_dominance(results, epsilons, problem):
     return reference_set
 
 
+# Function to get the archives file of an optimization run
+# the tar.gz archives of older runs are converted to the columnar npy format of the
+# ColumnarArchiveLogger once, after which loading them only memory-maps the npy file
+def get_archive_file(problem, scenario_name, seed):
+    archive_file_path = os.path.join("data", "archives", f"multi_MORDM_{scenario_name}_seed_{seed}.npy")
+    if not os.path.exists(archive_file_path):
+        tar_file_path = os.path.join("data", "archives", f"multi_MORDM_{scenario_name}_seed_{seed}.tar.gz")
+        ColumnarArchiveLogger.convert(tar_file_path, archive_file_path,
+                                      problem.parameter_names, problem.outcome_names)
+    return archive_file_path
+
+
+# Function to load the archives of an optimization run
+def load_archives(problem, scenario_name, seed):
+    return ColumnarArchiveLogger.load_archives(get_archive_file(problem, scenario_name, seed))
+
+
 # Function to calculate convergence_metrics
-def calculate_convergence_metrics(problem, archives_file):
-    hv = Hypervolume(minimum=[0, ] * len(model.outcomes), maximum=[12, ] * len(model.outcomes))
-    archives = ArchiveLogger.load_archives(archives_file)
+# hv: MonteCarloHypervolume, estimates the hypervolume of each archive and its confidence interval,
+# updating the estimate of the previous archive with the solutions that entered or left the archive
+def calculate_convergence_metrics(problem, archives, hv):
+    hv.reset()
     metrics = []
-    for nfe, archive in archives.items():
-        population = rebuild_platypus_population(archive, problem)
-        metrics.append(dict(hypervolume=hv.calculate(population), nfe=nfe))
+    for nfe in sorted(archives):
+        hypervolume, half_width = hv.update(archives[nfe][problem.outcome_names].values)
+        metrics.append(dict(hypervolume=hypervolume, hypervolume_ci=half_width, nfe=nfe))
 
     metrics = pd.DataFrame.from_dict(metrics)
     metrics.sort_values(by="nfe", inplace=True, ignore_index=True)
     return metrics
 
 
+# hypervolume estimator of a convergence worker process
+_worker_hv = None
+
+
+# Function to give a convergence worker process its hypervolume estimator
+def initialize_convergence_worker(hv):
+    global _worker_hv
+    _worker_hv = hv
+
+
+# Function to calculate the convergence metrics of a chunk of archives of one run in a worker process
+def calculate_convergence_chunk(problem, archive_file_path, nfes, scenario_name, seed):
+    archives = ColumnarArchiveLogger.load_archives(archive_file_path, nfes)
+    metrics = calculate_convergence_metrics(problem, archives, _worker_hv)
+    metrics["seed"] = seed
+    metrics["scenario"] = scenario_name
+    return metrics
+
+
+# Function to calculate the convergence metrics of all runs over a pool of processes
+# runs: list of (scenario name, seed) tuples
+# the archives of every run are split in chunks of chunksize archives, which are divided over
+# the processes; within a chunk, the hypervolume of each archive updates that of the previous one
+# n_processes: number of worker processes, defaults to the number of cpu's
+def calculate_convergence_parallel(problem, runs, hv, chunksize=25, n_processes=None):
+    units = []
+    for scenario_name, seed in runs:
+        archive_file_path = get_archive_file(problem, scenario_name, seed)
+        nfes = np.unique(ColumnarArchiveLogger.load_array(archive_file_path)["nfe"]).tolist()
+        for i in range(0, len(nfes), chunksize):
+            units.append((problem, archive_file_path, nfes[i:i + chunksize], scenario_name, seed))
+
+    with ProcessPoolExecutor(n_processes, initializer=initialize_convergence_worker, initargs=(hv,)) as pool:
+        metrics = list(pool.map(calculate_convergence_chunk, *zip(*units)))
+
+    convergence = pd.concat(metrics, ignore_index=True)
+    return convergence.sort_values(by=["scenario", "seed", "nfe"], ignore_index=True)
+
+
+# Function to get the sampled scenarios of a re-evaluation store, sampling them on the first run
+# the scenarios are saved, so a resumed re-evaluation uses the same scenarios
+def get_store_scenarios(model, number_of_scenarios, store_folder_path):
+    scenario_table = ColumnTable(os.path.join(store_folder_path, "scenarios"))
+    if scenario_table.rows == 0:
+        samples = [{"scenario": sample.name, **sample} for sample in sample_uncertainties(model, number_of_scenarios)]
+        scenario_table.append(pd.DataFrame(samples))
+    elif scenario_table.rows != number_of_scenarios:
+        raise EMAError(f"the store has {scenario_table.rows} scenarios instead of {number_of_scenarios}, "
+                       f"remove {store_folder_path} to start over")
+
+    df_scenarios = scenario_table.load()
+    return [Scenario(row.pop("scenario"), **row) for row in df_scenarios.to_dict("records")]
+
+
+# Function to save the names of the re-evaluated policies in the store on the first run
+# a resumed re-evaluation should have the same policies, otherwise its blocks do not match
+def check_store_policies(policies, store_folder_path):
+    policy_table = ColumnTable(os.path.join(store_folder_path, "policies"))
+    names = pd.DataFrame({"policy": [policy.name for policy in policies]})
+    if policy_table.rows == 0:
+        policy_table.append(names)
+    elif policy_table.load()["policy"].astype(str).tolist() != names["policy"].tolist():
+        raise EMAError(f"the policies differ from the ones in the store, remove {store_folder_path} to start over")
+
+
+# Function to open the robustness accumulator of a re-evaluation store, which is created on the first run
+# the accumulator is saved after the experiments it has seen, so it cannot be ahead of the stored rows,
+# unless the store was cut back by hand, in which case it is rebuilt from the store
+def get_store_accumulator(model, policies, thresholds, store_folder_path, rows):
+    accumulator_file_path = os.path.join(store_folder_path, "robustness.npz")
+    if os.path.exists(accumulator_file_path):
+        accumulator = RobustnessAccumulator.load(accumulator_file_path)
+        if accumulator.rows <= rows:
+            return accumulator
+    return RobustnessAccumulator([policy.name for policy in policies],
+                                 [outcome.name for outcome in model.outcomes], thresholds)
+
+
+# Function to add the experiments of finished scenarios to the robustness accumulator and save it
+# the block of experiments is read from the store, unless it is given
+def accumulate(accumulator, store_folder_path, experiments_table, outcomes_table, end, experiments=None, outcomes=None):
+    start = accumulator.rows
+    if start >= end:
+        return
+    if experiments is None:
+        columns = experiments_table.load_arrays(["scenario", "policy"])
+        experiments = pd.DataFrame({name: values[start:end] for name, values in columns.items()})
+        outcomes = {name: np.asarray(values[start:end])
+                    for name, values in outcomes_table.load_arrays(accumulator.outcome_names).items()}
+    accumulator.update(experiments, outcomes)
+    accumulator.save(os.path.join(store_folder_path, "robustness.npz"))
+
+
+# Function to re-evaluate policies on sampled scenarios in blocks of scenarios x policies
+# every finished block is appended to the experiments and outcomes tables of the store, so only one
+# block is kept in memory and an interrupted re-evaluation resumes after its last finished block
+# scenarios_per_block, policies_per_block: block size, None for all policies in every block
+# thresholds: outcome thresholds of the domain criterion, if given, the robustness metrics are accumulated
+# as soon as all policies are evaluated on the scenarios of a block, see robustness_metrics.py
+def perform_experiments_chunked(evaluator, model, policies, number_of_scenarios, store_folder_path,
+                                scenarios_per_block=50, policies_per_block=None, thresholds=None):
+    scenarios = get_store_scenarios(model, number_of_scenarios, store_folder_path)
+    check_store_policies(policies, store_folder_path)
+
+    policies_per_block = policies_per_block or len(policies)
+    blocks = [(scenarios[i:i + scenarios_per_block], policies[j:j + policies_per_block])
+              for i in range(0, len(scenarios), scenarios_per_block)
+              for j in range(0, len(policies), policies_per_block)]
+    block_ends = np.cumsum([len(block_scenarios) * len(block_policies) for block_scenarios, block_policies in blocks])
+    number_of_experiments = len(scenarios) * len(policies)
+
+    # the outcomes of a block are committed after its experiments, so keep the blocks both tables finished
+    experiments_table = ColumnTable(os.path.join(store_folder_path, "experiments"))
+    outcomes_table = ColumnTable(os.path.join(store_folder_path, "outcomes"))
+    finished_blocks = np.searchsorted(block_ends, min(experiments_table.rows, outcomes_table.rows), side="right")
+    rows = int(block_ends[finished_blocks - 1]) if finished_blocks else 0
+    experiments_table.truncate(rows)
+    outcomes_table.truncate(rows)
+    if finished_blocks:
+        print(f"Resuming after block {finished_blocks}/{len(blocks)}, {rows}/{number_of_experiments} experiments done.")
+
+    if thresholds is not None:
+        accumulator = get_store_accumulator(model, policies, thresholds, store_folder_path, rows)
+    policy_blocks = len(range(0, len(policies), policies_per_block))
+
+    for k, (block_scenarios, block_policies) in enumerate(blocks):
+        if k >= finished_blocks:
+            block_rows = len(block_scenarios) * len(block_policies)
+
+            start = time.time()
+            experiments, outcomes = evaluator.perform_experiments(block_scenarios, policies=block_policies)
+            experiments_table.append(experiments)
+            outcomes_table.append(pd.DataFrame(outcomes).astype(float))
+            duration = time.time() - start
+            rows += block_rows
+
+            print(f"Block {k + 1}/{len(blocks)}: {block_rows} experiments in {duration:.1f} s "
+                  f"({block_rows / duration:.1f} experiments/s), {rows}/{number_of_experiments} experiments done.")
+
+        # the last block of a set of scenarios completes them, also when resuming after it
+        if thresholds is not None and k % policy_blocks == policy_blocks - 1:
+            accumulate(accumulator, store_folder_path, experiments_table, outcomes_table, int(block_ends[k]))
+
+    return experiments_table, outcomes_table
+
+
+# Function to re-evaluate policies on sampled scenarios in blocks of scenarios, racing the policies
+# after every block, the racing policies that are dominated on the domain criterion with the given
+# confidence are eliminated (see racing.py), so the next blocks only evaluate the remaining policies
+# finished blocks are saved to the store like in perform_experiments_chunked, a resumed race replays
+# them to recover the racing policies and continues after the last finished block
+# thresholds: outcome thresholds of the domain criterion, the robustness metrics are accumulated as well
+def perform_experiments_racing(evaluator, model, policies, number_of_scenarios, thresholds, store_folder_path,
+                               scenarios_per_block=50, confidence=0.95, min_scenarios=100):
+    scenarios = get_store_scenarios(model, number_of_scenarios, store_folder_path)
+    check_store_policies(policies, store_folder_path)
+    policies_by_name = {policy.name: policy for policy in policies}
+    race = PolicyRace(list(policies_by_name), thresholds, confidence=confidence, min_scenarios=min_scenarios)
+
+    experiments_table = ColumnTable(os.path.join(store_folder_path, "experiments"))
+    outcomes_table = ColumnTable(os.path.join(store_folder_path, "outcomes"))
+    stored_rows = min(experiments_table.rows, outcomes_table.rows)
+    accumulator = get_store_accumulator(model, policies, thresholds, store_folder_path, stored_rows)
+    if stored_rows:
+        stored_experiments = experiments_table.load(columns=["scenario", "policy"])
+        stored_outcomes = outcomes_table.load_arrays(race.outcome_names)
+
+    rows = 0
+    for k, i in enumerate(range(0, len(scenarios), scenarios_per_block)):
+        block_scenarios = scenarios[i:i + scenarios_per_block]
+        block_rows = len(block_scenarios) * len(race.active)
+
+        # replay a finished block, the racing policies of a block follow from the blocks before it
+        if rows + block_rows <= stored_rows:
+            experiments = stored_experiments.iloc[rows:rows + block_rows].reset_index(drop=True)
+            outcomes = {name: np.asarray(values[rows:rows + block_rows]) for name, values in stored_outcomes.items()}
+            message = "replayed from the store"
+        else:
+            if rows < stored_rows or rows < max(experiments_table.rows, outcomes_table.rows):
+                experiments_table.truncate(rows)
+                outcomes_table.truncate(rows)
+                stored_rows = rows
+                print(f"Resuming after block {k}, {rows} experiments done.")
+
+            start = time.time()
+            experiments, outcomes = evaluator.perform_experiments(
+                block_scenarios, policies=[policies_by_name[name] for name in race.active])
+            experiments_table.append(experiments)
+            outcomes_table.append(pd.DataFrame(outcomes).astype(float))
+            duration = time.time() - start
+            message = f"{block_rows} experiments in {duration:.1f} s ({block_rows / duration:.1f} experiments/s)"
+        rows += block_rows
+
+        # arrange the outcomes of the block as (policy, scenario) arrays
+        racing = list(race.active)
+        policy_index = pd.Index([str(name) for name in racing]).get_indexer(experiments["policy"].astype(str))
+        scenario_index = pd.Index([str(scenario.name) for scenario in block_scenarios]).get_indexer(
+            experiments["scenario"].astype(str))
+        if (policy_index < 0).any() or (scenario_index < 0).any():
+            raise EMAError(f"the experiments of block {k + 1} do not match the racing policies and scenarios, "
+                           f"remove {store_folder_path} to start over")
+        block_outcomes = {}
+        for name in race.outcome_names:
+            values = np.empty((len(racing), len(block_scenarios)))
+            values[policy_index, scenario_index] = outcomes[name]
+            block_outcomes[name] = values
+
+        eliminated = race.update(racing, block_outcomes)
+        accumulate(accumulator, store_folder_path, experiments_table, outcomes_table, rows, experiments, outcomes)
+        print(f"Block {k + 1}: {message}, {len(eliminated)} policies eliminated, "
+              f"{len(race.active)}/{len(policies)} policies racing.")
+
+    return experiments_table, outcomes_table, race
+
+
 ### Run script ###
 if __name__ == "__main__":
 
@@ -168,19 +431,24 @@ if __name__ == "__main__":
         dominant_results.append((reference_set, convergences_per_scenario[i]))
     print("Solutions are filtered for non-dominated solutions.")
 
-    # calculate convergence
-    convergence_calculations = []
+    # the hypervolume is normalized with the bounds of the outcomes over all reference sets
+    hv = MonteCarloHypervolume.from_reference_sets([refset for refset, _ in dominant_results],
+                                                   problem.outcome_names)
+
+    # collect the epsilon progress of the runs
+    runs = []
+    epsilon_progress = []
     for (refset, eps_progress), scenario in zip(dominant_results, scenarios):
         for seed, seed_eps in zip(range(5), eps_progress):
-            archive_file_path = os.path.join("data", "archives", f"multi_MORDM_{scenario.name}_seed_{seed}.tar.gz")
-            archive_file = archive_file_path
-            metrics = calculate_convergence_metrics(problem, archive_file)
-            metrics["seed"] = seed
-            metrics["scenario"] = scenario.name
-            metrics["epsilon_progress"] = seed_eps.epsilon_progress
-            convergence_calculations.append(metrics)
+            runs.append((scenario.name, seed))
+            seed_eps = seed_eps[["nfe", "epsilon_progress"]].assign(seed=seed, scenario=scenario.name)
+            epsilon_progress.append(seed_eps)
 
-    convergence = pd.concat(convergence_calculations, ignore_index=True)
+    # calculate convergence of all runs in parallel and add the epsilon progress
+    # the archive at nfe 0 is empty, so it has no hypervolume
+    convergence = calculate_convergence_parallel(problem, runs, hv)
+    convergence = convergence.merge(pd.concat(epsilon_progress), on=["scenario", "seed", "nfe"], how="right")
+    convergence = convergence.fillna({"hypervolume": 0, "hypervolume_ci": 0})
 
     print("Convergence is calculated and will be shown.")
 
@@ -202,11 +470,9 @@ if __name__ == "__main__":
     fig.legend(artists, labels, bbox_to_anchor=(1, 0.9))
     # set title
     fig.suptitle("Epsilon Convergence", fontsize=16, fontweight=800, y=0.98)
-    # save figure
+    # save and show figure, not showing it keeps the figure from blocking the experiments below
     convergence_plot_path = os.path.join("data", "robustness_experiments", "convergence_figure.png")
-    plt.savefig(convergence_plot_path)
-    # show figure
-    plt.show()
+    export_figure(fig, convergence_plot_path, show=SHOW_PLOTS)
 
     # create policies by retrieving model levers from the results
     policies = []
@@ -219,21 +485,36 @@ if __name__ == "__main__":
     print("Policies have been determined.")
 
     # test policies on new scenarios
+    # the experiments run in blocks that are saved to the store as soon as they are finished,
+    # rerunning the script continues after the last finished block
+    # the robustness metrics are accumulated along, so multi_MORDM_robustness.py can be run during the experiments
     number_of_new_scenarios = 1000
+    store_folder_path = os.path.join("data", "robustness_experiments", "store")
     print(f"These {len(policies)} policies will be tested on {number_of_new_scenarios} new scenarios:")
-    with MultiprocessingEvaluator(model) as evaluator:
-        reevaluation_results = evaluator.perform_experiments(number_of_new_scenarios, policies=policies)
-
-    experiments, outcomes = reevaluation_results
-
-    # save experiments
-    experiments_file_path = os.path.join("data", "robustness_experiments", "experiments.csv")
-    experiments.to_csv(experiments_file_path, index=False)
-
-    # save outcomes
-    df_outcomes = pd.DataFrame().from_dict(outcomes)
-    outcomes_file_path = os.path.join("data", "robustness_experiments", "outcomes.csv")
-    df_outcomes.to_csv(outcomes_file_path, index=False)
+    with EVALUATORS[EVALUATOR](model) as evaluator:
+        if RACING:
+            # policies that are out of contention on the domain criterion are not tested on all scenarios
+            experiments_table, outcomes_table, race = perform_experiments_racing(evaluator, model, policies,
+                                                                                 number_of_new_scenarios,
+                                                                                 DOMAIN_THRESHOLDS,
+                                                                                 store_folder_path)
+            racing_log_path = os.path.join("data", "robustness_experiments", "racing_log.csv")
+            pd.DataFrame(race.log, columns=["policy", "scenarios", "dominated by"]).to_csv(racing_log_path,
+                                                                                          index=False)
+            racing_scores_path = os.path.join("data", "robustness_experiments", "racing_scores.csv")
+            race.scores().to_csv(racing_scores_path, index=False)
+        else:
+            experiments_table, outcomes_table = perform_experiments_chunked(evaluator, model, policies,
+                                                                            number_of_new_scenarios,
+                                                                            store_folder_path,
+                                                                            thresholds=DOMAIN_THRESHOLDS)
+
+    # export experiments and outcomes
+    if EXPORT_CSV:
+        experiments_file_path = os.path.join("data", "robustness_experiments", "experiments.csv")
+        experiments_table.to_csv(experiments_file_path)
+        outcomes_file_path = os.path.join("data", "robustness_experiments", "outcomes.csv")
+        outcomes_table.to_csv(outcomes_file_path)
 
     # save number of experiments
     number_dict = {"number of experiments": number_of_new_scenarios}
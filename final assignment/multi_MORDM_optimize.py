@@ -1,4 +1,8 @@
+import glob
 import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from ema_workbench import (
     ema_logging,
     Model,
@@ -9,10 +13,33 @@ from ema_workbench import (
 
 ema_logging.log_to_stderr(ema_logging.INFO)
 
-from ema_workbench.em_framework.optimization import (ArchiveLogger, EpsilonProgress)
+from ema_workbench.em_framework.optimization import EpsilonProgress
 from ema_workbench.util import ema_logging
 import pandas as pd
-from our_problem_formulation import get_model_for_problem_formulation
+from our_problem_formulation import get_model_for_problem_formulation, get_budget_constraint
+from batch_evaluator import PolicyBatchEvaluator, SharedPoolEvaluator, initialize_worker
+from convergence_metrics import ColumnarArchiveLogger, RunProgress
+from optimization_runner import EarlyStopping, FidelitySchedule, optimize, optimize_steady_state
+
+# pick evaluator from ['multiprocessing', 'batch']
+# 'batch' simulates all policies of a scenario in one DikeNetwork.run_policies call
+EVALUATOR = 'batch'
+EVALUATORS = {'multiprocessing': MultiprocessingEvaluator, 'batch': PolicyBatchEvaluator}
+
+# pick schedule from ['sequential', 'concurrent']
+# 'sequential' runs the scenarios and seeds one after another with the EVALUATOR above,
+# 'concurrent' runs all of them at once on one shared pool of worker processes
+# with 'sequential', every run seeds the random number generator with its scenario and seed, so a
+# run can be repeated; with 'concurrent', the runs draw from the one random number generator of
+# platypus in whatever order their threads get to it, so the seeds are only labels of the runs
+SCHEDULE = 'concurrent'
+
+# pick algorithm from ['generational', 'steady_state']
+# 'steady_state' gives a worker new offspring as soon as it returns its results, instead of waiting
+# for whole generations; its evaluations always run on a shared pool and it saves no checkpoints
+ALGORITHM = 'generational'
+# number of offspring a worker evaluates at a time with the 'steady_state' algorithm
+STEADY_STATE_BATCH_SIZE = 10
 
 
 # Function to create a list of scenarios from a dataframe
@@ -47,43 +74,198 @@ def create_scenarios(df_scenario_discovery):
     return scenarios
 
 
-# Function to run the optimizer to find policy levers for minimized model outcomes
-def optimize_scenarios(scenario, nfe, model, epsilons, number_of_seeds):
-
-    # save number of seeds per scenario
+# Function to save the number of seeds per scenario
+def save_number_of_seeds(number_of_seeds):
     seeds_dict = {"number of seeds": number_of_seeds}
     df_seeds = pd.DataFrame(seeds_dict, index=[0])
     seeds_file_path = os.path.join("data", "optimize_results", "number_of_seeds.csv",)
     df_seeds.to_csv(seeds_file_path)
 
-    # start optimization process
+
+# Function to load the policies to warm start the optimizer of a scenario with
+# warm_start: 'scenario' for the earlier results of the same scenario, 'all' for the earlier results
+# of all scenarios, or the path of a csv file with a column per lever (e.g. saved policies)
+def load_warm_start(warm_start, scenario):
+    if warm_start is None:
+        return None
+
+    if warm_start in ('scenario', 'all'):
+        scenario_name = scenario.name if warm_start == 'scenario' else '*'
+        pattern = os.path.join("data", "optimize_results", f"results_scenario_{scenario_name}_seed_*.csv")
+        file_paths = sorted(glob.glob(pattern))
+    else:
+        file_paths = [warm_start]
+
+    if not file_paths:
+        print(f"No policies found to warm start scenario {scenario.name}, it starts from a random population.")
+        return None
+    return pd.concat([pd.read_csv(file_path) for file_path in file_paths], ignore_index=True)
+
+
+# Function to run the optimizer for one seed of a scenario and save its results
+# the optimizer state is saved to a checkpoint every checkpoint_freq nfe, with resume=True
+# the run continues from its checkpoint, runs with results and without a checkpoint are finished
+# progress: optional RunProgress metric to report the number of function evaluations
+# early_stopping: optional dict with the EarlyStopping settings (window, min_epsilon_progress) to
+# stop the run before nfe is reached once the archive stops improving
+# initial_policies: optional dataframe of policies to seed the initial population with
+# fidelity: optional dict with the FidelitySchedule settings (levels, window) to simulate fewer flood
+# events while the archive is still improving; the results are always evaluated at full fidelity
+# with the 'steady_state' ALGORITHM the evaluator should be a SharedPoolEvaluator, and an unfinished
+# run starts over on resume
+def optimize_seed(scenario, seed, nfe, model, epsilons, evaluator, constraints=None, progress=None,
+                  resume=False, checkpoint_freq=10000, early_stopping=None, initial_policies=None,
+                  fidelity=None):
+    result_file_path = os.path.join("data", "optimize_results", f"results_scenario_{scenario.name}_seed_{seed}.csv")
+    convergence_file_path = os.path.join("data", "optimize_results", f"convergence_scenario_{scenario.name}_seed_{seed}.csv")
+    stopping_file_path = os.path.join("data", "optimize_results", f"stopping_scenario_{scenario.name}_seed_{seed}.csv")
+    checkpoint_file_path = os.path.join("data", "checkpoints", f"checkpoint_scenario_{scenario.name}_seed_{seed}.pkl")
+
+    if resume and os.path.exists(result_file_path) and not os.path.exists(checkpoint_file_path):
+        print(f"Scenario {scenario.name} seed {seed} is already finished.")
+        return
+    os.makedirs(os.path.dirname(checkpoint_file_path), exist_ok=True)
+    steady_state = ALGORITHM == 'steady_state'
+
     archives_folder_path = os.path.join("data", "archives")
-    with MultiprocessingEvaluator(model) as evaluator:
+    convergence_metrics = [
+        ColumnarArchiveLogger(
+            archives_folder_path,
+            # filter model levers and outcomes names on invalid python identifiers
+            [l.name for l in model.levers],
+            [o.name for o in model.outcomes],
+            base_filename=f"multi_MORDM_{scenario.name}_seed_{seed}.npy",
+            resume=resume and not steady_state,
+        ),
+        EpsilonProgress(),
+    ]
+    if progress is not None:
+        convergence_metrics.append(progress)
+    stopping = EarlyStopping(**early_stopping) if early_stopping is not None else None
+    schedule = FidelitySchedule(**fidelity) if fidelity is not None else None
+
+    # run optimizer
+    if steady_state:
+        result, convergence = optimize_steady_state(model, evaluator, nfe, epsilons,
+                                                    reference=scenario,
+                                                    convergence=convergence_metrics,
+                                                    constraints=constraints,
+                                                    early_stopping=stopping,
+                                                    initial_policies=initial_policies,
+                                                    batch_size=STEADY_STATE_BATCH_SIZE,
+                                                    fidelity=schedule)
+    else:
+        result, convergence = optimize(model, evaluator, nfe, epsilons,
+                                       reference=scenario,
+                                       convergence=convergence_metrics,
+                                       constraints=constraints,
+                                       checkpoint_file=checkpoint_file_path,
+                                       checkpoint_freq=checkpoint_freq,
+                                       resume=resume,
+                                       early_stopping=stopping,
+                                       initial_policies=initial_policies,
+                                       fidelity=schedule)
+
+    # save results and convergence in folder (optimize_results)
+    result.to_csv(result_file_path)
+    convergence.to_csv(convergence_file_path)
+
+    # save at which nfe and why the run stopped
+    if stopping is not None and stopping.stop_nfe is not None:
+        stop = {"stop nfe": stopping.stop_nfe, "reason": stopping.reason}
+    else:
+        stop = {"stop nfe": nfe, "reason": "maximum nfe reached"}
+    pd.DataFrame(stop, index=[0]).to_csv(stopping_file_path)
+
+    # the run is finished, so its checkpoint is no longer needed
+    if os.path.exists(checkpoint_file_path):
+        os.remove(checkpoint_file_path)
+
+
+# Function to run the optimizer to find policy levers for minimized model outcomes
+# constraints: optional list of optimization constraints, e.g. the investment budget
+# resume: continue interrupted runs from their checkpoints and skip finished runs
+# every run seeds the random number generator with its scenario and seed, so it can be repeated
+# early_stopping: optional dict with the EarlyStopping settings
+# warm_start: optional source of policies for the initial population, see load_warm_start
+# fidelity: optional dict with the FidelitySchedule settings
+def optimize_scenarios(scenario, nfe, model, epsilons, number_of_seeds, constraints=None, resume=False,
+                       early_stopping=None, warm_start=None, fidelity=None):
+
+    # save number of seeds per scenario
+    save_number_of_seeds(number_of_seeds)
+
+    # load the warm start policies before the results of this scenario are overwritten
+    initial_policies = load_warm_start(warm_start, scenario)
+
+    # start optimization process
+    if ALGORITHM == 'steady_state':
+        # the steady-state algorithm submits its evaluations to a pool itself
+        with ProcessPoolExecutor(initializer=initialize_worker, initargs=([model],)) as pool:
+            evaluator = SharedPoolEvaluator(model, pool)
+            for i in range(number_of_seeds):
+                random.seed(f"scenario {scenario.name} seed {i}")
+                optimize_seed(scenario, i, nfe, model, epsilons, evaluator, constraints, resume=resume,
+                              early_stopping=early_stopping, initial_policies=initial_policies,
+                              fidelity=fidelity)
+        return
+
+    with EVALUATORS[EVALUATOR](model) as evaluator:
         for i in range(number_of_seeds):
-            convergence_metrics = [
-                ArchiveLogger(
-                    archives_folder_path,
-                    # filter model levers and outcomes names on invalid python identifiers
-                    [l.name for l in model.levers],
-                    [o.name for o in model.outcomes],
-                    base_filename=f"multi_MORDM_{scenario.name}_seed_{i}.tar.gz",
-                ),
-                EpsilonProgress(),
-            ]
-
-            # run optimizer
-            # also, specify the seed because of reproducibility
-            result, convergence = evaluator.optimize(nfe=nfe, searchover='levers',
-                                                        convergence=convergence_metrics,
-                                                        epsilons=epsilons,
-                                                        reference=scenario,
-                                                        seed=i)
-
-            # save results and convergence in folder (optimize_results)
-            result_file_path = os.path.join("data", "optimize_results", f"results_scenario_{scenario.name}_seed_{i}.csv")
-            result.to_csv(result_file_path)
-            convergence_file_path = os.path.join("data", "optimize_results", f"convergence_scenario_{scenario.name}_seed_{i}.csv")
-            convergence.to_csv(convergence_file_path)
+            random.seed(f"scenario {scenario.name} seed {i}")
+            optimize_seed(scenario, i, nfe, model, epsilons, evaluator, constraints, resume=resume,
+                          early_stopping=early_stopping, initial_policies=initial_policies,
+                          fidelity=fidelity)
+
+
+# Function to run the optimizations of all scenarios and seeds at the same time
+# all runs share one pool of worker processes, to which each run submits its generations
+# in chunks; the pool serves the chunks in order of arrival, so every run gets its turn
+# n_processes: number of worker processes, defaults to the number of cpu's
+# report_interval: seconds between progress reports
+# the runs share the random number generator of platypus, so the seed of a run is only a label:
+# it does not make the run reproducible, and a resumed run is not identical to an uninterrupted one
+# resume: continue interrupted runs from their checkpoints and skip finished runs
+# early_stopping: optional dict with the EarlyStopping settings
+# warm_start: optional source of policies for the initial population, see load_warm_start
+# fidelity: optional dict with the FidelitySchedule settings
+def optimize_concurrently(scenarios, nfe, model, epsilons, number_of_seeds, constraints=None,
+                          n_processes=None, report_interval=60, resume=False, early_stopping=None,
+                          warm_start=None, fidelity=None):
+
+    # save number of seeds per scenario
+    save_number_of_seeds(number_of_seeds)
+
+    # load the warm start policies before any results are overwritten
+    initial_policies = {scenario.name: load_warm_start(warm_start, scenario) for scenario in scenarios}
+
+    runs = [(scenario, seed) for scenario in scenarios for seed in range(number_of_seeds)]
+    progress = {f"scenario {scenario.name} seed {seed}": 0 for scenario, seed in runs}
+
+    with ProcessPoolExecutor(n_processes, initializer=initialize_worker, initargs=([model],)) as pool, \
+            ThreadPoolExecutor(len(runs)) as optimizers:
+        # every run has its own optimizer thread and evaluator
+        futures = []
+        for (scenario, seed), label in zip(runs, progress):
+            evaluator = SharedPoolEvaluator(model, pool)
+            futures.append(optimizers.submit(optimize_seed, scenario, seed, nfe, model, epsilons,
+                                             evaluator, constraints, RunProgress(label, progress),
+                                             resume, early_stopping=early_stopping,
+                                             initial_policies=initial_policies[scenario.name],
+                                             fidelity=fidelity))
+
+        # report progress per run until all runs are finished
+        start = time.time()
+        while True:
+            done, not_done = wait(futures, timeout=report_interval)
+            report = ", ".join(f"{label}: {n}/{nfe}" for label, n in progress.items())
+            print(f"[{time.time() - start:.0f} s] {len(done)}/{len(runs)} runs finished. NFE {report}")
+            if not not_done:
+                break
+
+        # raise errors of failed runs
+        for future in futures:
+            future.result()
 
 
 ### Run Script ###
@@ -93,8 +275,13 @@ if __name__ == "__main__":
 
     ema_logging.log_to_stderr(ema_logging.INFO)
 
+    # set an investment budget (dikes and RfR, in euro) to reject over-budget policies
+    # before their flood simulation, None means no budget
+    budget = None
+
     # get model
-    model, steps = get_model_for_problem_formulation()
+    model, steps = get_model_for_problem_formulation(budget=budget)
+    constraints = [get_budget_constraint(budget, model)] if budget is not None else None
     print("Model is loaded.")
 
     # get scenarios from scenario discovery
@@ -138,12 +325,36 @@ if __name__ == "__main__":
     # this value needs to be large enough for converged solutions, but also limit computing time
     nfe = 100000
 
+    # to stop a run before nfe is reached once fewer than min_epsilon_progress solutions entered a
+    # new epsilon box within the last window nfe, set e.g. {"window": 10000, "min_epsilon_progress": 1},
+    # None means always run until nfe
+    early_stopping = None
+
+    # seed the initial populations with earlier found policies, pick from [None, 'scenario', 'all']
+    # or the path of a policy csv; see load_warm_start
+    warm_start = None
+
+    # to start with fewer flood events per evaluation and raise the number of events each time the
+    # epsilon progress stalls over window nfe, set e.g. {"levels": [5, 10, None], "window": 5000},
+    # None means always simulate all events; only the 'batch' EVALUATOR, the 'concurrent' SCHEDULE
+    # and the 'steady_state' ALGORITHM can change the number of events
+    fidelity = None
+
     # search for optimized results per scenario
     # set number of seeds to increase the variance in solution spaces
     number_of_seeds = 3
+
+    # set resume to True to continue an interrupted optimization from its checkpoints
+    # (in data/checkpoints) instead of starting all over
+    resume = False
     print(f"Optimization will run for {len(scenarios)} scenarios, {number_of_seeds} seeds and {nfe} NFEs:\n")
-    for scenario in scenarios:
-        optimize_scenarios(scenario, nfe, model, epsilons, number_of_seeds)
+    if SCHEDULE == 'concurrent':
+        optimize_concurrently(scenarios, nfe, model, epsilons, number_of_seeds, constraints, resume=resume,
+                              early_stopping=early_stopping, warm_start=warm_start, fidelity=fidelity)
+    else:
+        for scenario in scenarios:
+            optimize_scenarios(scenario, nfe, model, epsilons, number_of_seeds, constraints, resume=resume,
+                               early_stopping=early_stopping, warm_start=warm_start, fidelity=fidelity)
 
     # end of script
     print("\nMulti-MORDM optimization script is finished.")
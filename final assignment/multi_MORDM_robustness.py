@@ -1,22 +1,45 @@
 import os
-import matplotlib.pyplot as plt
 import pandas as pd
 from ema_workbench.analysis import parcoords
-import matplotlib.patches as mpatches
-import numpy as np
-
-
-def calculate_regret(x):
-    # policy is non numeric, so min is not defined for this
-    # all the outcomes need to be minimized.
-    best = x.min(numeric_only=True)
-
-    regret = x.loc[:, best.index] - best
-
-    # we add policy back into our regret dataframe
-    # so we know the regret for each policy
-    regret["policy"] = x.policy
-    return regret
+from results_store import ColumnTable
+from robustness_metrics import DOMAIN_THRESHOLDS, OutcomeCube, RobustnessAccumulator
+from bulk_parcoords import BulkParallelAxes, export_figure
+
+# the figures are exported to png and svg, set SHOW_PLOTS to False to not show them, for instance in batch jobs
+SHOW_PLOTS = True
+# above this number of policies, the parallel coordinates plots show the density of the lines instead of the lines
+DENSITY_PLOT_POLICIES = 5000
+
+
+# Function to get the group of each policy, which gives the colour of its line in the plots
+# policies of multi_MORDM_experiments.py are named after the optimization scenario they come from,
+# other policies get a group of their own
+def get_policy_groups(policies):
+    return [str(policy).split(" option")[0] for policy in policies]
+
+
+# Function to plot the robustness of policies on parallel axes, with a line collection per policy group
+def plot_policies(data):
+    limits = parcoords.get_limits(data)
+    paraxes = BulkParallelAxes(limits)
+    if len(data) > DENSITY_PLOT_POLICIES:
+        paraxes.plot_density(data)
+        return paraxes, []
+    return paraxes, paraxes.plot_groups(data, get_policy_groups(data.index))
+
+
+# Function to open a table of the re-evaluation store
+# experiments and outcomes saved as csv by an older version of multi_MORDM_experiments.py are
+# imported into the store once
+def get_store_table(store_folder_path, name):
+    table_folder_path = os.path.join(store_folder_path, name)
+    csv_file_path = os.path.join(os.path.dirname(store_folder_path), f"{name}.csv")
+    if not os.path.exists(os.path.join(table_folder_path, "table.json")) and os.path.exists(csv_file_path):
+        # all outcomes are floats, even if a first chunk of them happens to hold only integers
+        dtype = "float64" if name == "outcomes" else None
+        return ColumnTable.from_csv(table_folder_path, csv_file_path, categorical=["scenario", "policy", "model"],
+                                    dtype=dtype)
+    return ColumnTable(table_folder_path)
 
 
 ### Run script ###
@@ -25,61 +48,51 @@ if __name__ == "__main__":
     print("\nMulti-MORDM robustness script is running...\n")
 
     # get computed experiment data
-    experiments_file_path = os.path.join("data", "robustness_experiments", "experiments.csv")
-    df_experiments = pd.read_csv(experiments_file_path)
-    outcomes_file_path = os.path.join("data", "robustness_experiments", "outcomes.csv")
-    df_outcomes = pd.read_csv(outcomes_file_path)
-    number_file_path = os.path.join("data", "robustness_experiments", "number_of_experiments.csv")
-    df_number_of_experiments = pd.read_csv(number_file_path)
-
-    # convert outcomes dataframe to dictionary
-    outcomes = {}
-    for column in df_outcomes:
-        outcomes[column] = np.array(df_outcomes[column].tolist())
-
-    # get number of experiments
-    number_of_experiments = df_number_of_experiments["number of experiments"][0]
-
-    print("Previously created experiments and outcomes are loaded.")
+    # the experiments script updates a robustness accumulator of the store after every block, so the domain
+    # and regret tables are available while the experiments are still running, without reading the outcomes
+    # the accumulator scores the domain criterion against the thresholds it was created with, so it is only used
+    # if these are still the DOMAIN_THRESHOLDS
+    store_folder_path = os.path.join("data", "robustness_experiments", "store")
+    accumulator_file_path = os.path.join(store_folder_path, "robustness.npz")
+    accumulator = None
+    if os.path.exists(accumulator_file_path):
+        accumulator = RobustnessAccumulator.load(accumulator_file_path)
+        stored_thresholds = {name: threshold for name, threshold in zip(accumulator.outcome_names, accumulator.thresholds)
+                             if pd.notna(threshold)}
+        if stored_thresholds != {name: threshold for name, threshold in DOMAIN_THRESHOLDS.items()
+                                 if name in accumulator.outcome_names}:
+            print("The thresholds of the robustness metrics in the store differ from DOMAIN_THRESHOLDS, "
+                  "the metrics are computed from the experiments instead.")
+            accumulator = None
+        else:
+            print(f"Robustness metrics of {accumulator.rows} experiments are loaded.")
+    if accumulator is None:
+        # only the scenario and policy of the experiments are needed, the outcomes are memory-mapped
+        df_experiments = get_store_table(store_folder_path, "experiments").load(columns=["scenario", "policy"])
+        outcomes = get_store_table(store_folder_path, "outcomes").load_arrays()
+        print("Previously created experiments and outcomes are loaded.")
 
 
     ### Domain criterion ###
     print("\nThe domain criterion is checked:")
     # set thresholds for outcome preferences
-    # threshold values should be set regarding the scale of the outcome
-    thresholds = {'A1_Expected_Annual_Damage': 10000000,
-                  'A1_Dike_Investment_Costs': 20000000, 'A1_Expected_Number_of_Deaths': 1,
-                  'A2_Expected_Annual_Damage': 10000000,
-                  'A2_Dike_Investment_Costs': 20000000, 'A2_Expected_Number_of_Deaths': 1,
-                   'A3_Expected_Annual_Damage': 10000000,
-                   'A3_Dike_Investment_Costs': 20000000, 'A3_Expected_Number_of_Deaths': 1,
-                   'A4_Expected_Annual_Damage': 10000000,
-                   'A4_Dike_Investment_Costs': 20000000, 'A4_Expected_Number_of_Deaths': 1,
-                   'A5_Expected_Annual_Damage': 10000000,
-                   'A5_Dike_Investment_Costs': 20000000, 'A5_Expected_Number_of_Deaths': 1,
-                   'RfR_Total_Costs': 100000000, 'Expected_Evacuation_Costs': 1000000}
+    thresholds = DOMAIN_THRESHOLDS
 
     print("Domain criterion thresholds are set.")
 
     # compare experiment results to thresholds
-    experiments = df_experiments
-    overall_scores = {}
-    for policy in experiments.policy.unique():
-        logical = experiments.policy == policy
-        scores = {}
-        for k, v in outcomes.items():
-            try:
-                # because we want to minimize the outcomes, <= is used to assess whether the value is
-                # under the given threshold
-                n = np.sum(v[logical] <= thresholds[k])
-            except KeyError:
-                continue
-            scores[k] = n / number_of_experiments
-        overall_scores[policy] = scores
-
+    # the outcomes are arranged in a (policy, scenario, outcome) cube once, instead of a mask per policy
+    # because we want to minimize the outcomes, <= is used to assess whether the value is under the given threshold
     # the calculated scores indicate in how many percent of the new scenarios, the outcomes stay under their threshold
+    # policies eliminated by a racing re-evaluation are scored on the scenarios they were tested on
+    if accumulator is not None:
+        # policies that are not evaluated yet have no scores
+        overall_scores = accumulator.domain_criterion().dropna(how="all")
+    else:
+        cube = OutcomeCube.from_experiments(df_experiments, outcomes)
+        overall_scores = cube.domain_criterion(thresholds)
+
     # store the scores
-    overall_scores = pd.DataFrame(overall_scores).T
     scores_file_path = os.path.join("data", "robustness_results", "overall_scores.xlsx")
     overall_scores.to_excel(scores_file_path)
 
@@ -87,51 +100,31 @@ if __name__ == "__main__":
     print("Domain criterion plot will be created and shown.")
 
     # plot threshold compliance
-    limits = parcoords.get_limits(overall_scores)
-    paraxes = parcoords.ParallelAxes(limits)
-    # setup legend and colors
-    legend_handles = []
-    hsv = plt.get_cmap("hsv")
-    colors = hsv(np.linspace(0, 1.0, len(overall_scores)+1))
-    # process data and set legend info
-    for i, (index, row) in enumerate(overall_scores.iterrows()):
-        label = f"Policy {str(index)}"
-        clr = colors[i]
-        paraxes.plot(row.to_frame().T, color=clr, label=label)
-        patch = mpatches.Patch(color=clr, label=label)
-        legend_handles.append(patch)
+    paraxes, legend_handles = plot_policies(overall_scores)
 
     # format figure
-    fig = plt.gcf()
+    fig = paraxes.fig
     fig.set_size_inches(20, 8)
     fig.subplots_adjust(bottom=0.5, left=0.03, right=0.75, top=0.95)
     fig.suptitle("Domain Criterion", fontsize=16, fontweight=800, y=0.98)
-    fig.legend(handles=legend_handles, loc="upper right", fontsize=18)
+    if legend_handles:
+        fig.legend(handles=legend_handles, loc="upper right", fontsize=18)
 
-    # save figure
-    domain_plot_path = os.path.join("data", "robustness_results", "threshold_compliance.png")
-    plt.savefig(domain_plot_path)
-    # show figure
-    plt.show()
+    # save and show figure
+    domain_plot_path = os.path.join("data", "robustness_results", "threshold_compliance")
+    export_figure(fig, [f"{domain_plot_path}.png", f"{domain_plot_path}.svg"], show=SHOW_PLOTS)
 
 
     ### Regret criterion ###
     print("\nThe regret criterion is checked:")
-    # setup a dataframe for the outcomes
-    # we add scenario and policy as additional columns
-    # we need scenario because regret is calculated on a scenario by scenario basis
-    # we add policy because we need to get the maximum regret for each policy.
-
-    # add scenario and policy info to the experiment outcomes
-    outcomes = pd.DataFrame(outcomes)
-    outcomes["scenario"] = experiments.scenario
-    outcomes["policy"] = experiments.policy
-
-    # calculate regret scenario by scenario
-    regret = outcomes.groupby("scenario", group_keys=False).apply(calculate_regret)
-
-    # for all policies, calculate max regret
-    max_regret = regret.groupby("policy").max()
+    # regret is calculated on a scenario by scenario basis, as the difference with the best policy in that
+    # scenario, and the maximum regret is taken over the scenarios of each policy
+    # on the outcome cube of the domain criterion, these are a min over the policies, a subtraction and
+    # a max over the scenarios (max_regret also gives percentile and relative regret)
+    if accumulator is not None:
+        max_regret = accumulator.max_regret().dropna(how="all")
+    else:
+        max_regret = cube.max_regret()
 
     # reorder columns of max regret
     max_regret = max_regret[['A1_Expected_Annual_Damage', 'A1_Dike_Investment_Costs',
@@ -152,33 +145,19 @@ if __name__ == "__main__":
     print("Regret criterion plot will be created and shown.")
 
     # plot regret criterion
-    limits = parcoords.get_limits(max_regret)
-    paraxes = parcoords.ParallelAxes(max_regret)
-    paraxes.plot(max_regret, lw=1, alpha=0.75)
-    # setup legend and colors
-    legend_handles = []
-    color = plt.get_cmap("hsv")
-    colors = color(np.linspace(0, 1.0, len(max_regret)+1))
-    # process data and set legend info
-    for i, (index, row) in enumerate(max_regret.iterrows()):
-        label = f"Policy {str(index)}"
-        clr = colors[i]
-        paraxes.plot(row.to_frame().T, color=clr, label=label)
-        patch = mpatches.Patch(color=clr, label=label)
-        legend_handles.append(patch)
+    paraxes, legend_handles = plot_policies(max_regret)
 
     # format figure
-    fig = plt.gcf()
+    fig = paraxes.fig
     fig.set_size_inches(26, 21)
     fig.subplots_adjust(bottom=0.5, left=0.05, right=0.95, top=0.95)
     fig.suptitle("Regret Criterion", fontsize=16, fontweight=800, y=0.98)
-    fig.legend(handles=legend_handles, loc="lower center", fontsize=18)
+    if legend_handles:
+        fig.legend(handles=legend_handles, loc="lower center", fontsize=18)
 
-    # save figure
-    regret_plot_path = os.path.join("data", "robustness_results", "min_max_regret.png")
-    plt.savefig(regret_plot_path)
-    # show figure
-    plt.show()
+    # save and show figure
+    regret_plot_path = os.path.join("data", "robustness_results", "min_max_regret")
+    export_figure(fig, [f"{regret_plot_path}.png", f"{regret_plot_path}.svg"], show=SHOW_PLOTS)
 
     # end of script
     print("\nMulti-MORDM robustness script is finished.")
@@ -0,0 +1,720 @@
+"""
+Optimization of the levers of a model, one generation at a time.
+
+This does the same as evaluator.optimize with the default EpsNSGAII
+algorithm, but steps the optimizer itself instead of leaving the loop to
+platypus. In between generations, the state of the optimizer can be saved
+to a checkpoint file, from which an interrupted run can be resumed, and
+the run can stop early once its archive no longer improves. The initial
+population can be seeded with known policies instead of random ones.
+
+A FidelitySchedule lets the first part of a run simulate only a few flood
+events, and raises the number of events as the archive stabilizes.
+
+optimize_steady_state is an asynchronous alternative: instead of waiting
+for a whole generation, a new offspring is sent to a worker as soon as
+the worker returns a result.
+"""
+import functools
+import os
+import pickle
+import random
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from ema_workbench import Policy
+from ema_workbench.em_framework.optimization import (
+    CombinedVariator,
+    Convergence,
+    EpsNSGAII,
+    _evaluate_constraints,
+    to_dataframe,
+    to_problem,
+    transform_variables,
+)
+from ema_workbench.em_framework.points import experiment_generator
+from ema_workbench.util import EMAError, get_module_logger
+from platypus import (
+    EpsilonBoxArchive,
+    InjectedPopulation,
+    ParetoDominance,
+    PlatypusConfig,
+    RandomGenerator,
+    Solution,
+    TournamentSelector,
+)
+from platypus.core import EvaluateSolution
+
+from batch_evaluator import evaluate_in_worker
+
+_logger = get_module_logger(__name__)
+
+
+# state of the platypus extensions (adaptive time continuation, logging), which decides when the
+# next restart or log message is due; start_run is not called again on resume
+_EXTENSION_STATE = ("iteration", "last_invocation", "last_restart", "start_time")
+
+
+class _CheckpointPickler(pickle.Pickler):
+    """Pickler leaving out the problem, which is rebuilt on resume"""
+
+    def __init__(self, file, problem):
+        super().__init__(file)
+        self.problem = problem
+
+    def persistent_id(self, obj):
+        if obj is self.problem:
+            return "problem"
+        return None
+
+
+class _CheckpointUnpickler(pickle.Unpickler):
+    def __init__(self, file, problem):
+        super().__init__(file)
+        self.problem = problem
+
+    def persistent_load(self, pid):
+        return self.problem
+
+
+class EarlyStopping:
+    """Stops an optimization when its archive stops improving
+
+    After every generation, the improvement over the last window nfe is
+    compared with the thresholds. The run stops when the epsilon progress
+    (number of solutions that entered a new epsilon box) and, if given,
+    the relative gain of the hypervolume both stay below their threshold.
+
+    Parameters
+    ----------
+    window : int, optional
+             nfe over which the improvement is measured
+    min_epsilon_progress : int, optional
+                           minimum epsilon progress within the window
+    hypervolume : callable, optional
+                  function of the archive returning its hypervolume
+    min_hypervolume_gain : float, optional
+                           minimum relative gain of the hypervolume within
+                           the window
+
+    Attributes
+    ----------
+    stop_nfe : int or None
+               nfe at which the run was stopped
+    reason : str or None
+
+    """
+
+    def __init__(self, window=10000, min_epsilon_progress=1, hypervolume=None,
+                 min_hypervolume_gain=0.001):
+        self.window = window
+        self.min_epsilon_progress = min_epsilon_progress
+        self.hypervolume = hypervolume
+        self.min_hypervolume_gain = min_hypervolume_gain
+        self.history = []
+        self.stop_nfe = None
+        self.reason = None
+
+    def __call__(self, optimizer):
+        """Returns True if the optimizer should stop"""
+        hypervolume = self.hypervolume(optimizer.archive) if self.hypervolume is not None else None
+        self.history.append((optimizer.nfe, optimizer.archive.improvements, hypervolume))
+
+        # compare with the latest generation at least a window ago
+        past = [entry for entry in self.history if entry[0] <= optimizer.nfe - self.window]
+        if not past:
+            return False
+        self.history = self.history[len(past) - 1 :]
+        start_nfe, start_improvements, start_hypervolume = self.history[0]
+
+        epsilon_progress = optimizer.archive.improvements - start_improvements
+        if epsilon_progress >= self.min_epsilon_progress:
+            return False
+        reason = f"epsilon progress {epsilon_progress}"
+
+        if self.hypervolume is not None:
+            gain = (hypervolume - start_hypervolume) / start_hypervolume if start_hypervolume else 0
+            if gain >= self.min_hypervolume_gain:
+                return False
+            reason += f" and hypervolume gain {gain:.2%}"
+
+        self.stop_nfe = optimizer.nfe
+        self.reason = f"{reason} over the last {optimizer.nfe - start_nfe} nfe"
+        return True
+
+
+def _reevaluate(optimizer, evaluator):
+    """Evaluate the population and archive again, e.g. at a new fidelity
+
+    The archive is rebuilt from the re-evaluated solutions. Its count of
+    improvements is kept, so the epsilon progress only reflects the search.
+    Returns the number of evaluations.
+    """
+    solutions = list({id(solution): solution for solution in
+                      list(optimizer.population) + list(optimizer.archive)}.values())
+    for solution in solutions:
+        solution.evaluated = False
+
+    # the convergence metrics are not triggered by re-evaluations
+    callback = evaluator.callback
+    evaluator.callback = lambda: None
+    try:
+        evaluator.evaluate_all([EvaluateSolution(solution) for solution in solutions])
+    finally:
+        evaluator.callback = callback
+
+    improvements = optimizer.archive.improvements
+    optimizer.archive._contents = []
+    for solution in solutions:
+        optimizer.archive.add(solution)
+    optimizer.archive.improvements = improvements
+    return len(solutions)
+
+
+class FidelitySchedule:
+    """Raises the fidelity of the evaluations as the archive stabilizes
+
+    Early on, the ranking of the solutions is coarse anyway, so a run
+    starts by simulating only a few of the flood events of the DikeNetwork.
+    Once the archive stalls at a level, with less than min_epsilon_progress
+    within the last window nfe, the next level is used. Objectives of
+    different fidelities are not comparable, so the population and archive
+    are then re-evaluated at the new level. When the run ends below full
+    fidelity, finish re-evaluates them at full fidelity, so the results
+    are exact.
+
+    The evaluator should have a num_events attribute, like the
+    PolicyBatchEvaluator and SharedPoolEvaluator.
+
+    Parameters
+    ----------
+    levels : list of int or None, optional
+             number of flood events per level, None for all events
+    window : int, optional
+             nfe over which the epsilon progress is measured
+    min_epsilon_progress : int, optional
+                           minimum epsilon progress within the window
+
+    Attributes
+    ----------
+    level : int
+            index of the current level
+    history : list of tuple
+              nfe at which each level started and its number of events
+    reevaluations : int
+                    number of evaluations spent on re-evaluations
+
+    """
+
+    def __init__(self, levels=(5, 10, None), window=5000, min_epsilon_progress=1):
+        self.levels = list(levels)
+        if self.levels[-1] is not None:
+            self.levels.append(None)
+        self.stall = EarlyStopping(window=window, min_epsilon_progress=min_epsilon_progress)
+        self.level = 0
+        self.history = [(0, self.levels[0])]
+        self.reevaluations = 0
+
+    @property
+    def final(self):
+        """Whether the evaluations are at full fidelity"""
+        return self.level == len(self.levels) - 1
+
+    def start(self, evaluator):
+        """Set the fidelity of the current level on the evaluator"""
+        if not hasattr(evaluator, "num_events"):
+            raise EMAError(f"{type(evaluator).__name__} does not support a fidelity schedule")
+        evaluator.num_events = self.levels[self.level]
+
+    def _raise_level(self, optimizer, evaluator, level):
+        self.level = level
+        self.history.append((optimizer.nfe, self.levels[level]))
+        self.stall.history = []
+        evaluator.num_events = self.levels[level]
+        self.reevaluations += _reevaluate(optimizer, evaluator)
+
+        events = self.levels[level] if self.levels[level] is not None else "all"
+        _logger.info(f"fidelity raised to {events} events at {optimizer.nfe} nfe")
+
+    def __call__(self, optimizer, evaluator):
+        """Raises the fidelity if the archive stalled, returns True if it did"""
+        if self.final or not self.stall(optimizer):
+            return False
+        self._raise_level(optimizer, evaluator, self.level + 1)
+        return True
+
+    def finish(self, optimizer, evaluator):
+        """Re-evaluate at full fidelity, if the run is not there yet"""
+        if not self.final:
+            self._raise_level(optimizer, evaluator, len(self.levels) - 1)
+
+
+def to_solutions(policies, problem):
+    """Turn policies into unevaluated platypus solutions of a problem
+
+    Parameters
+    ----------
+    policies : DataFrame
+               with a column per lever, other columns are ignored
+    problem : Problem instance
+
+    Returns
+    -------
+    list of platypus Solutions
+
+    """
+    missing_levers = [name for name in problem.parameter_names if name not in policies.columns]
+    if missing_levers:
+        raise EMAError(f"Levers {missing_levers} not found in policies")
+
+    solutions = []
+    for values in policies[problem.parameter_names].itertuples(index=False):
+        solution = Solution(problem)
+        solution.variables[:] = [
+            platypus_type.encode(value) for platypus_type, value in zip(problem.types, values)
+        ]
+        solutions.append(solution)
+    return solutions
+
+
+def save_checkpoint(checkpoint_file, optimizer, convergence, early_stopping=None, fidelity=None):
+    """Save the state of an optimizer and its convergence metrics
+
+    The state consists of the population and its size, which changes when
+    the adaptive time continuation restarts the search, the archive, the
+    variator, the number of function evaluations, the state of the
+    extensions of the optimizer, the state of the random number generator
+    used by platypus and the convergence history. The checkpoint
+    is written to a temporary file first, so an interruption while saving
+    does not corrupt the previous checkpoint.
+
+    Parameters
+    ----------
+    checkpoint_file : str
+    optimizer : platypus Algorithm instance
+    convergence : Convergence instance
+    early_stopping : EarlyStopping instance, optional
+    fidelity : FidelitySchedule instance, optional
+
+    """
+    state = {
+        "nfe": optimizer.nfe,
+        "population": optimizer.population,
+        "population_size": optimizer.population_size,
+        "archive": optimizer.archive,
+        "variator": optimizer.variator,
+        "extensions": [
+            {name: getattr(extension, name) for name in _EXTENSION_STATE if hasattr(extension, name)}
+            for extension in optimizer._extensions
+        ],
+        "random_state": random.getstate(),
+        "convergence": {
+            "i": convergence.i,
+            "generation": convergence.generation,
+            "index": convergence.index,
+            "last_check": convergence.last_check,
+            "results": [metric.results for metric in convergence.metrics],
+        },
+        "early_stopping": early_stopping.history if early_stopping is not None else None,
+        "fidelity": (
+            {"level": fidelity.level, "history": fidelity.history,
+             "stall": fidelity.stall.history, "reevaluations": fidelity.reevaluations}
+            if fidelity is not None else None
+        ),
+    }
+
+    temporary_file = f"{checkpoint_file}.tmp"
+    with open(temporary_file, "wb") as fh:
+        _CheckpointPickler(fh, optimizer.problem).dump(state)
+    os.replace(temporary_file, checkpoint_file)
+
+    _logger.info(f"checkpoint saved at {optimizer.nfe} nfe")
+
+
+def load_checkpoint(checkpoint_file, optimizer, convergence, early_stopping=None, fidelity=None):
+    """Restore the state of an optimizer and its convergence metrics
+
+    Parameters
+    ----------
+    checkpoint_file : str
+    optimizer : platypus Algorithm instance
+                optimizer for the same problem as the saved one
+    convergence : Convergence instance
+                  with the same metrics as the saved one
+    early_stopping : EarlyStopping instance, optional
+    fidelity : FidelitySchedule instance, optional
+               its level is restored, but not set on the evaluator
+
+    """
+    with open(checkpoint_file, "rb") as fh:
+        state = _CheckpointUnpickler(fh, optimizer.problem).load()
+
+    optimizer.nfe = state["nfe"]
+    optimizer.population = state["population"]
+    optimizer.population_size = state.get("population_size", len(state["population"]))
+    optimizer.archive = state["archive"]
+    optimizer.result = state["archive"]
+    optimizer.variator = state["variator"]
+    # checkpoints of older versions have no extension state, their extensions start over
+    extension_states = state.get("extensions")
+    for i, extension in enumerate(optimizer._extensions):
+        if extension_states is None:
+            extension.start_run(optimizer)
+            continue
+        for name, value in extension_states[i].items():
+            setattr(extension, name, value)
+    random.setstate(state["random_state"])
+
+    convergence_state = state["convergence"]
+    convergence.i = convergence_state["i"]
+    convergence.generation = convergence_state["generation"]
+    convergence.index = convergence_state["index"]
+    convergence.last_check = convergence_state["last_check"]
+    for metric, results in zip(convergence.metrics, convergence_state["results"]):
+        metric.results = results
+        # e.g. the ColumnarArchiveLogger drops the snapshots logged after the checkpoint
+        if hasattr(metric, "resume_from"):
+            metric.resume_from(optimizer.nfe)
+    if not convergence.log_progress:
+        convergence.pbar.update(convergence.i)
+
+    if early_stopping is not None and state["early_stopping"] is not None:
+        early_stopping.history = state["early_stopping"]
+
+    if fidelity is not None and state.get("fidelity") is not None:
+        fidelity.level = state["fidelity"]["level"]
+        fidelity.history = state["fidelity"]["history"]
+        fidelity.stall.history = state["fidelity"]["stall"]
+        fidelity.reevaluations = state["fidelity"]["reevaluations"]
+
+    _logger.info(f"resumed from checkpoint at {optimizer.nfe} nfe")
+
+
+def _initial_generator(problem, initial_policies, population_size):
+    """Generator of the initial population, seeded with the initial policies if given"""
+    if initial_policies is None:
+        return RandomGenerator()
+
+    policies = initial_policies[problem.parameter_names].drop_duplicates()
+    if len(policies) > population_size:
+        policies = policies.iloc[sorted(random.sample(range(len(policies)), population_size))]
+    _logger.info(f"initial population seeded with {len(policies)} policies")
+    return InjectedPopulation(to_solutions(policies, problem))
+
+
+def optimize(model, evaluator, nfe, epsilons, reference=None, convergence=None, constraints=None,
+             convergence_freq=1000, logging_freq=5, checkpoint_file=None, checkpoint_freq=10000,
+             resume=False, early_stopping=None, initial_policies=None, population_size=100,
+             fidelity=None):
+    """Optimize the levers of a model with EpsNSGAII
+
+    Parameters
+    ----------
+    model : Model instance
+    evaluator : evaluator instance
+    nfe : int
+    epsilons : list of float
+    reference : Scenario instance, optional
+    convergence : list of convergence metrics, optional
+    constraints : list of Constraint instances, optional
+    convergence_freq : int, optional
+                       nfe between convergence checks
+    logging_freq : int, optional
+                   number of generations between logging of progress
+    checkpoint_file : str, optional
+                      file to save the state of the optimizer to
+    checkpoint_freq : int, optional
+                      nfe between checkpoints
+    resume : bool, optional
+             if True and the checkpoint file exists, the run continues from
+             the checkpoint instead of starting from a random population
+    early_stopping : EarlyStopping instance, optional
+                     stops the run before nfe is reached once it stalls
+    initial_policies : DataFrame, optional
+                       policies to seed the initial population with, the
+                       remainder of the population is random; if there are
+                       more unique policies than population_size, a random
+                       subset is used
+    population_size : int, optional
+    fidelity : FidelitySchedule instance, optional
+               starts with cheap evaluations, the results are always
+               evaluated at full fidelity; early stopping only applies
+               once at full fidelity
+
+    Returns
+    -------
+    tuple with DataFrame of results and DataFrame of convergence
+
+    Without interruptions, the run evaluates the same generations as
+    evaluator.optimize would. A resumed run gives the same results as an
+    uninterrupted run, also when the adaptive time continuation restarts
+    the search after the checkpoint, as long as nothing else draws from
+    the random number generator in the meantime (e.g. concurrent
+    optimizations in the same process).
+
+    """
+    problem = to_problem(model, "levers", reference=reference, constraints=constraints)
+
+    klass = problem.types[0].__class__
+    variator = None if all(isinstance(t, klass) for t in problem.types) else CombinedVariator()
+    generator = _initial_generator(problem, initial_policies, population_size)
+
+    optimizer = EpsNSGAII(problem, epsilons, population_size=population_size, generator=generator,
+                          evaluator=evaluator, variator=variator, log_frequency=500)
+
+    convergence = Convergence(convergence, nfe, convergence_freq=convergence_freq,
+                              logging_freq=logging_freq)
+    evaluator.callback = functools.partial(convergence, optimizer)
+
+    resumed = resume and checkpoint_file is not None and os.path.exists(checkpoint_file)
+    if resumed:
+        load_checkpoint(checkpoint_file, optimizer, convergence, early_stopping, fidelity)
+    last_checkpoint = optimizer.nfe
+    if fidelity is not None:
+        fidelity.start(evaluator)
+
+    # the extensions of a resumed run continue from their restored state
+    if not resumed:
+        for extension in optimizer._extensions:
+            extension.start_run(optimizer)
+
+    while optimizer.nfe < nfe:
+        for extension in optimizer._extensions:
+            extension.pre_step(optimizer)
+        optimizer.step()
+        for extension in optimizer._extensions:
+            extension.post_step(optimizer)
+
+        if fidelity is not None and not fidelity.final:
+            fidelity(optimizer, evaluator)
+        elif early_stopping is not None and early_stopping(optimizer):
+            _logger.info(f"stopped at {optimizer.nfe} nfe: {early_stopping.reason}")
+            break
+
+        if checkpoint_file is not None and optimizer.nfe >= last_checkpoint + checkpoint_freq:
+            save_checkpoint(checkpoint_file, optimizer, convergence, early_stopping, fidelity)
+            last_checkpoint = optimizer.nfe
+
+    for extension in optimizer._extensions:
+        extension.end_run(optimizer)
+
+    if fidelity is not None:
+        fidelity.finish(optimizer, evaluator)
+
+    convergence(optimizer, force=True)
+
+    results = to_dataframe(optimizer.result, problem.parameter_names, problem.outcome_names)
+    convergence = convergence.to_dataframe()
+
+    _logger.info(f"optimization completed, found {len(optimizer.archive)} solutions")
+
+    return results, convergence
+
+
+class SteadyStateEpsNSGAII:
+    """Asynchronous steady-state variant of EpsNSGAII
+
+    Like the Borg MOEA, every worker evaluates one solution at a time and
+    gets a new offspring as soon as it returns its result, so no worker
+    waits for the slowest evaluation of a generation. Because a batched
+    DikeNetwork run is much cheaper per policy, a worker can be given a
+    small batch of offspring at a time instead. An evaluated
+    offspring replaces a random population member it dominates, or a
+    random member if it is nondominated, and is otherwise discarded. It
+    is also offered to the epsilon-box archive. Parents are one random
+    archive member and one population member chosen by tournament.
+
+    Has the nfe, population, archive and result attributes of a platypus
+    algorithm, so the convergence metrics and EarlyStopping work on it.
+
+    Parameters
+    ----------
+    problem : Problem instance
+    epsilons : list of float
+    evaluator : SharedPoolEvaluator instance
+    n_workers : int
+                number of batches in progress at the same time
+    population_size : int, optional
+    batch_size : int, optional
+                 number of solutions per batch
+    generator : Generator, optional
+    variator : Variator, optional
+
+    """
+
+    def __init__(self, problem, epsilons, evaluator, n_workers, population_size=100,
+                 batch_size=1, generator=None, variator=None):
+        self.problem = problem
+        self.evaluator = evaluator
+        self.model = evaluator._msis[0]
+        self.n_workers = n_workers
+        self.population_size = population_size
+        self.batch_size = batch_size
+        self.generator = generator if generator is not None else RandomGenerator()
+        self.variator = variator if variator is not None else PlatypusConfig.default_variator(problem)
+        self.selector = TournamentSelector(2)
+        self.dominance = ParetoDominance()
+
+        self.nfe = 0
+        self.population = []
+        self.archive = EpsilonBoxArchive(epsilons)
+        self.result = self.archive
+        self._submitted = 0
+        self._offspring = []
+
+    def _next_solution(self):
+        # with more batches in progress than fit in the initial population, the first offspring are needed
+        # before any result has come back, so there is nothing to breed from yet
+        if self._submitted < self.population_size or not self.population:
+            return self.generator.generate(self.problem)
+
+        if not self._offspring:
+            parents = [random.choice(self.archive) if len(self.archive) else
+                       self.selector.select_one(self.population),
+                       self.selector.select_one(self.population)]
+            self._offspring = self.variator.evolve(parents)
+        return self._offspring.pop()
+
+    def _submit(self, nfe):
+        """Submit a batch of new solutions, without exceeding nfe submissions
+
+        The batch is evaluated at the current number of events of the
+        evaluator, which is returned with the future and the batch.
+        """
+        solutions, policies = [], []
+        for _ in range(min(self.batch_size, nfe - self._submitted)):
+            solution = self._next_solution()
+            values = transform_variables(self.problem, solution.variables)
+            solutions.append(solution)
+            policies.append(Policy(str(self._submitted), **dict(zip(self.problem.parameter_names, values))))
+            self._submitted += 1
+
+        experiments = list(experiment_generator([self.problem.reference], [self.model], policies))
+        num_events = self.evaluator.num_events
+        future = self.evaluator.pool.submit(evaluate_in_worker, self.model.name, experiments, num_events)
+        return future, (num_events, list(zip(solutions, experiments)))
+
+    def _evaluate(self, solution, experiment, outcomes):
+        """Set the objectives and constraints of a solution like the workbench does"""
+        objectives = [outcomes[name] for name in self.problem.outcome_names]
+        constraints = _evaluate_constraints({**experiment.scenario, **experiment.policy}, outcomes,
+                                            self.problem.ema_constraints)
+
+        if constraints:
+            self.problem.function = lambda _: (objectives, constraints)
+        else:
+            self.problem.function = lambda _: objectives
+        solution.evaluate()
+
+    def _add(self, solution):
+        """Steady-state replacement in the population, and update of the archive"""
+        self.archive.add(solution)
+
+        if len(self.population) < self.population_size:
+            self.population.append(solution)
+            return
+
+        flags = [self.dominance.compare(solution, member) for member in self.population]
+        dominated = [i for i, flag in enumerate(flags) if flag < 0]
+        if dominated:
+            self.population[random.choice(dominated)] = solution
+        elif not any(flag > 0 for flag in flags):
+            self.population[random.randrange(len(self.population))] = solution
+
+    def run(self, nfe, callback=None):
+        """Run until nfe solutions are evaluated or the callback returns True
+
+        Offspring that were evaluated at another fidelity than the current
+        one, because the fidelity changed in the meantime, are discarded.
+        """
+        in_flight = {}
+        while len(in_flight) < self.n_workers and self._submitted < nfe:
+            future, batch = self._submit(nfe)
+            in_flight[future] = batch
+        stop = False
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                num_events, batch = in_flight.pop(future)
+                outcomes, busy_time = future.result()
+                self.evaluator.busy_time += busy_time
+
+                for (solution, experiment), outcome in zip(batch, outcomes):
+                    self.nfe += 1
+                    if num_events == self.evaluator.num_events:
+                        self._evaluate(solution, experiment, outcome)
+                        self._add(solution)
+
+                    if callback is not None and callback(self):
+                        stop = True
+                if not stop and self._submitted < nfe:
+                    future, batch = self._submit(nfe)
+                    in_flight[future] = batch
+
+
+def optimize_steady_state(model, evaluator, nfe, epsilons, reference=None, convergence=None,
+                          constraints=None, convergence_freq=1000, logging_freq=5, early_stopping=None,
+                          initial_policies=None, population_size=100, n_workers=None, batch_size=1,
+                          fidelity=None):
+    """Optimize the levers of a model with the asynchronous SteadyStateEpsNSGAII
+
+    Takes the same arguments as optimize, except for checkpointing, which
+    is not supported because evaluations are in progress at any moment.
+
+    Parameters
+    ----------
+    evaluator : SharedPoolEvaluator instance
+                its process pool runs the evaluations
+    n_workers : int, optional
+                number of batches in progress at the same time,
+                defaults to the number of cpu's
+    batch_size : int, optional
+                 number of solutions a worker evaluates at a time
+    fidelity : FidelitySchedule instance, optional
+
+    Returns
+    -------
+    tuple with DataFrame of results and DataFrame of convergence
+
+    """
+    problem = to_problem(model, "levers", reference=reference, constraints=constraints)
+
+    klass = problem.types[0].__class__
+    variator = None if all(isinstance(t, klass) for t in problem.types) else CombinedVariator()
+    generator = _initial_generator(problem, initial_policies, population_size)
+    n_workers = n_workers if n_workers is not None else os.cpu_count()
+
+    optimizer = SteadyStateEpsNSGAII(problem, epsilons, evaluator, n_workers,
+                                     population_size=population_size, batch_size=batch_size,
+                                     generator=generator, variator=variator)
+    convergence = Convergence(convergence, nfe, convergence_freq=convergence_freq,
+                              logging_freq=logging_freq)
+
+    if fidelity is not None:
+        fidelity.start(evaluator)
+
+    def callback(optimizer):
+        convergence(optimizer)
+        # check the fidelity and early stopping once per population size of evaluations
+        if optimizer.nfe % population_size != 0:
+            return False
+        if fidelity is not None and not fidelity.final:
+            fidelity(optimizer, evaluator)
+        # the evaluations still in progress after a stop are drained through this callback, they should not
+        # check again and overwrite the nfe and reason of the stop
+        elif early_stopping is not None and early_stopping.stop_nfe is None and early_stopping(optimizer):
+            _logger.info(f"stopped at {optimizer.nfe} nfe: {early_stopping.reason}")
+            return True
+        return False
+
+    optimizer.run(nfe, callback)
+    if fidelity is not None:
+        fidelity.finish(optimizer, evaluator)
+    convergence(optimizer, force=True)
+
+    results = to_dataframe(optimizer.result, problem.parameter_names, problem.outcome_names)
+    convergence = convergence.to_dataframe()
+
+    _logger.info(f"optimization completed, found {len(optimizer.archive)} solutions")
+
+    return results, convergence
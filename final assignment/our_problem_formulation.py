@@ -1,3 +1,4 @@
+import functools
 from dike_model_function import DikeNetwork
 from problem_formulation import sum_over
 from ema_workbench import (
@@ -8,11 +9,45 @@ from ema_workbench import (
     RealParameter,
     CategoricalParameter,
     Scenario,
+    Constraint,
 )
 
+
+# Outcomes that only depend on the levers, summed up for the budget
+INVESTMENT_OUTCOMES = [f"A{i}_Dike_Investment_Costs" for i in range(1, 6)] + [
+    "RfR_Total_Costs"
+]
+
+
+def budget_exceedance(budget, *costs):
+    """Amount by which the total investment costs exceed the budget"""
+    return max(0, sum(costs) - budget)
+
+
+def get_budget_constraint(budget, model):
+    """Optimization constraint for policies exceeding the investment budget
+
+    The constraint sums the investment outcomes of the model, so with the
+    'local' scope only the costs of Dike Rings 1 and 2 and the RfR costs
+    count, while DikeNetwork.budget rejects policies on the costs of all
+    dike rings.
+    """
+    outcome_names = [o.name for o in model.outcomes if o.name in INVESTMENT_OUTCOMES]
+    return Constraint(
+        "investment budget",
+        outcome_names=outcome_names,
+        function=functools.partial(budget_exceedance, budget),
+    )
+
+
 # Load the model:
-def get_model_for_problem_formulation():
+# budget: maximum total investment costs [euro], over-budget policies are
+# rejected before their flood simulation (see DikeNetwork.budget)
+# scope: 'broad' for the outcomes of all dike rings, 'local' for Dike Rings 1 and 2
+# (and the RfR costs) only, as in the subspace notebook
+def get_model_for_problem_formulation(budget=None, scope="broad"):
     function = DikeNetwork()
+    function.budget = budget
     model = Model("dikesnet", function=function)
 
     model.uncertainties = [
@@ -102,7 +137,7 @@ def get_model_for_problem_formulation():
     ]
 
     direction = ScalarOutcome.MINIMIZE
-    model.outcomes = [
+    outcomes = [
         ScalarOutcome(
             "A1_Expected_Annual_Damage",
             variable_name="A.1_Expected Annual Damage",
@@ -207,4 +242,11 @@ def get_model_for_problem_formulation():
         ),
     ]
 
+    if scope == "local":
+        outcomes = [o for o in outcomes if o.name.startswith(("A1_", "A2_", "RfR_"))]
+    model.outcomes = outcomes
+
+    # only route the flood wave as far downstream as the outcomes need
+    function.limit_to_outcomes([name for o in model.outcomes for name in o.variable_name])
+
     return model, function.planning_steps
@@ -0,0 +1,158 @@
+"""
+Racing of policies during their re-evaluation on new scenarios.
+
+Instead of testing every policy on all scenarios, the scenarios are
+evaluated in increments and policies that are statistically out of
+contention stop being evaluated. Contention is judged on the domain
+criterion of multi_MORDM_robustness.py: the fraction of scenarios in
+which an outcome stays under its threshold.
+"""
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+
+class PolicyRace:
+    """Running robustness estimates of racing policies
+
+    After each increment of scenarios, the domain criterion scores of the
+    policies that are still racing are estimated with a Wilson confidence
+    interval. A policy is eliminated when another racing policy scores at
+    least as well on every outcome and better on at least one, both with
+    confidence. Because all racing policies are evaluated on the same
+    scenarios, this is tested on the paired per-scenario differences, with
+    a Bonferroni correction over the outcomes.
+
+    The max regret of a policy is the maximum over its scenarios of the
+    difference with the best outcome among the policies evaluated on the
+    same scenario. It can only grow with more scenarios, so the running
+    value is a lower bound; with the given confidence, at most a fraction
+    exceedance of the scenarios has a higher regret.
+
+    Parameters
+    ----------
+    policies : list of str
+               names of the policies
+    thresholds : dict
+                 outcome name to the threshold it should stay under
+    confidence : float, optional
+    min_scenarios : int, optional
+                    number of scenarios before any policy is eliminated
+
+    Attributes
+    ----------
+    active : list of str
+             policies that are still racing
+    log : list of dict
+          eliminated policies, the number of scenarios they were
+          evaluated on and the policy that dominated them
+
+    """
+
+    def __init__(self, policies, thresholds, confidence=0.95, min_scenarios=100):
+        self.policies = list(policies)
+        self.outcome_names = list(thresholds)
+        self.thresholds = np.array([thresholds[name] for name in self.outcome_names], dtype=float)
+        self.confidence = confidence
+        self.min_scenarios = min_scenarios
+
+        n_policies, n_outcomes = len(self.policies), len(self.outcome_names)
+        self.active = list(self.policies)
+        self.n_scenarios = np.zeros(n_policies, dtype=np.int64)
+        # number of scenarios under the threshold, and of those shared with every other policy
+        self.satisfied = np.zeros((n_policies, n_outcomes), dtype=np.int64)
+        self.jointly_satisfied = np.zeros((n_policies, n_policies, n_outcomes), dtype=np.int64)
+        self.max_regret = np.zeros((n_policies, n_outcomes))
+        self.log = []
+
+    def update(self, policies, outcomes):
+        """Add the outcomes of the racing policies on an increment of scenarios
+
+        Parameters
+        ----------
+        policies : list of str
+                   the racing policies, in the order of the outcomes
+        outcomes : dict
+                   outcome name to an array of shape (policies, scenarios)
+
+        Returns
+        -------
+        list of the policies eliminated after this increment
+
+        """
+        index = np.array([self.policies.index(policy) for policy in policies])
+        values = np.stack([np.asarray(outcomes[name], dtype=float) for name in self.outcome_names], axis=-1)
+        n_scenarios = values.shape[1]
+
+        # domain criterion: outcomes under their threshold, [policy, scenario, outcome]
+        satisfied = values <= self.thresholds
+        self.n_scenarios[index] += n_scenarios
+        self.satisfied[index] += satisfied.sum(axis=1)
+        self.jointly_satisfied[np.ix_(index, index)] += np.einsum(
+            "psk,qsk->pqk", satisfied.astype(np.int64), satisfied.astype(np.int64)
+        )
+
+        # regret against the best racing policy of each scenario
+        regret = values - values.min(axis=0, keepdims=True)
+        self.max_regret[index] = np.maximum(self.max_regret[index], regret.max(axis=1))
+
+        if self.n_scenarios[index].min() < self.min_scenarios:
+            return []
+        return self._eliminate(index)
+
+    def _eliminate(self, index):
+        """Eliminate the racing policies that are dominated with confidence"""
+        n = self.n_scenarios[index][:, None, None]
+        counts = self.satisfied[index]
+        joint = self.jointly_satisfied[np.ix_(index, index)]
+
+        # paired differences of the indicators of q and p: mean and variance over the scenarios
+        mean = (counts[None, :, :] - counts[:, None, :]) / n
+        disagree = (counts[None, :, :] + counts[:, None, :] - 2 * joint) / n
+        stderr = np.sqrt(np.maximum(disagree - mean**2, 0) / n)
+
+        z = norm.ppf(1 - (1 - self.confidence) / len(self.outcome_names))
+        lower = mean - z * stderr
+        # dominated[p, q]: q is at least as good on all outcomes and better on one
+        dominated = np.all(lower >= 0, axis=2) & np.any(lower > 0, axis=2)
+
+        eliminated = []
+        for i, p in enumerate(index):
+            dominating = [index[j] for j in np.flatnonzero(dominated[i])
+                          if self.policies[index[j]] in self.active]
+            if dominating:
+                policy = self.policies[p]
+                self.active.remove(policy)
+                self.log.append({"policy": policy, "scenarios": int(self.n_scenarios[p]),
+                                 "dominated by": self.policies[dominating[0]]})
+                eliminated.append(policy)
+        return eliminated
+
+    def scores(self):
+        """Domain criterion scores with their Wilson confidence interval
+
+        Returns
+        -------
+        DataFrame with a row per policy and outcome
+
+        """
+        n = np.maximum(self.n_scenarios[:, None], 1)
+        fraction = self.satisfied / n
+        z = norm.ppf(0.5 + self.confidence / 2)
+
+        center = (fraction + z**2 / (2 * n)) / (1 + z**2 / n)
+        half_width = z * np.sqrt(fraction * (1 - fraction) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+
+        exceedance = 1 - (1 - self.confidence) ** (1 / np.maximum(self.n_scenarios, 1))
+        df = pd.DataFrame({
+            "policy": np.repeat(self.policies, len(self.outcome_names)),
+            "outcome": np.tile(self.outcome_names, len(self.policies)),
+            "scenarios": np.repeat(self.n_scenarios, len(self.outcome_names)),
+            "score": fraction.ravel(),
+            "score_low": (center - half_width).ravel(),
+            "score_high": (center + half_width).ravel(),
+            "max_regret": self.max_regret.ravel(),
+            "max_regret_exceedance": np.repeat(exceedance, len(self.outcome_names)),
+            "racing": np.repeat([policy in self.active for policy in self.policies], len(self.outcome_names)),
+        })
+        return df
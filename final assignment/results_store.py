@@ -0,0 +1,261 @@
+"""
+Columnar on-disk storage of experiments and outcomes.
+
+A table is a directory with one npy file per column, to which rows are
+appended block by block, so results can be saved while the experiments
+are still running without keeping them in memory. Text columns, like the
+scenario and policy names, are stored as integer codes into a list of
+categories. The number of committed rows is kept in a small json file
+that is replaced after every block. When a table is opened again, its
+columns are cut back to that number, so a block that was interrupted
+while being written is dropped.
+
+Tables are loaded with memory-mapped columns, optionally only a
+projection of them, and can be exported to csv files.
+"""
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+import pandas as pd
+
+# start of a version 1.0 npy file, followed by the length of the header
+_NPY_PREFIX = b"\x93NUMPY\x01\x00"
+# room reserved in the header for the number of rows
+_MAX_ROWS = 10**15
+
+
+def npy_header(dtype, rows):
+    """Header of a one dimensional npy file, padded so it can hold up to _MAX_ROWS rows"""
+    descr = np.lib.format.dtype_to_descr(dtype)
+
+    def header_dict(rows):
+        return repr({"descr": descr, "fortran_order": False, "shape": (rows,)}).encode("latin1")
+
+    # the header has a fixed length, so it can be rewritten in place when rows are added
+    length = len(_NPY_PREFIX) + 2 + len(header_dict(_MAX_ROWS)) + 1
+    header_length = length + (-length % 64) - len(_NPY_PREFIX) - 2
+
+    header = header_dict(rows)
+    header += b" " * (header_length - len(header) - 1) + b"\n"
+    return _NPY_PREFIX + struct.pack("<H", header_length) + header
+
+
+def append_npy(filename, values):
+    """Append a one dimensional array to a npy file, which is created if it does not exist"""
+    values = np.ascontiguousarray(values)
+    if not os.path.exists(filename):
+        with open(filename, "wb") as fh:
+            fh.write(npy_header(values.dtype, 0))
+
+    header_length = len(npy_header(values.dtype, 0))
+    with open(filename, "r+b") as fh:
+        rows = (fh.seek(0, os.SEEK_END) - header_length) // values.dtype.itemsize
+        fh.write(values.tobytes())
+        fh.seek(0)
+        fh.write(npy_header(values.dtype, rows + len(values)))
+
+
+def truncate_npy(filename, rows):
+    """Keep the first rows of a npy file written by append_npy"""
+    dtype = np.load(filename, mmap_mode="r").dtype
+    header_length = len(npy_header(dtype, 0))
+    with open(filename, "r+b") as fh:
+        fh.truncate(header_length + rows * dtype.itemsize)
+        fh.seek(0)
+        fh.write(npy_header(dtype, rows))
+
+
+def _to_python(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class ColumnTable:
+    """Table stored as one npy file per column, appended in blocks
+
+    Parameters
+    ----------
+    directory : str
+                created if it does not exist, an existing table is
+                opened and cut back to its committed rows
+
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.meta_file = os.path.join(self.directory, "table.json")
+        os.makedirs(self.directory, exist_ok=True)
+
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as fh:
+                self.meta = json.load(fh)
+            self.truncate(self.rows)
+        else:
+            self.meta = {"rows": 0, "dtypes": {}, "categories": {}}
+
+    @property
+    def rows(self):
+        return self.meta["rows"]
+
+    @property
+    def columns(self):
+        return list(self.meta["dtypes"])
+
+    def _column_file(self, name):
+        return os.path.join(self.directory, f"{name}.npy")
+
+    def _save_meta(self):
+        temporary_file = f"{self.meta_file}.tmp"
+        with open(temporary_file, "w") as fh:
+            json.dump(self.meta, fh)
+        os.replace(temporary_file, self.meta_file)
+
+    def _encode(self, name, values):
+        """Codes of text or categorical values, adding new values to the categories"""
+        categories = self.meta["categories"].setdefault(name, [])
+        known = set(categories)
+        # missing values are stored as code -1
+        categories += [_to_python(value) for value in pd.unique(values)
+                       if pd.notna(value) and _to_python(value) not in known]
+        return pd.Categorical(values, categories=categories).codes.astype(np.int32)
+
+    def append(self, df):
+        """Append the rows of a DataFrame and commit them
+
+        Parameters
+        ----------
+        df : DataFrame
+             with the same columns as the earlier blocks
+
+        """
+        if len(df) == 0:
+            return
+        if not self.meta["dtypes"]:
+            for name in df.columns:
+                is_text = df[name].dtype == object or isinstance(df[name].dtype, pd.CategoricalDtype)
+                self.meta["dtypes"][name] = "category" if is_text else df[name].dtype.str
+        elif list(df.columns) != self.columns:
+            raise ValueError(f"columns {list(df.columns)} do not match the table columns {self.columns}")
+        else:
+            self._check_dtypes(df)
+
+        for name, dtype in self.meta["dtypes"].items():
+            if dtype == "category":
+                values = self._encode(name, df[name])
+            else:
+                values = df[name].to_numpy(dtype=dtype)
+            append_npy(self._column_file(name), values)
+
+        self.meta["rows"] += len(df)
+        self._save_meta()
+
+    def _check_dtypes(self, df):
+        """Raise if a block has values that do not fit the dtypes of the table columns"""
+        for name, dtype in self.meta["dtypes"].items():
+            if dtype == "category":
+                continue
+            block_dtype = df[name].dtype
+            if block_dtype == object or isinstance(block_dtype, pd.CategoricalDtype):
+                raise ValueError(f"column {name} has text values, but is stored as {np.dtype(dtype)}")
+            if not np.can_cast(block_dtype, np.dtype(dtype), casting="same_kind"):
+                raise ValueError(f"column {name} has {block_dtype} values, but is stored as {np.dtype(dtype)}")
+
+    def truncate(self, rows):
+        """Keep the first rows of the table"""
+        for name in self.columns:
+            if os.path.exists(self._column_file(name)):
+                truncate_npy(self._column_file(name), rows)
+        self.meta["rows"] = rows
+        self._save_meta()
+
+    @classmethod
+    def from_dataframe(cls, directory, df):
+        """Write a DataFrame to a new table, replacing an existing one"""
+        shutil.rmtree(os.path.abspath(directory), ignore_errors=True)
+        table = cls(directory)
+        table.append(df)
+        return table
+
+    @classmethod
+    def from_csv(cls, directory, filename, categorical=(), dtype=None, chunksize=100000):
+        """Import a csv file to a new table, chunksize rows at a time
+
+        Parameters
+        ----------
+        directory : str
+        filename : str
+        categorical : collection of str, optional
+                      columns to store as categoricals, on top of the text
+                      columns
+        dtype : str or numpy dtype, optional
+                dtype of the other columns, e.g. float64 for outcomes; by
+                default it is inferred from the first chunk, and a later
+                chunk that does not fit it raises a ValueError
+        chunksize : int, optional
+
+        """
+        columns = pd.read_csv(filename, nrows=0).columns
+        dtypes = {name: object if name in categorical else dtype for name in columns
+                  if name in categorical or dtype is not None}
+
+        shutil.rmtree(os.path.abspath(directory), ignore_errors=True)
+        table = cls(directory)
+        for chunk in pd.read_csv(filename, chunksize=chunksize, dtype=dtypes):
+            table.append(chunk)
+        return table
+
+    def _check_columns(self, columns):
+        columns = self.columns if columns is None else list(columns)
+        missing = [name for name in columns if name not in self.meta["dtypes"]]
+        if missing:
+            raise KeyError(f"columns {missing} not in the table")
+        return columns
+
+    def load_arrays(self, columns=None):
+        """Memory-map columns of the table
+
+        Parameters
+        ----------
+        columns : list of str, optional
+                  columns to load, all columns by default
+
+        Returns
+        -------
+        dict with a numpy memmap per column, text columns as a Categorical
+
+        """
+        arrays = {}
+        for name in self._check_columns(columns):
+            values = np.load(self._column_file(name), mmap_mode="r")
+            if self.meta["dtypes"][name] == "category":
+                values = pd.Categorical.from_codes(values, self.meta["categories"][name])
+            arrays[name] = values
+        return arrays
+
+    def load(self, columns=None):
+        """Load columns of the table as a DataFrame, text columns become categoricals
+
+        Parameters
+        ----------
+        columns : list of str, optional
+                  columns to load, all columns by default
+
+        """
+        columns = self._check_columns(columns)
+        return pd.DataFrame(self.load_arrays(columns), columns=columns)
+
+    def to_csv(self, filename, chunksize=100000):
+        """Export the table to a csv file, chunksize rows at a time"""
+        columns = {name: np.load(self._column_file(name), mmap_mode="r") for name in self.columns}
+        for start in range(0, max(self.rows, 1), chunksize):
+            chunk = {}
+            for name, values in columns.items():
+                values = np.asarray(values[start:start + chunksize])
+                if self.meta["dtypes"][name] == "category":
+                    values = pd.Categorical.from_codes(values, self.meta["categories"][name])
+                chunk[name] = values
+            pd.DataFrame(chunk, columns=self.columns).to_csv(
+                filename, mode="w" if start == 0 else "a", header=start == 0, index=False
+            )
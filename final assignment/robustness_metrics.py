@@ -0,0 +1,438 @@
+"""
+Robustness metrics on a (policy, scenario, outcome) cube.
+
+The outcomes of the re-evaluation experiments are arranged once in a
+dense cube, with a row per policy and a column per scenario, after which
+the robustness metrics of all policies and outcomes are computed with
+broadcasting instead of a boolean mask per policy. Experiments that were
+not run, like the scenarios a policy was eliminated for in a racing
+re-evaluation, are NaN in the cube and do not count for that policy.
+
+The same metrics can be accumulated while the experiments are running,
+block by block, with a RobustnessAccumulator, so they are available
+during a long re-evaluation without reading the outcomes back.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+# thresholds of the outcome preferences for the domain criterion
+# threshold values should be set regarding the scale of the outcome
+DOMAIN_THRESHOLDS = {'A1_Expected_Annual_Damage': 10000000,
+                     'A1_Dike_Investment_Costs': 20000000, 'A1_Expected_Number_of_Deaths': 1,
+                     'A2_Expected_Annual_Damage': 10000000,
+                     'A2_Dike_Investment_Costs': 20000000, 'A2_Expected_Number_of_Deaths': 1,
+                     'A3_Expected_Annual_Damage': 10000000,
+                     'A3_Dike_Investment_Costs': 20000000, 'A3_Expected_Number_of_Deaths': 1,
+                     'A4_Expected_Annual_Damage': 10000000,
+                     'A4_Dike_Investment_Costs': 20000000, 'A4_Expected_Number_of_Deaths': 1,
+                     'A5_Expected_Annual_Damage': 10000000,
+                     'A5_Dike_Investment_Costs': 20000000, 'A5_Expected_Number_of_Deaths': 1,
+                     'RfR_Total_Costs': 100000000, 'Expected_Evacuation_Costs': 1000000}
+
+
+class OutcomeCube:
+    """Outcomes of experiments as a (policy, scenario, outcome) array
+
+    Parameters
+    ----------
+    values : ndarray
+             of shape (policies, scenarios, outcomes), NaN for experiments
+             that were not run
+    policies : Index
+    scenarios : Index
+    outcome_names : list of str
+
+    """
+
+    def __init__(self, values, policies, scenarios, outcome_names):
+        self.values = values
+        self.policies = pd.Index(policies, name="policy")
+        self.scenarios = pd.Index(scenarios, name="scenario")
+        self.outcome_names = list(outcome_names)
+
+    @classmethod
+    def from_experiments(cls, experiments, outcomes, outcome_names=None, dtype=float):
+        """Arrange the outcomes of experiments in a cube
+
+        Parameters
+        ----------
+        experiments : DataFrame
+                      with a policy and a scenario column, one row per
+                      experiment
+        outcomes : dict or DataFrame
+                   outcome name to an array with a value per experiment
+        outcome_names : list of str, optional
+                        outcomes to include, all outcomes by default
+        dtype : dtype, optional
+                float32 halves the memory of the cube
+
+        Returns
+        -------
+        OutcomeCube with the policies and scenarios in order of appearance
+
+        """
+        outcome_names = list(outcomes) if outcome_names is None else list(outcome_names)
+        policy_codes, policies = pd.factorize(experiments["policy"])
+        scenario_codes, scenarios = pd.factorize(experiments["scenario"])
+
+        values = np.full((len(policies), len(scenarios), len(outcome_names)), np.nan, dtype=dtype)
+        for k, name in enumerate(outcome_names):
+            values[policy_codes, scenario_codes, k] = outcomes[name]
+        return cls(values, np.asarray(policies), np.asarray(scenarios), outcome_names)
+
+    def _threshold_array(self, thresholds):
+        """Outcome names with a threshold and their thresholds, in the order of the cube"""
+        names = [name for name in self.outcome_names if name in thresholds]
+        index = [self.outcome_names.index(name) for name in names]
+        return names, index, np.array([thresholds[name] for name in names], dtype=self.values.dtype)
+
+    def domain_criterion(self, thresholds):
+        """Fraction of its scenarios in which each outcome of a policy stays under its threshold
+
+        Parameters
+        ----------
+        thresholds : dict
+                     outcome name to the threshold it should stay under,
+                     outcomes without a threshold are left out
+
+        Returns
+        -------
+        DataFrame with a row per policy and a column per outcome
+
+        """
+        names, index, threshold_values = self._threshold_array(thresholds)
+        values = self.values[:, :, index]
+
+        # experiments that were not run are NaN, which counts in neither the satisfied nor the evaluated count
+        satisfied = np.count_nonzero(values <= threshold_values, axis=1)
+        evaluated = np.count_nonzero(~np.isnan(values), axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scores = satisfied / evaluated
+        return pd.DataFrame(scores, index=self.policies, columns=names)
+
+    def regret(self, relative=False):
+        """Regret of each experiment: the difference with the best policy in the same scenario
+
+        Parameters
+        ----------
+        relative : bool, optional
+                   divide the regret by the magnitude of the best outcome,
+                   which gives inf for the other policies where the best
+                   outcome is 0
+
+        Returns
+        -------
+        ndarray of shape (policies, scenarios, outcomes)
+
+        """
+        # all the outcomes are minimized, experiments that were not run are skipped
+        with np.errstate(invalid="ignore", divide="ignore"):
+            best = np.nanmin(self.values, axis=0, keepdims=True)
+            regret = self.values - best
+            if relative:
+                regret = np.where(regret == 0, 0, regret / np.abs(best))
+        return regret
+
+    def max_regret(self, percentile=None, relative=False):
+        """Maximum, or a percentile, of the regret of each policy over its scenarios
+
+        Parameters
+        ----------
+        percentile : float, optional
+                     percentile between 0 and 100, the maximum by default
+        relative : bool, optional
+                   use the relative regret, see regret
+
+        Returns
+        -------
+        DataFrame with a row per policy and a column per outcome
+
+        """
+        regret = self.regret(relative=relative)
+        with np.errstate(invalid="ignore"):
+            if percentile is None:
+                values = np.nanmax(regret, axis=1)
+            else:
+                values = _nanpercentile(regret, percentile, axis=1)
+        return pd.DataFrame(values, index=self.policies, columns=self.outcome_names)
+
+
+def _nanpercentile(values, percentile, axis):
+    """Percentile with linear interpolation that skips NaN, like np.nanpercentile
+
+    np.nanpercentile handles the slices with NaN one by one, so the values
+    are sorted in place instead, which puts the NaN at the end of each slice.
+    """
+    values.sort(axis=axis)
+    n = np.count_nonzero(~np.isnan(values), axis=axis)
+    position = np.expand_dims(percentile / 100 * np.maximum(n - 1, 0), axis)
+    below = np.floor(position).astype(np.intp)
+    above = np.minimum(below + 1, np.expand_dims(np.maximum(n - 1, 0), axis))
+
+    low = np.take_along_axis(values, below, axis)
+    high = np.take_along_axis(values, above, axis)
+    result = np.squeeze(low + (high - low) * (position - below), axis)
+    return np.where(n > 0, result, np.nan)
+
+
+class StreamingQuantiles:
+    """P-square estimates of percentiles, for many streams of observations at once
+
+    Every stream keeps five markers per percentile, which are adjusted
+    with each observation (Jain and Chlamtac, 1985), so the percentiles
+    are estimated without storing the observations. The streams are
+    updated together with numpy, one observation per stream at a time.
+
+    Parameters
+    ----------
+    n_streams : int
+    percentiles : list of float
+                  percentiles between 0 and 100
+
+    """
+
+    def __init__(self, n_streams, percentiles):
+        self.percentiles = list(percentiles)
+        p = np.array(self.percentiles, dtype=float)[:, None, None] / 100
+        # marker heights and positions, and the desired positions and their increments
+        self.heights = np.full((len(p), n_streams, 5), np.nan)
+        self.positions = np.tile(np.arange(1.0, 6.0), (len(p), n_streams, 1))
+        self.increments = np.concatenate([np.zeros_like(p), p / 2, p, (1 + p) / 2, np.ones_like(p)], axis=-1)
+        self.desired = np.broadcast_to(1 + 4 * self.increments, self.heights.shape).copy()
+        self.count = np.zeros(n_streams, dtype=np.int64)
+
+    def update(self, streams, values):
+        """Add an observation to each of the given streams
+
+        Parameters
+        ----------
+        streams : array of int
+                  distinct stream indices
+        values : array of float
+                 an observation per stream
+
+        """
+        heights = self.heights[:, streams]
+        positions = self.positions[:, streams]
+        desired = self.desired[:, streams]
+        count = self.count[streams]
+
+        # the first five observations become the markers
+        filling = np.flatnonzero(count < 5)
+        heights[:, filling, count[filling]] = values[filling]
+        full = filling[count[filling] == 4]
+        heights[:, full] = np.sort(heights[:, full], axis=-1)
+
+        running = np.flatnonzero(count >= 5)
+        h, n, d = heights[:, running], positions[:, running], desired[:, running]
+        x = values[running][None, :]
+
+        # marker cell of the observation, the outer markers are moved to it if it falls outside
+        k = np.clip(np.count_nonzero(h <= x[..., None], axis=-1) - 1, 0, 3)
+        h[..., 0] = np.minimum(h[..., 0], x)
+        h[..., 4] = np.maximum(h[..., 4], x)
+        n += np.arange(5) > k[..., None]
+        d += self.increments
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for i in (1, 2, 3):
+                offset = d[..., i] - n[..., i]
+                up = (offset >= 1) & (n[..., i + 1] - n[..., i] > 1)
+                down = (offset <= -1) & (n[..., i - 1] - n[..., i] < -1)
+                step = np.where(up, 1.0, -1.0)
+
+                parabolic = h[..., i] + step / (n[..., i + 1] - n[..., i - 1]) * (
+                    (n[..., i] - n[..., i - 1] + step) * (h[..., i + 1] - h[..., i]) / (n[..., i + 1] - n[..., i])
+                    + (n[..., i + 1] - n[..., i] - step) * (h[..., i] - h[..., i - 1]) / (n[..., i] - n[..., i - 1])
+                )
+                neighbour_height = np.where(up, h[..., i + 1], h[..., i - 1])
+                neighbour_position = np.where(up, n[..., i + 1], n[..., i - 1])
+                linear = h[..., i] + step * (neighbour_height - h[..., i]) / (neighbour_position - n[..., i])
+                between = (h[..., i - 1] < parabolic) & (parabolic < h[..., i + 1])
+
+                adjust = up | down
+                h[..., i] = np.where(adjust, np.where(between, parabolic, linear), h[..., i])
+                n[..., i] += np.where(adjust, step, 0)
+
+        heights[:, running], positions[:, running], desired[:, running] = h, n, d
+        self.heights[:, streams] = heights
+        self.positions[:, streams] = positions
+        self.desired[:, streams] = desired
+        self.count[streams] = count + 1
+
+    def estimate(self):
+        """Estimated percentiles, an array of shape (percentiles, streams)"""
+        estimate = self.heights[..., 2].copy()
+        # streams with fewer than five observations use the percentile of their observations
+        filling = np.flatnonzero(self.count < 5)
+        for j, percentile in enumerate(self.percentiles):
+            estimate[j, filling] = _nanpercentile(self.heights[j, filling].copy(), percentile, axis=-1)
+        return estimate
+
+
+class RobustnessAccumulator:
+    """Robustness metrics of policies, accumulated as blocks of experiments come in
+
+    For every policy and outcome, it counts the scenarios in which the
+    outcome stays under its threshold, keeps the mean and variance of the
+    outcome, the maximum regret and streaming percentiles of the regret.
+    The best value of every scenario, which the regret is taken from, is
+    kept as well. Each block should hold all experiments of its scenarios,
+    so their best values are final.
+
+    Parameters
+    ----------
+    policies : list of str
+    outcome_names : list of str
+    thresholds : dict
+                 outcome name to the threshold of the domain criterion
+    percentiles : list of float, optional
+                  percentiles of the regret to estimate
+
+    Attributes
+    ----------
+    rows : int
+           number of experiments accumulated
+    scenarios : list of str
+    best : ndarray
+           best value of each outcome per scenario
+
+    """
+
+    def __init__(self, policies, outcome_names, thresholds, percentiles=(90,)):
+        self.policies = [str(policy) for policy in policies]
+        self.outcome_names = list(outcome_names)
+        self.thresholds = np.array([thresholds.get(name, np.nan) for name in self.outcome_names], dtype=float)
+        self.rows = 0
+        self.scenarios = []
+        self.best = np.empty((0, len(self.outcome_names)))
+
+        shape = (len(self.policies), len(self.outcome_names))
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.satisfied = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.max_regret_values = np.full(shape, np.nan)
+        self.regret_quantiles = StreamingQuantiles(np.prod(shape), percentiles)
+
+    def update(self, experiments, outcomes):
+        """Add a block of experiments
+
+        Parameters
+        ----------
+        experiments : DataFrame
+                      with a policy and a scenario column
+        outcomes : dict or DataFrame
+                   outcome name to an array with a value per experiment
+
+        """
+        cube = OutcomeCube.from_experiments(experiments, outcomes, self.outcome_names)
+        scenarios = [str(scenario) for scenario in cube.scenarios]
+        if not set(scenarios).isdisjoint(self.scenarios):
+            raise ValueError("the block has scenarios that were accumulated already")
+        index = pd.Index(self.policies).get_indexer([str(policy) for policy in cube.policies])
+        if (index < 0).any():
+            raise ValueError("the block has policies that are not accumulated")
+
+        values = cube.values.astype(float)
+        evaluated = ~np.isnan(values)
+        n = evaluated.sum(axis=1)
+        self.satisfied[index] += np.count_nonzero(values <= self.thresholds, axis=1)
+
+        # merge the mean and variance of the block with the accumulated ones
+        with np.errstate(invalid="ignore", divide="ignore"):
+            block_mean = np.where(n > 0, np.nansum(values, axis=1) / n, 0)
+            block_m2 = np.nansum((values - block_mean[:, None, :]) ** 2, axis=1)
+            count = self.count[index]
+            total = count + n
+            delta = block_mean - self.mean[index]
+            self.mean[index] += np.where(total > 0, delta * n / total, 0)
+            self.m2[index] += block_m2 + np.where(total > 0, delta**2 * count * n / total, 0)
+        self.count[index] = total
+
+        # the block has all experiments of its scenarios, so its regret is final
+        regret = cube.regret()
+        block_max = np.where(n > 0, np.max(np.where(evaluated, regret, -np.inf), axis=1), np.nan)
+        self.max_regret_values[index] = np.fmax(self.max_regret_values[index], block_max)
+        streams = index[:, None] * len(self.outcome_names) + np.arange(len(self.outcome_names))
+        for s in range(regret.shape[1]):
+            observed = evaluated[:, s]
+            self.regret_quantiles.update(streams[observed], regret[:, s][observed])
+
+        self.best = np.concatenate([self.best, np.nanmin(values, axis=0)])
+        self.scenarios += scenarios
+        self.rows += len(experiments)
+
+    def domain_criterion(self):
+        """Fraction of its scenarios in which each outcome of a policy stays under its threshold"""
+        names = [name for name, threshold in zip(self.outcome_names, self.thresholds) if not np.isnan(threshold)]
+        index = [self.outcome_names.index(name) for name in names]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scores = self.satisfied[:, index] / self.count[:, index]
+        return pd.DataFrame(scores, index=pd.Index(self.policies, name="policy"), columns=names)
+
+    def max_regret(self, percentile=None):
+        """Maximum, or an estimated percentile, of the regret of each policy
+
+        Parameters
+        ----------
+        percentile : float, optional
+                     one of the percentiles of the accumulator, the
+                     maximum by default
+
+        """
+        if percentile is None:
+            values = self.max_regret_values
+        else:
+            j = self.regret_quantiles.percentiles.index(percentile)
+            values = self.regret_quantiles.estimate()[j].reshape(self.max_regret_values.shape)
+        return pd.DataFrame(values, index=pd.Index(self.policies, name="policy"), columns=self.outcome_names)
+
+    def statistics(self):
+        """Mean and standard deviation of the outcomes of each policy
+
+        Returns
+        -------
+        tuple of two DataFrames with a row per policy and a column per outcome
+
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(self.count > 0, self.mean, np.nan)
+            std = np.sqrt(self.m2 / (self.count - 1))
+        index = pd.Index(self.policies, name="policy")
+        return (pd.DataFrame(mean, index=index, columns=self.outcome_names),
+                pd.DataFrame(std, index=index, columns=self.outcome_names))
+
+    def save(self, filename):
+        """Save the accumulator to a npz file, which is replaced in one step"""
+        arrays = {"policies": np.array(self.policies), "outcome_names": np.array(self.outcome_names),
+                  "thresholds": self.thresholds, "rows": np.array(self.rows),
+                  "scenarios": np.array(self.scenarios, dtype=str), "best": self.best,
+                  "count": self.count, "satisfied": self.satisfied, "mean": self.mean, "m2": self.m2,
+                  "max_regret_values": self.max_regret_values,
+                  "percentiles": np.array(self.regret_quantiles.percentiles, dtype=float)}
+        for name in ["heights", "positions", "desired", "count"]:
+            arrays[f"quantiles_{name}"] = getattr(self.regret_quantiles, name)
+
+        temporary_file = f"{filename}.tmp"
+        with open(temporary_file, "wb") as fh:
+            np.savez(fh, **arrays)
+        os.replace(temporary_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an accumulator saved with save"""
+        with np.load(filename) as data:
+            thresholds = {name: value for name, value in zip(data["outcome_names"].tolist(), data["thresholds"])
+                          if not np.isnan(value)}
+            accumulator = cls(data["policies"].tolist(), data["outcome_names"].tolist(), thresholds,
+                              data["percentiles"].tolist())
+            accumulator.rows = int(data["rows"])
+            accumulator.scenarios = data["scenarios"].tolist()
+            for name in ["best", "count", "satisfied", "mean", "m2", "max_regret_values"]:
+                setattr(accumulator, name, data[name])
+            for name in ["heights", "positions", "desired", "count"]:
+                setattr(accumulator.regret_quantiles, name, data[f"quantiles_{name}"])
+        return accumulator
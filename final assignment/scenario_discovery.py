@@ -0,0 +1,471 @@
+"""
+PRIM for scenario discovery on large sets of experiments.
+
+This follows the peeling and pasting of the workbench Prim, with its
+default lenient1 objective, but each peel only looks at the data that is
+still in the box. Every numeric uncertainty is sorted once, after which
+the box members are kept in that order per uncertainty, so the candidate
+peels of an uncertainty are read from the sorted values and a cumulative
+sum of y. The box is kept as a count per experiment of the dimensions it
+is outside the box on, which gives the members (count 0) and, for
+pasting, the experiments that are outside on a single dimension.
+Categorical uncertainties keep the number of box members and cases of
+interest per category, so removing a category is scored without looking
+at the data.
+
+The boxes have the box limits, peeling trajectory, show_tradeoff and
+inspect of the workbench PrimBox.
+"""
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from ema_workbench.analysis import scenario_discovery_util as sdutil
+from scipy.stats import binomtest
+
+# violation count of experiments that are in an earlier box, so never in the box
+_EXCLUDED = 10000
+
+
+def _lower_quantile(values, quantile):
+    """get_quantile of the workbench for quantiles up to 0.5, on sorted values"""
+    i = (len(values) - 1) * quantile
+    lower, higher = int(np.floor(i)), int(np.ceil(i))
+    if values[lower] == values[higher]:
+        higher = min(np.searchsorted(values, values[lower], side="right"), len(values) - 1)
+    return (values[lower] + values[higher]) / 2
+
+
+def _upper_quantile(values, quantile):
+    """get_quantile of the workbench for quantiles above 0.5, on sorted values"""
+    i = (len(values) - 1) * quantile
+    lower, higher = int(np.floor(i)), int(np.ceil(i))
+    if values[lower] == values[higher]:
+        lower = max(np.searchsorted(values, values[higher], side="left") - 1, 0)
+    return (values[lower] + values[higher]) / 2
+
+
+def _objective(n_old, y_old, n_new, y_new):
+    """lenient1 objective of the workbench: gain in mean divided by the change in mass"""
+    mean_old = y_old / n_old
+    mean_new = y_new / n_new if n_new > 0 else 0
+    if mean_new == mean_old:
+        return 0
+    return (mean_new - mean_old) / abs(n_old - n_new)
+
+
+class FastPrim:
+    """PRIM on presorted uncertainties
+
+    Parameters
+    ----------
+    x : DataFrame
+        the uncertainties of the experiments, a scenario column is dropped
+    y : array-like
+        1 for the cases of interest, 0 otherwise
+    threshold : float
+                minimum density of a box
+    peel_alpha : float, optional
+    paste_alpha : float, optional
+    mass_min : float, optional
+    categorical : collection of str, optional
+                  numeric columns to treat as categorical, for instance
+                  the Brate and discount rate uncertainties when they are
+                  read from a csv file; text, bool and categorical columns
+                  are always categorical
+
+    """
+
+    def __init__(self, x, y, threshold, peel_alpha=0.05, paste_alpha=0.05, mass_min=0.05, categorical=()):
+        x = x.drop(columns="scenario", errors="ignore").reset_index(drop=True)
+        y = np.asarray(y, dtype=float)
+        if y.shape != (len(x),):
+            raise ValueError(f"y should be a 1-d array with a value per experiment, not of shape {y.shape}")
+        if not np.isin(y, [0, 1]).all():
+            raise ValueError("y should be binary")
+
+        for column in x.columns:
+            if column in categorical or not pd.api.types.is_numeric_dtype(x[column]) \
+                    or pd.api.types.is_bool_dtype(x[column]):
+                x[column] = x[column].astype("category").cat.remove_unused_categories()
+        # like the workbench, categorical columns with a single category are left out
+        x = x.drop(columns=[column for column in x.columns
+                            if isinstance(x[column].dtype, pd.CategoricalDtype) and x[column].nunique() < 2])
+
+        self.x = x
+        self.y = y
+        self.threshold = threshold
+        self.peel_alpha = peel_alpha
+        self.paste_alpha = paste_alpha
+        self.mass_min = mass_min
+        self.n = len(y)
+        self.t_coi = y.sum()
+        self.columns = list(x.columns)
+        self.box_init = sdutil._make_box(x)
+
+        # numeric uncertainties, sorted once
+        self.numeric = [column for column in self.columns if not isinstance(x[column].dtype, pd.CategoricalDtype)]
+        self.discrete = {column for column in self.numeric if pd.api.types.is_integer_dtype(x[column])}
+        self.values = {column: x[column].to_numpy(dtype=float) for column in self.numeric}
+        self.order = {column: np.argsort(values, kind="stable") for column, values in self.values.items()}
+        self.sorted_values = {column: self.values[column][self.order[column]] for column in self.numeric}
+        # constant uncertainties can not be peeled with a gain
+        self.peelable = [column for column in self.numeric if self.sorted_values[column][0] < self.sorted_values[column][-1]]
+        # peels are tried on float, then integer, then categorical uncertainties, like in the workbench
+        self.peelable.sort(key=lambda column: column in self.discrete)
+
+        # categorical uncertainties as codes, with the experiments sorted by category
+        self.categorical = [column for column in self.columns if column not in self.numeric]
+        self.categories = {column: list(x[column].cat.categories) for column in self.categorical}
+        self.codes = {column: x[column].cat.codes.to_numpy() for column in self.categorical}
+        self.code_order = {column: np.argsort(codes, kind="stable") for column, codes in self.codes.items()}
+        self.code_starts = {column: np.searchsorted(codes[self.code_order[column]], np.arange(len(self.categories[column]) + 1))
+                            for column, codes in self.codes.items()}
+
+        self.remaining = np.ones(self.n, dtype=bool)
+        self._boxes = []
+
+    @property
+    def boxes(self):
+        if not self._boxes:
+            return [self.box_init]
+        return [box.box_lim for box in self._boxes]
+
+    @property
+    def stats(self):
+        return [{key: box.peeling_trajectory.iloc[box._cur_box][key] for key in ["coverage", "density", "mass", "res_dim"]}
+                for box in self._boxes]
+
+    def _initial_limits(self):
+        limits = {column: [self.sorted_values[column][0], self.sorted_values[column][-1]] for column in self.numeric}
+        limits.update({column: np.ones(len(self.categories[column]), dtype=bool) for column in self.categorical})
+        return limits
+
+    def _is_restricted(self, column, limit):
+        if column in self.values:
+            return bool(limit[0] != self.sorted_values[column][0] or limit[1] != self.sorted_values[column][-1])
+        return not limit.all()
+
+    def _box_lim(self, limits):
+        """Box limits in the DataFrame format of the workbench"""
+        box_lim = self.box_init.copy()
+        for column in self.numeric:
+            box_lim[column] = [int(limit) for limit in limits[column]] if column in self.discrete else limits[column]
+        for column in self.categorical:
+            allowed = {category for category, inside in zip(self.categories[column], limits[column]) if inside}
+            box_lim[column] = [allowed, allowed]
+        return box_lim
+
+    def _outside(self, column, limit):
+        """Experiments outside the limit of one uncertainty"""
+        if column in self.values:
+            values = self.values[column]
+            return (values < limit[0]) | (values > limit[1])
+        return ~limit[self.codes[column]]
+
+    def _set_box(self, limits):
+        """Set the violation counts, sorted members and category counts of a box"""
+        self.limits = limits
+        self.violations = np.where(self.remaining, 0, _EXCLUDED).astype(np.int16)
+        for column, limit in limits.items():
+            self.violations += self._outside(column, limit)
+        self.members = {column: self.order[column][self.violations[self.order[column]] == 0]
+                        for column in self.peelable}
+        inside = np.flatnonzero(self.violations == 0)
+        self.box_n, self.box_y = len(inside), self.y[inside].sum()
+        self.category_n = {column: np.bincount(self.codes[column][inside], minlength=len(self.categories[column]))
+                           for column in self.categorical}
+        self.category_y = {column: np.bincount(self.codes[column][inside], weights=self.y[inside],
+                                               minlength=len(self.categories[column]))
+                           for column in self.categorical}
+        self.n_restricted = sum(self._is_restricted(column, limit) for column, limit in limits.items())
+
+    def _numeric_peels(self, column):
+        """Candidate peels of a numeric uncertainty as (n, y, limit, sorted members removed)"""
+        members = self.members[column]
+        values = self.values[column][members]
+        cumulative = np.concatenate([[0], np.cumsum(self.y[members])])
+        m = len(values)
+        lower, upper = self.limits[column]
+
+        # the workbench peels the upper side first
+        if column in self.discrete:
+            peel = int(_upper_quantile(values, 1 - self.peel_alpha))
+            keep = np.searchsorted(values, upper, side="left") if peel == upper else np.searchsorted(values, peel, side="right")
+            limit = values[keep - 1] if keep > 0 else values[-1]
+        else:
+            limit = _upper_quantile(values, 1 - self.peel_alpha)
+            keep = np.searchsorted(values, limit, side="right")
+        peels = [(keep, cumulative[keep], [lower, limit], members[keep:])]
+
+        if column in self.discrete:
+            peel = int(_lower_quantile(values, self.peel_alpha))
+            start = np.searchsorted(values, lower, side="right") if peel == lower else np.searchsorted(values, peel, side="left")
+            limit = values[start] if start < m else values[0]
+        else:
+            limit = _lower_quantile(values, self.peel_alpha)
+            start = np.searchsorted(values, limit, side="left")
+        peels.append((m - start, cumulative[m] - cumulative[start], [limit, upper], members[:start]))
+        return peels
+
+    def _peel(self):
+        """Apply the best peel, returns False if no peel improves the box"""
+        candidates = []
+        for column in self.peelable:
+            for n, y, limit, removed in self._numeric_peels(column):
+                candidates.append((column, n, y, limit, removed))
+        for column in self.categorical:
+            allowed = self.limits[column]
+            if allowed.sum() > 1:
+                for code in np.flatnonzero(allowed):
+                    limit = allowed.copy()
+                    limit[code] = False
+                    candidates.append((column, self.box_n - self.category_n[column][code],
+                                       self.box_y - self.category_y[column][code], limit, code))
+
+        best, best_score = None, None
+        for column, n, y, limit, removed in candidates:
+            n_restricted = (self.n_restricted - self._is_restricted(column, self.limits[column])
+                            + self._is_restricted(column, limit))
+            score = (_objective(self.box_n, self.box_y, n, y), len(self.columns) - n_restricted)
+            if best_score is None or score > best_score:
+                best, best_score = (column, n, y, limit, removed), score
+        if best is None:
+            return False
+
+        column, n, y, limit, removed = best
+        if not (n / self.n >= self.mass_min and n < self.box_n and best_score[0] > 0):
+            return False
+
+        # experiments in the peeled range are outside on one more dimension, members or not
+        if column in self.values:
+            lower, upper = self.limits[column]
+            sorted_values, order = self.sorted_values[column], self.order[column]
+            if limit[0] > lower:
+                peeled = order[np.searchsorted(sorted_values, lower, side="left"):
+                               np.searchsorted(sorted_values, limit[0], side="left")]
+            else:
+                peeled = order[np.searchsorted(sorted_values, limit[1], side="right"):
+                               np.searchsorted(sorted_values, upper, side="right")]
+            removed_codes = {other: self.codes[other][removed] for other in self.categorical}
+        else:
+            starts = self.code_starts[column]
+            peeled = self.code_order[column][starts[removed]:starts[removed + 1]]
+            removed = peeled[self.violations[peeled] == 0]
+            removed_codes = {other: self.codes[other][removed] for other in self.categorical}
+        self.violations[peeled] += 1
+
+        for other in self.categorical:
+            categories = len(self.categories[other])
+            self.category_n[other] -= np.bincount(removed_codes[other], minlength=categories)
+            self.category_y[other] -= np.bincount(removed_codes[other], weights=self.y[removed], minlength=categories)
+        self.members = {other: members[self.violations[members] == 0] for other, members in self.members.items()}
+        self.n_restricted += self._is_restricted(column, limit) - self._is_restricted(column, self.limits[column])
+        self.limits = {**self.limits, column: limit}
+        self.box_n, self.box_y = n, y
+        return True
+
+    def _paste(self):
+        """Apply the best paste, returns False if no paste improves the box"""
+        candidates = []
+        for column, limit in self.limits.items():
+            if not self._is_restricted(column, limit):
+                continue
+            outside = self._outside(column, limit)
+            # experiments inside the box on all other dimensions
+            others = (self.violations - outside) == 0
+
+            if column in self.values:
+                values = self.values[column]
+                minimum, maximum = self.sorted_values[column][0], self.sorted_values[column][-1]
+                data = np.sort(values[others & (values <= limit[0])])
+                lower = _upper_quantile(data, 1 - self.paste_alpha) if data.size else minimum
+                candidates.append((column, [lower, limit[1]]))
+                data = np.sort(values[others & (values >= limit[1])])
+                upper = _lower_quantile(data, self.paste_alpha) if data.size else maximum
+                candidates.append((column, [limit[0], upper]))
+            else:
+                for code in np.flatnonzero(~limit):
+                    pasted = limit.copy()
+                    pasted[code] = True
+                    candidates.append((column, pasted))
+
+        best, best_score = None, None
+        for column, limit in candidates:
+            inside = (self.violations - self._outside(column, self.limits[column])) == 0
+            inside &= ~self._outside(column, limit)
+            n, y = inside.sum(), self.y[inside].sum()
+            n_restricted = (self.n_restricted - self._is_restricted(column, self.limits[column])
+                            + self._is_restricted(column, limit))
+            score = (_objective(self.box_n, self.box_y, n, y), len(self.columns) - n_restricted)
+            if best_score is None or score > best_score:
+                best, best_score = (column, limit, n, y), score
+        if best is None:
+            return False
+
+        column, limit, n, y = best
+        if not (n / self.n >= self.mass_min and n > self.box_n and best_score[0] > 0
+                and y / n > self.box_y / self.box_n):
+            return False
+        self._set_box({**self.limits, column: limit})
+        return True
+
+    def _record(self, box):
+        box.update(self._box_lim(self.limits), int(self.box_n), int(self.box_y), self.n_restricted)
+
+    def find_box(self):
+        """Find the next box in the experiments that are not in an earlier box
+
+        Returns
+        -------
+        FastPrimBox, or None if there are no experiments left. A box that
+        does not meet the threshold is the dump box with all remaining
+        experiments.
+
+        """
+        for box in self._boxes:
+            self.remaining &= ~box.inside
+        if not self.remaining.any():
+            return None
+
+        box = FastPrimBox(self, self.remaining.copy())
+        self._set_box(self._initial_limits())
+        self._record(box)
+        while self._peel():
+            self._record(box)
+        while self._paste():
+            self._record(box)
+        box.inside = self.violations == 0
+
+        if self.box_y / self.box_n < self.threshold:
+            box = FastPrimBox(self, self.remaining.copy())
+            self._set_box(self._initial_limits())
+            self._record(box)
+            box.inside = self.violations == 0
+        self._boxes.append(box)
+        return box
+
+
+class FastPrimBox:
+    """Peeling trajectory of a box found by FastPrim
+
+    Parameters
+    ----------
+    prim : FastPrim
+    remaining : ndarray
+                experiments that were not in an earlier box
+
+    Attributes
+    ----------
+    peeling_trajectory : DataFrame
+                         coverage, density, mean, res_dim, mass, id, n and
+                         k of each step
+    box_lims : list of DataFrame
+               the box limits of each step
+    inside : ndarray
+             experiments in the last box of the trajectory
+
+    """
+
+    def __init__(self, prim, remaining):
+        self.prim = prim
+        self.remaining = remaining
+        self.box_lims = []
+        self._trajectory = []
+        self._cur_box = -1
+
+    def update(self, box_lim, n, k, n_restricted):
+        self.box_lims.append(box_lim)
+        self._trajectory.append({"coverage": k / self.prim.t_coi, "density": k / n, "mean": k / n,
+                                 "res_dim": n_restricted, "mass": n / self.prim.n,
+                                 "id": len(self._trajectory), "n": n, "k": k})
+        self._cur_box = len(self._trajectory) - 1
+
+    @property
+    def peeling_trajectory(self):
+        return pd.DataFrame(self._trajectory)
+
+    @property
+    def box_lim(self):
+        return self.box_lims[self._cur_box]
+
+    def select(self, i):
+        """Select a step of the peeling trajectory as the box"""
+        self._cur_box = i
+
+    def _quasi_p(self, i):
+        """One sided binomial test of each restriction of a box, as in the workbench"""
+        box_lim, stats = self.box_lims[i], self._trajectory[i]
+        prim = self.prim
+        restricted = sdutil._determine_restricted_dims(box_lim, prim.box_init)
+
+        outside = {}
+        for column in restricted:
+            if column in prim.values:
+                outside[column] = prim._outside(column, box_lim[column].values)
+            else:
+                categories = box_lim.at[0, column]
+                outside[column] = ~np.array([category in categories for category in prim.categories[column]])[
+                    prim.codes[column]]
+        violations = np.where(self.remaining, 0, _EXCLUDED) + sum(outside.values())
+
+        def quasi_p(inside):
+            p = prim.y[inside].sum() / inside.sum()
+            return binomtest(int(stats["k"]), int(stats["n"]), p, alternative="greater").pvalue
+
+        qp_values = {}
+        for column in restricted:
+            others = (violations - outside[column]) == 0
+            if column in prim.values:
+                values = prim.values[column]
+                qp = []
+                for side, (limit, unlimited) in enumerate(zip(box_lim[column], prim.box_init[column])):
+                    if limit == unlimited:
+                        qp.append(-1)
+                    elif side == 0:
+                        qp.append(quasi_p(others & (values <= box_lim.at[1, column])))
+                    else:
+                        qp.append(quasi_p(others & (values >= box_lim.at[0, column])))
+                qp_values[column] = qp
+            else:
+                qp_values[column] = [quasi_p(others), -1]
+        return qp_values
+
+    def inspect(self, i=None, style="table", **kwargs):
+        """Print the statistics and box limits of a step, or plot them with style graph
+
+        Parameters
+        ----------
+        i : int, optional
+            step of the peeling trajectory, the selected box by default
+        style : {'table', 'graph', 'data'}
+        kwargs : passed to the box plot of the workbench, ax to plot on an existing axes
+
+        """
+        if style not in ("table", "graph", "data"):
+            raise ValueError(f"style must be one of 'graph', 'table' or 'data', not {style}")
+        i = self._cur_box if i is None else i
+        qp_values = self._quasi_p(i)
+        uncs = sorted(qp_values, key=lambda column: qp_values[column])
+        stats = self.peeling_trajectory.iloc[i]
+
+        if style == "graph":
+            ax = kwargs.pop("ax", None)
+            if ax is None:
+                _, ax = plt.subplots()
+            return sdutil.plot_box(self.box_lims[i], qp_values, self.prim.box_init, uncs,
+                                   stats["coverage"], stats["density"], ax, **kwargs)
+
+        columns = pd.MultiIndex.from_product([[f"box {i}"], ["min", "max", "qp value", "qp value"]])
+        box_lim = pd.DataFrame([self.box_lims[i][column].tolist() + qp_values[column] for column in uncs],
+                               index=uncs, columns=columns)
+        box_lim.iloc[:, 2:] = box_lim.iloc[:, 2:].replace(-1, np.nan)
+        if style == "data":
+            return stats, box_lim
+        print(stats)
+        print()
+        print(box_lim)
+        print()
+
+    def show_tradeoff(self, annotated=False, **kwargs):
+        """Plot the coverage and density of the steps, coloured by the number of restricted dimensions"""
+        return sdutil.plot_tradeoff(self.peeling_trajectory, annotated=annotated, **kwargs)
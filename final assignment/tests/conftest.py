@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the assignment are scripts importing each other by name, like they are run
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
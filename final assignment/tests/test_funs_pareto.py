@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+from ema_workbench import Model, RealParameter, ScalarOutcome
+from ema_workbench.em_framework.optimization import epsilon_nondominated as workbench_epsilon_nondominated
+from ema_workbench.em_framework.optimization import to_problem
+
+from funs_pareto import epsilon_nondominated
+
+
+@pytest.fixture
+def problem():
+    model = Model("toy", function=lambda **kwargs: {})
+    model.levers = [RealParameter("l1", 0, 1), RealParameter("l2", 0, 1)]
+    model.outcomes = [ScalarOutcome("o1", kind=ScalarOutcome.MINIMIZE),
+                      ScalarOutcome("o2", kind=ScalarOutcome.MAXIMIZE),
+                      ScalarOutcome("o3", kind=ScalarOutcome.MINIMIZE)]
+    return to_problem(model, "levers")
+
+
+def get_results(seed, n):
+    rng = np.random.default_rng(seed)
+    levers = rng.random((n, 2))
+    o1 = levers[:, 0]
+    o2 = levers[:, 1] - levers[:, 0] ** 2
+    o3 = 1 - levers[:, 1] + 0.1 * rng.random(n)
+    results = pd.DataFrame({"l1": levers[:, 0], "l2": levers[:, 1], "o1": o1, "o2": o2, "o3": o3})
+    # rows on the corner of a box, and rows with the outcomes of another row, for the ties
+    results.iloc[: n // 5, 2:] = (results.iloc[: n // 5, 2:] / 0.125).round() * 0.125
+    copies = results.sample(n // 5, random_state=seed)
+    copies[["l1", "l2"]] = rng.random((len(copies), 2))
+    return pd.concat([results, copies], ignore_index=True)
+
+
+def test_same_as_workbench(problem):
+    results = [get_results(seed, 500) for seed in range(3)]
+    epsilons = [0.0625, 0.0625, 0.0625]
+
+    expected = workbench_epsilon_nondominated(results, epsilons, problem)
+    actual = epsilon_nondominated(results, epsilons, problem)
+
+    pd.testing.assert_frame_equal(actual, expected.reset_index(drop=True), check_dtype=False)
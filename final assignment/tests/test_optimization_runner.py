@@ -0,0 +1,67 @@
+from concurrent.futures import Future
+
+from ema_workbench import Model, RealParameter, ScalarOutcome, Scenario
+
+from batch_evaluator import SharedPoolEvaluator, initialize_worker
+from optimization_runner import EarlyStopping, optimize_steady_state
+
+
+class ToyNetwork:
+    """Two conflicting objectives of two levers, with the batched interface of DikeNetwork"""
+
+    def __call__(self, **kwargs):
+        return next(iter(self.run_policies({}, [kwargs])))
+
+    def run_policies(self, scenario, lever_matrix, num_events=None):
+        for _, levers in lever_matrix.iterrows():
+            yield {"f1": levers["x1"], "f2": 1 - levers["x1"] + levers["x2"]}
+
+
+class ImmediatePool:
+    """Process pool running every submitted batch at once, in the calling process"""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def get_evaluator():
+    model = Model("toy", function=ToyNetwork())
+    model.uncertainties = [RealParameter("a", 0, 1)]
+    model.levers = [RealParameter("x1", 0, 1), RealParameter("x2", 0, 1)]
+    model.outcomes = [ScalarOutcome("f1", kind=ScalarOutcome.MINIMIZE),
+                      ScalarOutcome("f2", kind=ScalarOutcome.MINIMIZE)]
+    initialize_worker([model])
+    return model, SharedPoolEvaluator([model], ImmediatePool())
+
+
+def test_more_batches_in_progress_than_population():
+    # 16 workers with batches of 10 are submitted before the first result of a population of 100 comes back
+    model, evaluator = get_evaluator()
+    results, _ = optimize_steady_state(model, evaluator, 1000, [0.1, 0.1], reference=Scenario("reference", a=0.5),
+                                       population_size=100,
+                                       n_workers=16, batch_size=10)
+    assert len(results) > 0
+
+
+class CountingStopping(EarlyStopping):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def __call__(self, optimizer):
+        self.calls.append(optimizer.nfe)
+        self.stop_nfe = optimizer.nfe
+        self.reason = f"stopped at {optimizer.nfe}"
+        return True
+
+
+def test_early_stopping_is_not_checked_after_a_stop():
+    # the batches in progress at the stop contain more than a population size of evaluations
+    model, evaluator = get_evaluator()
+    stopping = CountingStopping()
+    optimize_steady_state(model, evaluator, 1000, [0.1, 0.1], reference=Scenario("reference", a=0.5),
+                          population_size=20, n_workers=8, batch_size=10, early_stopping=stopping)
+    assert stopping.calls == [20]
+    assert stopping.stop_nfe == 20
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+from ema_workbench.analysis import prim
+
+from scenario_discovery import FastPrim
+
+
+def get_experiments(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    x = pd.DataFrame({"a": rng.random(n), "b": rng.random(n), "c": rng.integers(0, 20, n).astype(float),
+                      "shape": pd.Categorical(rng.choice(["low", "mid", "high"], n))})
+    y = ((x["a"] > 0.6) & (x["b"] < 0.5) & (x["shape"] != "low")) | ((x["c"] < 3) & (x["a"] < 0.2))
+    # some noise, so the boxes are not pure
+    y ^= rng.random(n) < 0.05
+    return x, y.to_numpy()
+
+
+def test_same_as_workbench():
+    x, y = get_experiments()
+    workbench = prim.Prim(x, y, threshold=0.6, peel_alpha=0.05)
+    fast = FastPrim(x, y, threshold=0.6, peel_alpha=0.05)
+
+    for _ in range(2):
+        expected = workbench.find_box()
+        actual = fast.find_box()
+
+        columns = ["coverage", "density", "mass", "res_dim", "n", "k"]
+        pd.testing.assert_frame_equal(actual.peeling_trajectory[columns],
+                                      expected.peeling_trajectory[columns], check_dtype=False)
+        assert len(actual.box_lims) == len(expected.box_lims)
+        for actual_lim, expected_lim in zip(actual.box_lims, expected.box_lims):
+            pd.testing.assert_frame_equal(actual_lim, expected_lim, check_dtype=False)
@@ -0,0 +1,77 @@
+"""
+Evaluator running the experiments in a pool of threads within one process.
+
+Compared to the MultiprocessingEvaluator there are no worker processes to
+spawn and no experiments or outcomes to pickle: all threads share the data
+loaded by the model. Every thread works on its own copy of the model
+objects, because the workbench stores the outcomes of a run on the model.
+
+Note that the DikeNetwork simulation is plain Python, so it only runs in
+parallel on a free-threaded (no GIL) Python build. With the GIL, the
+threads take turns, and the model copies only add memory and copy time.
+The multi-MORDM scripts therefore do not offer this evaluator;
+benchmark_evaluators.py compares it with the other evaluators.
+"""
+import copy
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ema_workbench.em_framework.evaluators import BaseEvaluator
+from ema_workbench.em_framework.experiment_runner import ExperimentRunner
+from ema_workbench.em_framework.model import AbstractModel
+from ema_workbench.em_framework.points import experiment_generator
+from ema_workbench.em_framework.util import NamedObjectMap
+from ema_workbench.util import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+
+class ThreadPoolEvaluator(BaseEvaluator):
+    """Evaluator for experiments using a pool of threads
+
+    Has the same perform_experiments and optimize interface as the
+    MultiprocessingEvaluator.
+
+    Parameters
+    ----------
+    msis : collection of models
+    n_threads : int, optional
+                number of threads, defaults to the number of cpu's
+
+    """
+
+    def __init__(self, msis, n_threads=None):
+        super().__init__(msis)
+        self.n_threads = n_threads if n_threads is not None else os.cpu_count()
+        self._pool = None
+        self._local = None
+
+    def initialize(self):
+        self._pool = ThreadPoolExecutor(max_workers=self.n_threads)
+        self._local = threading.local()
+
+    def finalize(self):
+        self._pool.shutdown()
+        self._pool = None
+
+    def _run_experiment(self, experiment):
+        """Run a single experiment with the model copies of this thread"""
+        runner = getattr(self._local, "runner", None)
+        if runner is None:
+            models = NamedObjectMap(AbstractModel)
+            models.extend(copy.deepcopy(self._msis))
+            runner = ExperimentRunner(models)
+            self._local.runner = runner
+        return experiment, runner.run_experiment(experiment)
+
+    def evaluate_experiments(self, scenarios, policies, callback, combine="factorial"):
+        _logger.info(f"performing experiments using {self.n_threads} threads")
+
+        ex_gen = experiment_generator(scenarios, self._msis, policies, combine=combine)
+        futures = [self._pool.submit(self._run_experiment, exp) for exp in ex_gen]
+
+        # results are processed in the main thread
+        for future in as_completed(futures):
+            experiment, outcomes = future.result()
+            callback(experiment, outcomes)